@@ -1,6 +1,28 @@
+import sys
+import time
+import random
+import asyncio
 import datetime
+import threading
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
+from itertools import repeat
+from ResponseCache import ResponseCache
+from CircuitBreaker import CircuitBreaker
+from ConnectionPool import ConnectionPool
+from VectorizedPayments import PaymentColumns, paymentPlanInfoColumns, np
+from IncrementalState import IncrementalState
+from DateParser import DateParser
+from Metrics import RequestMetrics, writeMetrics
+from Hooks import hooked
+from Sharding import APIShardAccess
+from JsonStream import StreamDecoder, jsonLoads
+
+
+# result of request for cached entry which is not modified since cached
+NotModified = object()
 
 
 class APIAccess:
@@ -20,68 +42,461 @@ class APIAccess:
         """
 
     class APISession:
-        """HTTP session to query Debts DB API"""
+        """
+        HTTP session to query Debts DB API
+        requests.Session is not thread-safe : each thread gets its own session object, reused between its calls
+        Sessions of all tables and threads share connections of ConnectionPool, if given
 
-        def __init__(self, cfg, table):
+        Response body is decoded as it arrives (StreamDecoder, JsonStream.py), by orjson when installed.
+        Config settings (all optional) :
+            Decode.Streaming : false to read whole body before decoding, defaults to true
+            Decode.Backend   : auto, orjson or json, defaults to auto (jsonLoads)
+            Decode.ChunkSize : bytes read from connection at a time when streaming, defaults to 65536
+        """
+
+        # sleep between retries, replaceable for testing
+        sleep = staticmethod(time.sleep)
+
+        def __init__(self, cfg, table, cache=None, pool=None):
             self.cfg = cfg
             self.table = table
-            self.session = requests.Session()
+            self.cache = cache
+            self.pool = pool
+            self.local = threading.local()
+            self.breaker = CircuitBreaker(cfg)
 
-        def httpRequest(self, request_params={}) -> list:
-            """Generic HTTP GET request to API"""
+            # (connect, read) timeouts in seconds : Tables.<table>.Timeout config setting
+            timeout_cfg = cfg.get('Tables', {}).get(table, {}).get('Timeout', {})
+            self.timeout = (float(timeout_cfg.get('Connect', 3.05)), float(timeout_cfg.get('Read', 30)))
+
+            decode_cfg = cfg.get('Decode', {})
+            self.streaming = bool(decode_cfg.get('Streaming', True))
+            self.chunk_size = int(decode_cfg.get('ChunkSize', 65536))
+            self.loads = jsonLoads(cfg)
+
+            self.lock = threading.Lock()
+            self.counters = {'requests': 0, 'retries': 0, 'failures': 0, 'fast_failures': 0}
+            self.metrics = RequestMetrics()
+
+        def count(self, counter):
+            with self.lock:
+                self.counters[counter] += 1
+
+        def stats(self) -> dict:
+            """Retry and circuit breaker counters"""
+            with self.lock:
+                counters = dict(self.counters)
+            return dict(counters, breaker=self.breaker.stats())
+
+        def metricsSnapshot(self) -> dict:
+            """Request and retry counts, response bytes, decode time, errors by class, latency histogram"""
+            with self.lock:
+                counters = {'requests': self.counters['requests'], 'retries': self.counters['retries']}
+            return dict(counters, **self.metrics.snapshot())
 
-            def err_msg():
-                """Format error message """
-                sparams = "no params" if len(request_params) == 0 \
-                    else reduce(lambda acc, k: acc + f" {k}={request_params[k]}", request_params, " ")
-                return f"Error fetching data from {self.table} for {sparams}"
-
-            def check_error_response():
-                # expect list of dict
-                # error response : { 'error' : error-description }
-                if type(data) is not list:
-                    if type(data) is dict and 'error' in data:
-                        raise Exception(f"{err_msg()}: http response error: {data['error']}")
-                    else:
-                        raise Exception(f"{err_msg()}: invalid http response {data}")
-
-            # -- retry loop
+        def backoffDelay(self, attempt) -> float:
+            """
+            Exponential backoff with full jitter : random delay up to Retry.BackoffBase * 2^attempt seconds,
+            capped by Retry.BackoffMax
+            """
+            retry_cfg = self.cfg.get('Retry', {})
+            base = float(retry_cfg.get('BackoffBase', 0.2))
+            cap = float(retry_cfg.get('BackoffMax', 10))
+            return random.uniform(0, min(cap, base * 2 ** attempt))
+
+        def iterBody(self, rsp, start, request_params={}):
+            """
+            Generator : records of JSON array response body, yielded as body is read and decoded chunk by chunk :
+            neither whole body nor all its records are held in memory. Records latency until body is read, bytes
+            and decode time. Body which is not a JSON array (error response) raises
+            """
+            nbytes, decode_seconds = 0, 0.0
+            try:
+                if not self.streaming:
+                    nbytes = len(rsp.content)
+                    decode_start = time.perf_counter()
+                    data = self.loads(rsp.content)
+                    decode_seconds = time.perf_counter() - decode_start
+                    self.checkResponse(data, request_params)
+                    yield from data
+                    return
+
+                decoder = StreamDecoder(self.loads)
+                for chunk in rsp.iter_content(self.chunk_size):
+                    nbytes += len(chunk)
+                    decode_start = time.perf_counter()
+                    records = decoder.feed(chunk)
+                    decode_seconds += time.perf_counter() - decode_start
+                    yield from records
+                decode_start = time.perf_counter()
+                data = decoder.close()
+                decode_seconds += time.perf_counter() - decode_start
+                if not decoder.array:
+                    self.checkResponse(data, request_params)
+                yield from data
+
+            # invalid JSON body : request error without response, as raised by Response.json
+            except ValueError as err:
+                raise requests.exceptions.InvalidJSONError(f"Invalid JSON response : {err}")
+            finally:
+                self.metrics.observeResponse(time.perf_counter() - start, nbytes)
+                self.metrics.observeDecode(decode_seconds, nbytes)
+
+        def decodeBody(self, rsp, start, request_params={}) -> list:
+            """Read and decode whole response body : list of records"""
+            return list(self.iterBody(rsp, start, request_params))
+
+        @property
+        def session(self) -> requests.Session:
+            if not hasattr(self.local, 'session'):
+                self.local.session = requests.Session() if self.pool is None else self.pool.newSession()
+            return self.local.session
+
+        def errorMessage(self, request_params) -> str:
+            sparams = "no params" if len(request_params) == 0 \
+                else reduce(lambda acc, k: acc + f" {k}={request_params[k]}", request_params, " ")
+            return f"Error fetching data from {self.table} for {sparams}"
+
+        def checkResponse(self, data, request_params):
+            """Expect list of dict. Error response : { 'error' : error-description }"""
+            if type(data) is not list:
+                self.metrics.observeError('response')
+                if type(data) is dict and 'error' in data:
+                    raise Exception(f"{self.errorMessage(request_params)}: http response error: {data['error']}")
+                else:
+                    raise Exception(f"{self.errorMessage(request_params)}: invalid http response {data}")
+
+        def send(self, request_params, entry, read):
+            """
+            GET request with retries and circuit breaker : return read(response, start time) for successful response,
+            NotModified if cached entry is not modified. Connection errors and timeouts, including those raised while
+            read reads body, are retried
+            """
             nretry = int(self.cfg['RetryConnection'])
             url = self.cfg['URL'][self.table]
+            attempt = 0
             while True:
                 nretry -= 1
+
+                # circuit breaker : fail fast while API keeps failing
+                if not self.breaker.allowRequest():
+                    self.count('fast_failures')
+                    self.metrics.observeError('circuit_open')
+                    raise Exception(f"{self.errorMessage(request_params)}: circuit breaker open")
+
                 try:
-                    rsp = self.session.get(url, params=request_params)
-                    rsp.raise_for_status()
-                    data = rsp.json()
-                    check_error_response()
+                    self.count('requests')
+                    start = time.perf_counter()
+                    rsp = self.session.get(url, params=request_params, headers=ResponseCache.validators(entry),
+                                           timeout=self.timeout, stream=self.streaming)
+
+                    # not modified since cached, error status : body is not decoded
+                    if (rsp.status_code == 304 and entry is not None) or not rsp.ok:
+                        self.metrics.observeResponse(time.perf_counter() - start, len(rsp.content))
+
+                    # any response but server error, client errors included, shows API is reachable
+                    if rsp.status_code < 500:
+                        self.breaker.recordSuccess()
 
-                    return data
+                    # not modified since cached
+                    if rsp.status_code == 304 and entry is not None:
+                        return NotModified
 
-                # timeout, connection error : retry until all retries exhausted
+                    rsp.raise_for_status()
+                    return read(rsp, start)
+
+                # timeout, connection error : retry with backoff until all retries exhausted
                 except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as err:
+                    self.metrics.observeError('timeout' if isinstance(err, requests.exceptions.Timeout)
+                                              else 'connection')
+                    self.count('failures')
+                    self.breaker.recordFailure()
                     if nretry == 0:
-                        raise Exception(f"{err_msg()}: {err}")
+                        raise Exception(f"{self.errorMessage(request_params)}: {err}")
+                    self.count('retries')
+                    APIAccess.APISession.sleep(self.backoffDelay(attempt))
+                    attempt += 1
 
-                # other errors
+                # other errors : server errors count as failures for circuit breaker
                 except (requests.exceptions.HTTPError, requests.exceptions.RequestException) as err:
-                    raise Exception(f"{err_msg()}: {err}")
+                    # invalid JSON body has no error response
+                    self.metrics.observeError('response' if err.response is None
+                                              else f"http_{err.response.status_code // 100}xx")
+                    if err.response is not None and err.response.status_code >= 500:
+                        self.count('failures')
+                        self.breaker.recordFailure()
+                    raise Exception(f"{self.errorMessage(request_params)}: {err}")
+
+                # probe request ended without recording success or failure (e.g. unexpected error) : next one probes
+                finally:
+                    self.breaker.releaseProbe()
+
+        @hooked('httpRequest')
+        def httpRequest(self, request_params={}) -> list:
+            """Generic HTTP GET request to API"""
+
+            # -- response cache : fresh entry is served without request, expired entry is revalidated
+            entry = None
+            if self.cache is not None:
+                entry = self.cache.get(self.table, request_params)
+                if entry is not None and self.cache.isFresh(self.table, entry):
+                    self.cache.count(self.table, 'hits')
+                    return entry['data']
+
+            result = self.send(request_params, entry,
+                               lambda rsp, start: (self.decodeBody(rsp, start, request_params), rsp.headers))
+            if result is NotModified:
+                self.cache.count(self.table, 'revalidated')
+                self.cache.refresh(self.table, request_params, entry)
+                return entry['data']
+
+            data, headers = result
+            if self.cache is not None:
+                self.cache.count(self.table, 'misses')
+                self.cache.put(self.table, request_params, data, headers.get('ETag'), headers.get('Last-Modified'))
+            return data
+
+        @hooked('httpRequest')
+        def httpRequestStream(self, request_params={}) -> tuple:
+            """HTTP GET request to API, response body is left to be read by iterBody : (response, start time)"""
+            return self.send(request_params, None, lambda rsp, start: (rsp, start))
+
+        def iterRecords(self, request_params={}):
+            """
+            Generator : records of HTTP GET request to API, yielded as response body is decoded (iterBody) :
+            consumer starts on first records while body is still read, memory is bounded by a chunk.
+            Request is retried as httpRequest does until response status is received; error while body is read
+            raises after records before it are yielded.
+            Whole response is read by httpRequest when streaming is disabled or responses are cached
+            """
+            if not self.streaming or self.cache is not None:
+                yield from self.httpRequest(request_params)
+                return
+
+            rsp, start = self.httpRequestStream(request_params)
+            try:
+                yield from self.iterBody(rsp, start, request_params)
+            except requests.exceptions.RequestException as err:
+                self.metrics.observeError('response' if isinstance(err, requests.exceptions.InvalidJSONError)
+                                          else 'connection')
+                raise Exception(f"{self.errorMessage(request_params)}: {err}")
+            finally:
+                rsp.close()
+
+        def httpRequestPages(self, request_params={}, page_size=None, prefetch=False):
+            """
+            Generator : query API page by page, yielding one page (list of records) at a time
+            Paging parameters are json-server style : _page/_limit, or _start/_end
+            if config setting Tables.<table>.Paging is 'range'.
+            Iteration stops at first page with less than page_size records.
+            :param page_size : records per page; if not set, whole result is fetched in one request
+            :param prefetch  : fetch next page in background thread while current page is processed
+            """
+            if not page_size:
+                yield self.httpRequest(request_params)
+                return
+
+            paging = self.cfg.get('Tables', {}).get(self.table, {}).get('Paging', 'page')
+
+            def pageParams(npage) -> dict:
+                if paging == 'range':
+                    return dict(request_params, _start=npage * page_size, _end=(npage + 1) * page_size)
+                return dict(request_params, _page=npage + 1, _limit=page_size)
+
+            executor = ThreadPoolExecutor(1) if prefetch else None
+            try:
+                npage = 0
+                next_page = executor.submit(self.httpRequest, pageParams(npage)) if prefetch else None
+                while True:
+                    page = next_page.result() if prefetch else self.httpRequest(pageParams(npage))
+                    last_page = len(page) < page_size
+                    npage += 1
+                    # next page is fetched while this page is consumed
+                    if prefetch and not last_page:
+                        next_page = executor.submit(self.httpRequest, pageParams(npage))
+                    yield page
+                    if last_page:
+                        return
+            finally:
+                if executor is not None:
+                    executor.shutdown()
 
     # ============= DBAccess instance
     _instance = None
 
+    # fetch modes accepted by Open
+    FetchModes = ["single", "bulk", "async", "threads", "batched", "incremental", "processes", "sqlite", "spill"]
+
     @classmethod
     def Instance(cls, cfg):
         if cls._instance is None:
             cls._instance = APIAccess(cfg)
         return cls._instance
 
+    @classmethod
+    def WriteRunMetrics(cls, cfg, stages):
+        """
+        Write metrics of run (writeMetrics) at the end of run, when run result is decided : error writing them is
+        reported to stderr, not raised
+        """
+        try:
+            cls.Instance(cfg).writeMetrics(stages)
+        except Exception as err:
+            sys.stderr.write(f"***ERROR*** Cannot write metrics : {err}\n")
+
+    @classmethod
+    def Open(cls, cfg, fetch_mode="single", shard=None):
+        """
+        Open API access for given fetch mode, restricted to debts of shard if any (ShardSpec, Sharding.py)
+        :param fetch_mode
+            single  : query PaymentPlans and Payments per debt id (1 + 2N requests)
+            bulk    : load all 3 tables at once and join them in memory (3 requests)
+            async   : load all debts, then query payment plans and payments for many debts concurrently
+            threads : query payment plans and payments per debt, enriching many debts in thread pool
+            batched : query payment plans and payments for chunks of debts with multi-id requests (~ 1 + 2N/K requests)
+            incremental : load payment plans at once, and query only payments made since last run
+            processes : load all 3 tables at once, compute payment plan info in process pool (ProcessShards.py)
+            sqlite  : query local SQLite mirror of all 3 tables (SQLiteMirror.py), synced from API if missing or old
+            spill   : load all 3 tables page by page and join them out of core, within Spill.MemoryBudget (SpillJoin.py)
+        """
+        api = cls.Instance(cfg)
+        if fetch_mode == "sqlite":
+            # mirror holds all debts whatever the shard, shared by shard runs : shard filters records read from mirror
+            from SQLiteMirror import SQLiteMirror
+            return SQLiteMirror.Open(api, shard)
+        if fetch_mode == "spill":
+            # shard's payments are selected by merge join with shard's payment plans, within memory budget
+            from SpillJoin import APISpillAccess
+            return APISpillAccess.Load(api, shard)
+        if shard is not None:
+            api = APIShardAccess(api, shard)
+        if fetch_mode == "single" or fetch_mode == "threads":
+            return api
+        if fetch_mode == "bulk":
+            return APIBulkAccess.Load(api)
+        if fetch_mode == "async":
+            return AsyncAPIAccess.Load(api)
+        if fetch_mode == "batched":
+            return APIBatchedAccess(api)
+        if fetch_mode == "incremental":
+            return APIIncrementalAccess(api, shard)
+        if fetch_mode == "processes":
+            # ProcessShards depends on this module : imported when used
+            from ProcessShards import APIShardedAccess
+            return APIShardedAccess.Load(api)
+        raise Exception(f"Unrecognized fetch mode '{fetch_mode}'. Expected one of {', '.join(cls.FetchModes)}")
+
     # ============= DBAccess methods
     def __init__(self, cfg):
         self.cfg = cfg
-        self.sessionDebts = APIAccess.APISession(cfg, 'Debts')
-        self.sessionPaymentPlans = APIAccess.APISession(cfg, 'PaymentPlans')
-        self.sessionPayments = APIAccess.APISession(cfg, 'Payments')
+        self.cache = ResponseCache(cfg) if ResponseCache.Enabled(cfg) else None
+        # all tables are served by the same host : one connection pool for all sessions
+        self.pool = ConnectionPool(cfg)
+        self.sessionDebts = APIAccess.APISession(cfg, 'Debts', self.cache, self.pool)
+        self.sessionPaymentPlans = APIAccess.APISession(cfg, 'PaymentPlans', self.cache, self.pool)
+        self.sessionPayments = APIAccess.APISession(cfg, 'Payments', self.cache, self.pool)
+
+    def retryStats(self) -> dict:
+        """Retry and circuit breaker counters per table"""
+        return {session.table: session.stats()
+                for session in [self.sessionDebts, self.sessionPaymentPlans, self.sessionPayments]}
+
+    def metrics(self) -> dict:
+        """Request metrics per table : counts, response bytes, decode time, errors by class, latency histogram"""
+        return {session.table: session.metricsSnapshot()
+                for session in [self.sessionDebts, self.sessionPaymentPlans, self.sessionPayments]}
+
+    def writeMetrics(self, stages):
+        """Write request metrics per table and run stage timings (StageTimer), if enabled by Metrics config"""
+        writeMetrics(self.cfg, {'stages': stages.snapshot(), 'tables': self.metrics()})
+
+    def poolStats(self) -> dict:
+        """Connection pool utilization : sessions, requests, connections opened and reused"""
+        return self.pool.stats()
+
+    def cacheStats(self) -> dict:
+        """Response cache hit/miss counters per table, empty if cache is disabled"""
+        return {} if self.cache is None else self.cache.stats()
+
+    def iterTable(self, session, page_size=None, request_params={}):
+        """
+        Generator : iterate over all records in table matching request params, fetched page by page
+        Page size and prefetch of next page are set by config settings Tables.<table>.PageSize and .Prefetch
+        Memory is bounded by one page (two with prefetch). Table which is not paged is iterated as response body is
+        decoded : memory is bounded by a chunk of body, when response streaming is enabled (Decode.Streaming)
+        """
+        table_cfg = self.cfg.get('Tables', {}).get(session.table, {})
+        page_size = page_size if page_size is not None else table_cfg.get('PageSize')
+        # not paged : records are yielded as response body is decoded
+        if not page_size:
+            yield from session.iterRecords(request_params)
+            return
+        for page in session.httpRequestPages(request_params, page_size, table_cfg.get('Prefetch', False)):
+            yield from page
+
+    def iterDebts(self, page_size=None):
+        """Generator : iterate over all debts in Debts table, fetched page by page"""
+        return self.iterTable(self.sessionDebts, page_size)
+
+    def iterPaymentPlans(self, page_size=None):
+        """Generator : iterate over all payment plans in PaymentPlans table, fetched page by page"""
+        return self.iterTable(self.sessionPaymentPlans, page_size)
+
+    def iterPayments(self, page_size=None):
+        """Generator : iterate over all payments in Payments table, fetched page by page"""
+        return self.iterTable(self.sessionPayments, page_size)
+
+    def iterPaymentsSince(self, date, page_size=None):
+        """Generator : iterate over payments dated on or after date ('YYYY-MM-DD'), fetched page by page"""
+        return self.iterTable(self.sessionPayments, page_size, {'date_gte': date})
+
+    def batchChunks(self, session, key, ids):
+        """
+        Generator : split ids into chunks for multi-id requests (key=id1&key=id2&...)
+        Chunk size is limited by config settings Batch.Size and Batch.MaxURLLength
+        """
+        batch_cfg = self.cfg.get('Batch', {})
+        max_size = int(batch_cfg.get('Size', 100))
+        max_url_length = int(batch_cfg.get('MaxURLLength', 2000))
+        base_length = len(self.cfg['URL'][session.table]) + 1
+
+        chunk, url_length = [], base_length
+        for id in ids:
+            param_length = len(f"{key}={id}&")
+            if len(chunk) > 0 and (len(chunk) >= max_size or url_length + param_length > max_url_length):
+                yield chunk
+                chunk, url_length = [], base_length
+            chunk.append(id)
+            url_length += param_length
+        if len(chunk) > 0:
+            yield chunk
+
+    def paymentPlanInfo(self, payment_plan, debt_amount):
+        """Payment plan info is not precomputed for API queries : None, caller computes it from payments"""
+        return None
+
+    def fetchBatch(self, session, key, ids) -> dict:
+        """
+        Fetch records for list of ids with multi-id requests, split in chunks
+        Return records grouped by key : { id : [records] }, every requested id is present
+        """
+        grouped = {id: [] for id in ids}
+        for chunk in self.batchChunks(session, key, ids):
+            for rec in session.httpRequest({key: chunk}):
+                grouped.setdefault(rec.get(key), []).append(rec)
+        return grouped
+
+    def fetchDebtsBatch(self, debt_ids) -> dict:
+        """fetch data from Debts table for list of debt ids : { debt id : [debts] }"""
+        return self.fetchBatch(self.sessionDebts, 'id', debt_ids)
+
+    def fetchPaymentPlansBatch(self, debt_ids) -> dict:
+        """fetch data from PaymentPlans table for list of debt ids : { debt id : [payment plans] }"""
+        return self.fetchBatch(self.sessionPaymentPlans, 'debt_id', debt_ids)
+
+    def fetchPaymentsBatch(self, payment_plan_ids) -> dict:
+        """fetch data from Payments table for list of payment plan ids : { payment plan id : [payments] }"""
+        return self.fetchBatch(self.sessionPayments, 'payment_plan_id', payment_plan_ids)
 
     def fetchDebts(self, debt_id=None) -> list:
         """fetch data from Debts table, throws exception if failed"""
@@ -99,3 +514,508 @@ class APIAccess:
         """fetch data from Debts table, throws exception if failed"""
         parms = {} if payment_plan_id is None else {'payment_plan_id': payment_plan_id}
         return self.sessionPayments.httpRequest(parms)
+
+
+def parallelIter(cfg, func, items):
+    """
+    Generator : apply func to each item in thread pool sized by config setting Threads.MaxWorkers
+    Yield results in order of items, as soon as they are ready; at most 2 * MaxWorkers items are in flight.
+    Exception raised by func is captured as result for that item
+    """
+
+    def capture(item):
+        try:
+            return func(item)
+        except Exception as err:
+            return err
+
+    max_workers = int(cfg.get('Threads', {}).get('MaxWorkers', 8))
+    with ThreadPoolExecutor(max_workers) as executor:
+        in_flight = deque()
+        for item in items:
+            in_flight.append(executor.submit(capture, item))
+            if len(in_flight) >= 2 * max_workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def parallelMap(cfg, func, items) -> list:
+    """
+    Apply func to each item in thread pool sized by config setting Threads.MaxWorkers
+    Return results in order of items. Exception raised by func is captured as result for that item
+    """
+    return list(parallelIter(cfg, func, items))
+
+
+def orderedMap(cfg, func, items, fetch_mode="single"):
+    """
+    Generator : apply func to each item, yielding results in order of items
+    In 'threads' fetch mode, items are processed in thread pool; first error in item order is raised
+    """
+    if fetch_mode == "threads":
+        for rs in parallelIter(cfg, func, items):
+            if isinstance(rs, Exception):
+                raise rs
+            yield rs
+    else:
+        for item in items:
+            yield func(item)
+
+
+def raiseFirstError(results) -> list:
+    """Raise first exception captured by parallelMap, as sequential run would. Return results if none"""
+    for rs in results:
+        if isinstance(rs, Exception):
+            raise rs
+    return results
+
+
+def groupBy(records, key) -> dict:
+    """Hash index : { key value : [records with this key value] }, preserving order of records"""
+    index = {}
+    for rec in records:
+        index.setdefault(rec.get(key), []).append(rec)
+    return index
+
+
+class APIBulkAccess:
+    """
+    In-memory replica of Debts DB, compatible with APIAccess fetch methods
+
+    Each table is fetched from API once, then joined in memory :
+    Debts to PaymentPlans on debt_id, PaymentPlans to Payments on payment_plan_id.
+    Lookups return the same records, in the same order, as parametrized API queries.
+    """
+
+    def __init__(self, cfg, debts, plans, payments):
+        self.cfg = cfg
+        self.debts = debts
+        self.plans = plans
+        self.payments = payments
+        self.debtsById = groupBy(debts, 'id')
+        self.plansByDebtId = groupBy(plans, 'debt_id')
+        self.paymentsByPlanId = groupBy(payments, 'payment_plan_id')
+        self.lock = threading.Lock()
+        self.planInfo = None
+
+    @classmethod
+    def Load(cls, api):
+        """Load all 3 tables from API : 3 requests regardless of number of debts, unless tables are paged"""
+        return cls(api.cfg, list(api.iterDebts()), list(api.iterPaymentPlans()), list(api.iterPayments()))
+
+    def iterDebts(self, page_size=None):
+        return iter(self.debts)
+
+    def fetchDebtsBatch(self, debt_ids) -> dict:
+        return {debt_id: self.debtsById.get(debt_id, []) for debt_id in debt_ids}
+
+    def fetchDebts(self, debt_id=None) -> list:
+        """lookup Debts table, throws XDebtIdNotFound if debt id is not present"""
+        if debt_id is None:
+            return self.debts
+        debts = self.debtsById.get(debt_id, [])
+        if len(debts) == 0: raise APIAccess.XDebtIdNotFound
+        return debts
+
+    def fetchPaymentPlans(self, debt_id=None) -> list:
+        """lookup PaymentPlans table by debt id"""
+        return self.plans if debt_id is None else self.plansByDebtId.get(debt_id, [])
+
+    def fetchPayments(self, payment_plan_id=None) -> list:
+        """lookup Payments table by payment plan id"""
+        return self.payments if payment_plan_id is None else self.paymentsByPlanId.get(payment_plan_id, [])
+
+    def paymentPlanInfo(self, payment_plan, debt_amount):
+        """
+        Remaining amount and next payment due date of payment plan as of APIAccess.Today,
+        computed for all payment plans at once by vectorized engine (VectorizedPayments.py) :
+        { 'remaining_amount': float, 'next_payment_due_date': datetime or None if debt is paid off }
+        None if not available : caller computes it from payment plan and payments
+        """
+        if not PaymentColumns.Available(self.cfg):
+            return None
+        with self.lock:
+            if self.planInfo is None or self.planInfo[0] != APIAccess.Today:
+                self.planInfo = (APIAccess.Today, self.computePaymentPlanInfo())
+            return self.planInfo[1].get(payment_plan['id'])
+
+    def computePaymentPlanInfo(self) -> dict:
+        """
+        { payment plan id : payment plan info }, for payment plans with single debt, valid schedule and valid payments
+        """
+        plan_index, *columns = self.paymentPlanColumns()
+        remaining, next_due, computed = paymentPlanInfoColumns(self.cfg, APIAccess.Today, *columns)
+        next_due = next_due.astype(object)
+        return {pp_id: {'remaining_amount': float(remaining[i]), 'next_payment_due_date': next_due[i]}
+                for pp_id, i in plan_index.items() if computed[i]}
+
+    def paymentPlanColumns(self) -> tuple:
+        """
+        Payment plans with single plan id, as columns by payment plan index : ({ payment plan id : index },
+        debt amounts, start dates, installment frequencies, payment plan index of each payment or -1,
+        payment amounts, payment dates). Debt amount is None unless payment plan has single debt
+        """
+        plans = [pp[0] for pp in groupBy(self.plans, 'id').values() if len(pp) == 1]
+        amounts = []
+        for pp in plans:
+            try:
+                debts = self.debtsById.get(pp.get('debt_id'), [])
+                amounts.append(debts[0].get('amount') if len(debts) == 1 else None)
+            except TypeError:
+                amounts.append(None)
+
+        plan_index = {pp['id']: i for i, pp in enumerate(plans)}
+        payment_plans = np.fromiter(map(plan_index.get, [pmt.get('payment_plan_id') for pmt in self.payments],
+                                        repeat(-1)), np.int64, len(self.payments))
+        return (plan_index, amounts, [pp.get('start_date') for pp in plans],
+                [pp.get('installment_frequency') for pp in plans], payment_plans,
+                [pmt.get('amount') for pmt in self.payments], [pmt.get('date') for pmt in self.payments])
+
+
+class APIBatchedAccess:
+    """
+    APIAccess-compatible access enriching debts in chunks
+
+    Debts are iterated in chunks of Batch.Size debts. For each chunk, payment plans and payments are fetched
+    with multi-id requests and served from memory while debts of the chunk are enriched.
+    Memory is bounded by the chunk; lookups for debts outside of current chunk are delegated to API.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.cfg = api.cfg
+        self.chunk = APIBulkAccess(api.cfg, [], [], [])
+        self.chunkPlanIds = set()
+
+    def iterDebts(self, page_size=None):
+        """Generator : iterate over all debts, loading payment plans and payments for each chunk of debts"""
+        batch_size = int(self.cfg.get('Batch', {}).get('Size', 100))
+        chunk = []
+        for dbt in self.api.iterDebts(page_size):
+            chunk.append(dbt)
+            if len(chunk) == batch_size:
+                yield from self.loadChunk(chunk)
+                chunk = []
+        yield from self.loadChunk(chunk)
+
+    def loadChunk(self, debts) -> list:
+        """Fetch payment plans and payments for chunk of debts : 2 requests per chunk, unless URL is too long"""
+        plans_by_debt_id = self.api.fetchPaymentPlansBatch([dbt['id'] for dbt in debts])
+        plans = [pp for dbt_plans in plans_by_debt_id.values() for pp in dbt_plans]
+
+        # multiple payment plans are reported as corrupt data by enrichment
+        plan_ids = [dbt_plans[0]['id'] for dbt_plans in plans_by_debt_id.values() if len(dbt_plans) == 1]
+        payments_by_plan_id = self.api.fetchPaymentsBatch(plan_ids)
+        payments = [pmt for plan_payments in payments_by_plan_id.values() for pmt in plan_payments]
+
+        self.chunk = APIBulkAccess(self.cfg, debts, plans, payments)
+        self.chunkPlanIds = set(plan_ids)
+        return debts
+
+    def fetchDebts(self, debt_id=None) -> list:
+        return self.api.fetchDebts(debt_id)
+
+    def fetchDebtsBatch(self, debt_ids) -> dict:
+        return self.api.fetchDebtsBatch(debt_ids)
+
+    def fetchPaymentPlans(self, debt_id=None) -> list:
+        if debt_id is None or debt_id not in self.chunk.debtsById:
+            return self.api.fetchPaymentPlans(debt_id)
+        return self.chunk.fetchPaymentPlans(debt_id)
+
+    def fetchPayments(self, payment_plan_id=None) -> list:
+        if payment_plan_id is None or payment_plan_id not in self.chunkPlanIds:
+            return self.api.fetchPayments(payment_plan_id)
+        return self.chunk.fetchPayments(payment_plan_id)
+
+    def paymentPlanInfo(self, payment_plan, debt_amount):
+        if payment_plan['id'] not in self.chunkPlanIds:
+            return None
+        return self.chunk.paymentPlanInfo(payment_plan, debt_amount)
+
+
+class APIIncrementalAccess:
+    """
+    APIAccess-compatible access used by 'incremental' fetch mode
+
+    Remaining amount of each payment plan is persisted between runs (IncrementalState.py), as of run date and time.
+    Next run fetches only payments dated since earliest persisted state, in one paged query, and applies payments
+    made since state was computed. Payment plans are loaded once per run, in one paged query, and payment plan is
+    recomputed from all its payments when payment plan or debt amount changes (persisted signature), or it has no
+    state yet : run with no changes takes one query per table. Payments are expected to be added with date not
+    earlier than the last run.
+    State is saved when iteration over debts is complete, with states of payment plans not seen in this run pruned.
+    Shard runs keep separate state files. Payments are fetched outside of lock : threads compute plans concurrently
+    """
+
+    def __init__(self, api, shard=None):
+        self.api = api
+        self.cfg = api.cfg
+        self.state = IncrementalState(api.cfg, shard)
+        self.seen = set()
+        self.parser = DateParser.Instance(api.cfg)
+        self.lock = threading.Lock()
+        # loads of payment plans and delta payments, once per run
+        self.loadLock = threading.Lock()
+        self.plansByDebtId = None
+        self.delta = None
+        self.counters = {'recomputed': 0, 'incremental': 0, 'delta_payments': 0}
+
+    def iterDebts(self, page_size=None):
+        """Generator : iterate over all debts, saving state of payment plans seen when iteration is complete"""
+        yield from self.api.iterDebts(page_size)
+        with self.lock:
+            self.state.prune(self.seen)
+        self.save()
+
+    def save(self):
+        self.state.save()
+
+    def incrementalStats(self) -> dict:
+        """Payment plans recomputed from all payments, updated with new payments, and number of new payments"""
+        with self.lock:
+            return dict(self.counters)
+
+    def fetchDebts(self, debt_id=None) -> list:
+        return self.api.fetchDebts(debt_id)
+
+    def fetchDebtsBatch(self, debt_ids) -> dict:
+        return self.api.fetchDebtsBatch(debt_ids)
+
+    def fetchPaymentPlans(self, debt_id=None) -> list:
+        """lookup payment plans by debt id, loaded once per run"""
+        if debt_id is None:
+            return self.api.fetchPaymentPlans()
+        return self.paymentPlans().get(debt_id, [])
+
+    def fetchPayments(self, payment_plan_id=None) -> list:
+        return self.api.fetchPayments(payment_plan_id)
+
+    def paymentPlans(self) -> dict:
+        """Payment plans of all debts, fetched once per run, page by page : { debt id : [payment plans] }"""
+        with self.loadLock:
+            if self.plansByDebtId is None:
+                self.plansByDebtId = groupBy(self.api.iterPaymentPlans(), 'debt_id')
+            return self.plansByDebtId
+
+    def paymentsSince(self) -> dict:
+        """Payments dated since earliest persisted state, fetched once per run : { payment plan id : [payments] }"""
+        with self.loadLock:
+            if self.delta is None or self.delta[0] != APIAccess.Today:
+                with self.lock:
+                    watermark = self.state.watermark()
+                payments = [] if watermark is None else list(self.api.iterPaymentsSince(watermark[:10]))
+                with self.lock:
+                    self.counters['delta_payments'] = len(payments)
+                self.delta = (APIAccess.Today, groupBy(payments, 'payment_plan_id'))
+            return self.delta[1]
+
+    def paymentPlanInfo(self, payment_plan, debt_amount):
+        """
+        Remaining amount and next payment due date of payment plan as of APIAccess.Today, updated from persisted state
+        { 'remaining_amount': float, 'next_payment_due_date': datetime or None if debt is paid off }
+        None if payment plan or its payments are invalid : caller computes it from payments and reports the error
+        """
+        today = APIAccess.Today
+        ppid = payment_plan['id']
+        signature = IncrementalState.signature(payment_plan, debt_amount)
+        with self.lock:
+            self.seen.add(ppid)
+            state = self.state.get(ppid)
+        # payments are fetched without lock
+        try:
+            next_payment_due_date = self.nextPaymentDueDate(payment_plan, today)
+            if state is not None and state['signature'] == signature \
+                    and datetime.datetime.fromisoformat(state['as_of']) <= today:
+                remaining_amount, has_payments = self.applyPayments(ppid, state, today)
+                counter = 'incremental'
+            else:
+                remaining_amount, has_payments = self.recompute(ppid, debt_amount, today)
+                counter = 'recomputed'
+        except Exception:
+            with self.lock:
+                self.state.drop(ppid)
+            return None
+
+        with self.lock:
+            self.counters[counter] += 1
+            self.state.put(ppid, {'signature': signature, 'as_of': today.isoformat(),
+                                  'remaining': remaining_amount, 'has_payments': has_payments})
+
+        # debt with payments made is paid off : no next payment due
+        if has_payments and remaining_amount == 0:
+            next_payment_due_date = None
+        return {'remaining_amount': remaining_amount, 'next_payment_due_date': next_payment_due_date}
+
+    def recompute(self, payment_plan_id, debt_amount, today) -> tuple:
+        """Remaining amount from all payments of payment plan : (remaining amount, has payments)"""
+        payments = self.api.fetchPayments(payment_plan_id)
+        dates = [self.parser.parse(pmt['date']) for pmt in payments]
+        remaining_amount = float(debt_amount)
+        for pmt, date in zip(payments, dates):
+            if date < today:
+                remaining_amount -= float(pmt['amount'])
+        return remaining_amount, len(payments) > 0
+
+    def applyPayments(self, payment_plan_id, state, today) -> tuple:
+        """Remaining amount from persisted state and payments made since : (remaining amount, has payments)"""
+        as_of = datetime.datetime.fromisoformat(state['as_of'])
+        payments = self.paymentsSince().get(payment_plan_id, [])
+        remaining_amount = state['remaining']
+        for pmt in payments:
+            if as_of <= self.parser.parse(pmt['date']) < today:
+                remaining_amount -= float(pmt['amount'])
+        return remaining_amount, state['has_payments'] or len(payments) > 0
+
+    def nextPaymentDueDate(self, payment_plan, today) -> datetime.datetime:
+        """First date in payment schedule after or including today"""
+        start_date = self.parser.parse(payment_plan['start_date'])
+        period = self.cfg["Tables"]["PaymentPlans"]["FrequencyToDays"][payment_plan['installment_frequency']]
+        elapsed_days = (today - start_date).days
+        return start_date + datetime.timedelta(-(-elapsed_days // period) * period)
+
+
+class DebtIdScanner:
+    """
+    Discovers debt ids in Debts table, without loading the whole table
+
+    Upper bound of debt ids is found by exponential probing followed by binary search.
+    Each probe checks a window of IdScan.MaxGap ids with multi-id requests, so gaps in id sequence
+    shorter than MaxGap do not stop the scan. Discovered id range is then fetched in chunks of Batch.Size ids,
+    several chunks at a time in thread pool.
+    """
+
+    def __init__(self, api, shard=None):
+        """:param shard : ShardSpec, only debts of shard are fetched (optional)"""
+        self.api = api
+        self.cfg = api.cfg
+        self.shard = shard
+        self.max_gap = max(1, int(self.cfg.get('IdScan', {}).get('MaxGap', 100)))
+        self.bound = None
+
+    def probe(self, start):
+        """Highest debt id found in window [start, start + MaxGap), None if there is no debt in window"""
+        window = list(range(start, start + self.max_gap))
+        found = self.api.fetchDebtsBatch(window)
+        ids = [debt_id for debt_id in window if len(found.get(debt_id, [])) > 0]
+        return max(ids) if len(ids) > 0 else None
+
+    def upperBound(self) -> int:
+        """Exclusive upper bound of debt ids : highest debt id + 1, 0 if there are no debts"""
+        if self.bound is not None:
+            return self.bound
+
+        lo = self.probe(0)
+        if lo is None:
+            self.bound = 0
+            return self.bound
+
+        # -- exponential probing : lo is highest debt id found, window at hi has no debts
+        hi = lo + 1
+        while True:
+            found = self.probe(hi)
+            if found is None:
+                break
+            lo = found
+            hi = max(2 * hi, lo + 1)
+
+        # -- binary search between highest debt id found and empty window
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            found = self.probe(mid)
+            if found is None:
+                hi = mid
+            else:
+                lo = found
+
+        self.bound = lo + 1
+        return self.bound
+
+    def fetchChunk(self, debt_ids) -> list:
+        """Fetch debts for chunk of ids, in id order"""
+        found = self.api.fetchDebtsBatch(debt_ids)
+        debts = []
+        for debt_id in debt_ids:
+            if len(found[debt_id]) > 1:
+                raise Exception(f"Corrupt debt data for debt_id '{debt_id}' : multiple records")
+            debts.extend(found[debt_id])
+        return debts
+
+    def iterDebts(self):
+        """Generator : iterate over all debts in discovered id range, in id order"""
+        bound = self.upperBound()
+        chunk_size = int(self.cfg.get('Batch', {}).get('Size', 100))
+        chunks = (list(range(start, min(start + chunk_size, bound))) for start in range(0, bound, chunk_size))
+        if self.shard is not None:
+            chunks = ([debt_id for debt_id in chunk if self.shard.contains(debt_id)] for chunk in chunks)
+        for debts in orderedMap(self.cfg, self.fetchChunk, chunks, "threads"):
+            yield from debts
+
+
+class AsyncAPIAccess:
+    """
+    Asynchronous twin of APIAccess
+
+    Fetch coroutines run APIAccess requests in a thread pool, so retries and error responses
+    are handled exactly as in synchronous requests.
+    Number of requests in flight is limited by config setting Async.MaxConcurrency
+    """
+
+    def __init__(self, api, executor):
+        self.api = api
+        self.cfg = api.cfg
+        self.executor = executor
+        self.semaphore = asyncio.Semaphore(AsyncAPIAccess.maxConcurrency(api.cfg))
+
+    @staticmethod
+    def maxConcurrency(cfg) -> int:
+        return int(cfg.get('Async', {}).get('MaxConcurrency', 8))
+
+    async def request(self, fetch, key) -> list:
+        """Run blocking fetch method in thread pool, waiting for free slot if too many requests are in flight"""
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fetch, key)
+
+    async def fetchDebts(self, debt_id=None) -> list:
+        return await self.request(self.api.fetchDebts, debt_id)
+
+    async def fetchPaymentPlans(self, debt_id=None) -> list:
+        return await self.request(self.api.fetchPaymentPlans, debt_id)
+
+    async def fetchPayments(self, payment_plan_id=None) -> list:
+        return await self.request(self.api.fetchPayments, payment_plan_id)
+
+    async def fetchDebtData(self, debt_id) -> tuple:
+        """Fetch payment plans and payments for debt id : (plans, payments)"""
+        plans = await self.fetchPaymentPlans(debt_id)
+        # multiple payment plans are reported as corrupt data by enrichment
+        payments = await self.fetchPayments(plans[0]['id']) if len(plans) == 1 else []
+        return plans, payments
+
+    async def loadAsync(self) -> 'APIBulkAccess':
+        debts = await self.fetchDebts()
+        # debt id repeated in Debts table is fetched once : its payment plans are not loaded twice
+        debt_ids = list(dict.fromkeys(dbt['id'] for dbt in debts))
+        results = await asyncio.gather(*[self.fetchDebtData(debt_id) for debt_id in debt_ids], return_exceptions=True)
+
+        # report first error in debt id order, as sequential run would
+        raiseFirstError(results)
+
+        plans = [pp for dbt_plans, _ in results for pp in dbt_plans]
+        payments = [pmt for _, dbt_payments in results for pmt in dbt_payments]
+        return APIBulkAccess(self.cfg, debts, plans, payments)
+
+    @classmethod
+    def Load(cls, api) -> 'APIBulkAccess':
+        """
+        Load all debts, then payment plans and payments for all debts concurrently
+        Return in-memory replica of loaded data, ordered by debt
+        """
+
+        async def load():
+            # semaphore must be created within running event loop
+            return await cls(api, executor).loadAsync()
+
+        with ThreadPoolExecutor(cls.maxConcurrency(api.cfg)) as executor:
+            return asyncio.run(load())
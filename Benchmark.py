@@ -0,0 +1,440 @@
+import io
+import re
+import sys
+import json
+import time
+import datetime
+import tracemalloc
+import contextlib
+import multiprocessing
+import responses
+from urllib.parse import urlsplit, parse_qs
+from APIAccess import APIAccess, APIBulkAccess
+from MockServer import MockServer, syntheticTables
+from SyntheticData import PortfolioGenerator, loadTables
+from DateParser import DateParser
+from VectorizedPayments import PaymentColumns, PaymentSchedule, np
+from DebtFunctional import runDebtFunctional, enrichDebts, addPaymentPlanExtraInfo
+from DebtObjectOriented import runDebtObjectOriented_LoadIds, runDebtObjectOriented_GenerateIds, \
+    DebtRecordExtra, DebtTable
+
+
+# ###################################### MOCK API ########################################################
+
+@contextlib.contextmanager
+def mockAPI(cfg, tables, latency):
+    """
+    Mock Debts DB API serving tables (debts, payment plans, payments)
+    Every request takes 'latency' seconds, mimicking network round trip
+    """
+
+    def table_callback(data, key):
+        def callback(request):
+            time.sleep(latency)
+            params = parse_qs(urlsplit(request.url).query)
+            rs = data if key not in params else [rec for rec in data if str(rec[key]) in params[key]]
+            return 200, {}, json.dumps(rs)
+
+        return callback
+
+    debts, plans, payments = tables
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+        for table, data, key in [('Debts', debts, 'id'),
+                                 ('PaymentPlans', plans, 'debt_id'),
+                                 ('Payments', payments, 'payment_plan_id')]:
+            rsps.add_callback(responses.GET, re.compile(re.escape(cfg['URL'][table]) + r"(\?.*)?$"),
+                              callback=table_callback(data, key), content_type="application/json")
+        yield rsps
+
+
+def timeRun(run) -> tuple:
+    """Run with stdout captured. Return (seconds elapsed, output)"""
+    out = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        run()
+    return time.perf_counter() - start, out.getvalue()
+
+
+# ###################################### BENCHMARKS ######################################################
+
+def benchParallelLoad(cfg, ndebts=200, latency=0.01):
+    """
+    Compare sequential and thread pool construction of DebtRecordExtra over mock API with given latency
+    Print wall time of both runs and speedup
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    with mockAPI(cfg, syntheticTables(ndebts), latency):
+        tseq, out_seq = timeRun(lambda: runDebtObjectOriented_LoadIds(cfg, 2, True, "single"))
+        tpar, out_par = timeRun(lambda: runDebtObjectOriented_LoadIds(cfg, 2, True, "threads"))
+
+    if out_seq != out_par:
+        raise Exception("Parallel load output differs from sequential load output")
+
+    workers = cfg.get('Threads', {}).get('MaxWorkers', 8)
+    print(f"Parallel load : {ndebts} debts, latency {latency * 1000:.0f}ms, {workers} workers")
+    print(f"  sequential : {tseq:8.3f}s")
+    print(f"  threads    : {tpar:8.3f}s")
+    print(f"  speedup    : {tseq / tpar:8.2f}x")
+
+
+def benchDateParsing(cfg, nrows=1000000, ndates=730):
+    """
+    Compare strptime loop over date formats with DateParser over payment dates
+    nrows payment dates cycle through ndates distinct days, as payment dates repeat heavily
+    Print throughput of both parsers
+    """
+    start = datetime.datetime(2020, 1, 1)
+    distinct = [(start + datetime.timedelta(days)).strftime('%Y-%m-%d') for days in range(ndates)]
+    dates = [distinct[i % ndates] for i in range(nrows)]
+    formats = cfg.get('DateFormats', DateParser.DefaultFormats)
+
+    def strptime_loop(sdate):
+        for fmt in formats:
+            try:
+                return datetime.datetime.strptime(sdate, fmt)
+            except ValueError:
+                continue
+
+    parser = DateParser(formats, int(cfg.get('DateParser', {}).get('CacheSize', 4096)))
+    tloop, _ = timeRun(lambda: [strptime_loop(sdate) for sdate in dates])
+    tuncached, _ = timeRun(lambda: [parser.parseUncached(sdate) for sdate in dates])
+    tparser, _ = timeRun(lambda: [parser.parse(sdate) for sdate in dates])
+
+    print(f"Date parsing : {nrows} payment dates, {ndates} distinct")
+    print(f"  strptime loop : {tloop:8.3f}s {nrows / tloop:12,.0f} rows/s")
+    print(f"  ISO fast path : {tuncached:8.3f}s {nrows / tuncached:12,.0f} rows/s")
+    print(f"  memoized      : {tparser:8.3f}s {nrows / tparser:12,.0f} rows/s")
+    print(f"  speedup       : {tloop / tparser:8.2f}x")
+
+
+def benchVectorizedPlanInfo(cfg, npayments=5000000, nplans=100000):
+    """
+    Compare per-debt calculation of remaining amount and next payment due date with vectorized engine
+    computing them for all payment plans at once. Print wall time of both and verify results are identical
+    """
+    if not PaymentColumns.Available(cfg):
+        print("Vectorized plan info : numpy is not installed or Vectorized.Enabled is false, skipped")
+        return
+
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    start = datetime.datetime(2020, 1, 1)
+    dates = [(start + datetime.timedelta(days)).strftime('%Y-%m-%d') for days in range(730)]
+    debts = [{"amount": 100000.0 + i, "id": i} for i in range(nplans)]
+    plans = [{"debt_id": i, "id": i, "installment_frequency": ["WEEKLY", "BI_WEEKLY"][i % 2],
+              "start_date": dates[i % len(dates)]} for i in range(nplans)]
+    payments = [{"amount": 10.25 + i % 7, "date": dates[i % len(dates)], "payment_plan_id": i % nplans}
+                for i in range(npayments)]
+
+    per_debt = APIBulkAccess(dict(cfg, Vectorized={"Enabled": False}), debts, plans, payments)
+    bulk = APIBulkAccess(cfg, debts, plans, payments)
+    results = {}
+    tloop, _ = timeRun(lambda: results.update(per_debt=enrichDebts(per_debt, addPaymentPlanExtraInfo, debts)))
+    tvec, _ = timeRun(lambda: results.update(vectorized=enrichDebts(bulk, addPaymentPlanExtraInfo, debts)))
+    if results['per_debt'] != results['vectorized']:
+        raise Exception("Vectorized payment plan info differs from per-debt calculation")
+
+    columns = PaymentColumns(cfg, payments, {i: i for i in range(nplans)})
+    schedule = PaymentSchedule(cfg, plans)
+    amounts = np.array([float(dbt['amount']) for dbt in debts])
+    tgroup, _ = timeRun(lambda: (columns.remainingAmounts(amounts, APIAccess.Today),
+                                 schedule.nextPaymentDueDates(APIAccess.Today)))
+
+    print(f"Payment plan info : {npayments} payments, {nplans} payment plans")
+    print(f"  per debt   : {tloop:8.3f}s")
+    print(f"  vectorized : {tvec:8.3f}s, of which {tgroup:.3f}s over loaded columns")
+    print(f"  speedup    : {tloop / tvec:8.2f}x")
+
+
+def allocatedBytes(build) -> int:
+    """Memory allocated by objects returned by build, which are kept alive while measured"""
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        kept = build()
+        allocated, _ = tracemalloc.get_traced_memory()
+        del kept
+        return allocated - start
+    finally:
+        tracemalloc.stop()
+
+
+def benchRecordMemory(cfg, ndebts=1000000):
+    """
+    Compare memory per debt of extended debt info kept as merged dicts (functional), records with __dict__,
+    __slots__ records, and DebtTable column store
+    """
+
+    class DictRecord:
+        """Record with per-instance __dict__, as DebtRecordExtra before __slots__"""
+
+        def __init__(self, debt_id, amount, in_payment_plan, remaining_amount, next_payment_due_date):
+            self.id, self.amount, self.in_payment_plan, self.payment_plan = debt_id, amount, in_payment_plan, None
+            self.remaining_amount, self.next_payment_due_date = remaining_amount, next_payment_due_date
+
+    # values are shared with rows : object representations are charged for containers only, DebtTable for values
+    start = datetime.datetime(2021, 1, 1)
+    rows = [(i, 100.0 + i, i % 2 == 0, 50.0 + i if i % 2 == 0 else None,
+             start + datetime.timedelta(i % 365) if i % 2 == 0 else None) for i in range(ndebts)]
+
+    builds = [
+        ("merged dicts", lambda: [{'amount': amount, 'id': i, 'in_payment_plan': flag, 'remaining_amount': remaining,
+                                   'next_payment_due_date': due} for i, amount, flag, remaining, due in rows]),
+        ("__dict__ records", lambda: [DictRecord(*row) for row in rows]),
+        ("__slots__ records", lambda: [DebtRecordExtra.FromValues(*row) for row in rows]),
+        ("DebtTable", lambda: DebtTable(DebtRecordExtra).extend(DebtRecordExtra.FromValues(*row) for row in rows)),
+    ]
+
+    print(f"Record memory : {ndebts} debts with extended info")
+    for name, build in builds:
+        print(f"  {name:<18}: {allocatedBytes(build) / ndebts:8.1f} bytes per debt")
+
+
+def peakRSS() -> int:
+    """Peak resident set size of this process in bytes, None if not available on this platform"""
+    # Linux : high water mark of this process image; ru_maxrss of spawned child includes parent's peak
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+Runners = {
+    'functional': runDebtFunctional,
+    'oop_load': runDebtObjectOriented_LoadIds,
+    'oop_generate': runDebtObjectOriented_GenerateIds,
+}
+
+
+def runInChild(conn, cfg, runner, fetch_mode):
+    """Child process : run solution with output captured, send back (seconds elapsed, peak RSS, error line)"""
+    seconds, out = timeRun(lambda: Runners[runner](cfg, 3, False, fetch_mode))
+    errors = [line for line in out.splitlines() if line.startswith("***ERROR***")]
+    conn.send((seconds, peakRSS(), errors[0] if errors else None))
+    conn.close()
+
+
+def benchRunModes(cfg, ndebts=500, latency=0.002, jitter=0.001, error_rate=0.0):
+    """
+    Time every solution in every fetch mode accepted by APIAccess.Open against local mock API server with injected
+    latency. Server data is synthetic portfolio of ndebts debts (SyntheticData.py), or tables loaded from
+    Synthetic.Path directory when this config setting is set
+    Each run is made in fresh process, so that peak RSS is measured per run. Incremental state, SQLite mirror and
+    spill files are written to temporary directory of each run : incremental and sqlite runs start without state
+    or mirror, and load them from API
+    Print requests served, wall time and peak RSS per run
+    """
+    import tempfile
+
+    data_path = cfg.get('Synthetic', {}).get('Path')
+    tables = loadTables(data_path) if data_path else PortfolioGenerator(cfg, ndebts).tables()
+    ndebts = len(tables[0])
+
+    context = multiprocessing.get_context('spawn')
+    with MockServer(tables, latency, jitter, error_rate, seed=1) as server:
+        cfg = server.config(cfg)
+        print(f"Run modes : {ndebts} debts, latency {latency * 1000:.1f}ms + jitter {jitter * 1000:.1f}ms, "
+              f"error rate {error_rate:.1%}")
+        print(f"  {'solution':<13} {'fetch mode':<11} {'requests':>9} {'errors':>7} {'time, s':>9} {'peak RSS, MB':>13}")
+        for runner in Runners:
+            for fetch_mode in APIAccess.FetchModes:
+                server.resetStats()
+                with tempfile.TemporaryDirectory() as run_dir:
+                    run_cfg = dict(cfg, Incremental={"Path": f"{run_dir}/state.json"},
+                                   Mirror={"Path": f"{run_dir}/mirror.sqlite"},
+                                   Spill=dict(cfg.get('Spill', {}), Directory=run_dir))
+                    parent_conn, child_conn = context.Pipe()
+                    child = context.Process(target=runInChild, args=(child_conn, run_cfg, runner, fetch_mode))
+                    child.start()
+                    seconds, rss, error = parent_conn.recv()
+                    child.join()
+
+                stats = server.stats()
+                srss = "n/a" if rss is None else f"{rss / 2 ** 20:.1f}"
+                print(f"  {runner:<13} {fetch_mode:<11} {stats['requests']:>9} {stats['errors']:>7} "
+                      f"{seconds:>9.3f} {srss:>13}" + ("" if error is None else f"  {error}"))
+
+
+def benchProcessShards(cfg, ndebts=200000):
+    """
+    Compare enrichment of synthetic portfolio in bulk fetch mode, payment plan info computed by vectorized engine,
+    with payment plan info computed by vectorized engine in process pool ('processes' fetch mode).
+    Print wall time of both and verify results are identical
+    """
+    import os
+    from ProcessShards import APIShardedAccess
+
+    if not PaymentColumns.Available(cfg):
+        print("Process shards : numpy is not installed or Vectorized.Enabled is false, skipped")
+        return
+
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    debts, plans, payments = PortfolioGenerator(cfg, ndebts).tables()
+
+    results = {}
+    tbulk, _ = timeRun(lambda: results.update(
+        bulk=enrichDebts(APIBulkAccess(cfg, debts, plans, payments), addPaymentPlanExtraInfo, debts)))
+    tproc, _ = timeRun(lambda: results.update(
+        processes=enrichDebts(APIShardedAccess(cfg, debts, plans, payments), addPaymentPlanExtraInfo, debts)))
+    if results['bulk'] != results['processes']:
+        raise Exception("Sharded payment plan info differs from bulk calculation")
+
+    workers = int(cfg.get('Processes', {}).get('MaxWorkers', 0)) or os.cpu_count()
+    print(f"Process shards : {ndebts} debts, {len(payments)} payments, {workers} workers")
+    print(f"  bulk      : {tbulk:8.3f}s")
+    print(f"  processes : {tproc:8.3f}s")
+    print(f"  speedup   : {tbulk / tproc:8.2f}x")
+
+
+def fetchInChild(conn, cfg):
+    """Child process : fetch whole Payments table, send back (seconds elapsed, peak RSS growth, decode throughput)"""
+    api = APIAccess(cfg)
+    rss = peakRSS()
+    start = time.perf_counter()
+    api.fetchPayments()
+    seconds = time.perf_counter() - start
+    growth = None if rss is None else peakRSS() - rss
+    conn.send((seconds, growth, api.metrics()['Payments']['decode_bytes_per_second']))
+    conn.close()
+
+
+def benchStreamDecode(cfg, npayments=1000000):
+    """
+    Fetch whole Payments table in one response from local mock API server : body read whole and decoded at once
+    vs decoded as it streams, by json and orjson decoders. Each fetch is made in fresh process
+    Print wall time, decode throughput and peak RSS growth : decoded records, plus transient response body
+    and decoder memory
+    """
+    from JsonStream import orjson
+
+    payments = [{"amount": 25.5, "date": "2020-08-01", "payment_plan_id": i // 10} for i in range(npayments)]
+    context = multiprocessing.get_context('spawn')
+    with MockServer(([], [], payments)) as server:
+        cfg = dict(server.config(cfg), Cache={"Enabled": False})
+        print(f"Stream decode : {npayments} payments, orjson {'installed' if orjson is not None else 'not installed'}")
+        print(f"  {'body':<8} {'decoder':<8} {'time, s':>9} {'decode, MB/s':>13} {'peak RSS growth, MB':>20}")
+        for streaming in [False, True]:
+            for backend in ["json", "orjson"]:
+                parent_conn, child_conn = context.Pipe()
+                child = context.Process(target=fetchInChild, args=(
+                    child_conn, dict(cfg, Decode={"Streaming": streaming, "Backend": backend})))
+                child.start()
+                seconds, growth, throughput = parent_conn.recv()
+                child.join()
+                sgrowth = "n/a" if growth is None else f"{growth / 2 ** 20:.1f}"
+                print(f"  {'streamed' if streaming else 'whole':<8} {backend:<8} {seconds:>9.3f} "
+                      f"{throughput / 2 ** 20:>13.1f} {sgrowth:>20}")
+
+
+def benchSQLiteMirror(cfg, ndebts=20000, latency=0.002):
+    """
+    Sync local SQLite mirror of synthetic portfolio from local mock API server with injected latency, then compare
+    payment plan and payments lookups by id in mirror and over API, and time remaining amounts of all payment plans
+    by single GROUP BY query. Print sync time, microseconds per lookup and GROUP BY time
+    """
+    import tempfile
+    from SQLiteMirror import SQLiteMirror
+
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    tables = PortfolioGenerator(cfg, ndebts).tables()
+    debt_ids = [dbt['id'] for dbt in tables[0]]
+    plan_ids = [pp['id'] for pp in tables[1]]
+
+    with tempfile.TemporaryDirectory() as mirror_dir, MockServer(tables, latency) as server:
+        mirror_cfg = dict(server.config(cfg), Mirror={"Path": f"{mirror_dir}/mirror.sqlite"}, Cache={"Enabled": False})
+        api = APIAccess(mirror_cfg)
+        tsync, _ = timeRun(lambda: SQLiteMirror(mirror_cfg).sync(api))
+        mirror = SQLiteMirror.Open(api)
+
+        napi = 100
+        tapi, _ = timeRun(lambda: [(api.fetchPaymentPlans(debt_id), api.fetchPayments(ppid))
+                                   for debt_id, ppid in zip(debt_ids[:napi], plan_ids[:napi])])
+        tmirror, _ = timeRun(lambda: [(mirror.fetchPaymentPlans(debt_id), mirror.fetchPayments(ppid))
+                                      for debt_id, ppid in zip(debt_ids, plan_ids)])
+        tgroup, _ = timeRun(mirror.remainingAmounts)
+
+    print(f"SQLite mirror : {ndebts} debts, {len(tables[2])} payments, API latency {latency * 1000:.1f}ms")
+    print(f"  sync                  : {tsync:8.3f}s")
+    print(f"  API lookup            : {tapi / (2 * napi) * 1e6:8.1f}us")
+    print(f"  mirror lookup         : {tmirror / (2 * len(plan_ids)) * 1e6:8.1f}us")
+    print(f"  remaining amounts     : {tgroup:8.3f}s, GROUP BY over all payments")
+
+
+def joinInChild(conn, cfg, fetch_mode):
+    """Child process : run functional solution with JSON lines output discarded, send back (seconds elapsed, peak RSS)"""
+    import os
+    with open(os.devnull, 'w') as out:
+        start = time.perf_counter()
+        runDebtFunctional(cfg, 3, False, fetch_mode, "jsonl", None, out)
+        seconds = time.perf_counter() - start
+    conn.send((seconds, peakRSS()))
+    conn.close()
+
+
+def benchSpillJoin(cfg, ndebts=50000, budget=4 * 2 ** 20):
+    """
+    Enrich synthetic portfolio from local mock API server with paged tables, joined in memory (bulk fetch mode)
+    vs out of core within memory budget (spill fetch mode). Each run is made in fresh process, with JSON lines
+    output discarded. Print wall time and peak RSS of both
+    """
+    tables = PortfolioGenerator(cfg, ndebts).tables()
+    context = multiprocessing.get_context('spawn')
+    with MockServer(tables) as server:
+        paged = {table: dict(cfg.get('Tables', {}).get(table, {}), PageSize=1000, Prefetch=False)
+                 for table in ['Debts', 'PaymentPlans', 'Payments']}
+        cfg = dict(server.config(cfg), Tables=paged, Cache={"Enabled": False}, Metrics={"Enabled": False},
+                   Spill={"MemoryBudget": budget})
+        print(f"Spill join : {ndebts} debts, {len(tables[2])} payments, memory budget {budget / 2 ** 20:.1f}MB")
+        print(f"  {'fetch mode':<10} {'time, s':>9} {'peak RSS, MB':>13}")
+        for fetch_mode in ["bulk", "spill"]:
+            parent_conn, child_conn = context.Pipe()
+            child = context.Process(target=joinInChild, args=(child_conn, cfg, fetch_mode))
+            child.start()
+            seconds, rss = parent_conn.recv()
+            child.join()
+            srss = "n/a" if rss is None else f"{rss / 2 ** 20:.1f}"
+            print(f"  {fetch_mode:<10} {seconds:>9.3f} {srss:>13}")
+
+
+Benchmarks = {
+    'parallel_load': benchParallelLoad,
+    'date_parsing': benchDateParsing,
+    'vectorized_plan_info': benchVectorizedPlanInfo,
+    'record_memory': benchRecordMemory,
+    'run_modes': benchRunModes,
+    'process_shards': benchProcessShards,
+    'stream_decode': benchStreamDecode,
+    'sqlite_mirror': benchSQLiteMirror,
+    'spill_join': benchSpillJoin,
+}
+
+# ###################################### MAIN ############################################################
+
+if __name__ == '__main__':
+    """
+    Program arguments:
+    :argument1 : path to config file or '-'. Optional. Defaults to "debt_config"
+    :argument2.. : names of benchmarks to run. Optional. Defaults to all benchmarks
+    """
+
+    cfg_path = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] != '-' else "debt_config"
+    try:
+        with open(cfg_path) as cfg_file:
+            config = json.load(cfg_file)
+    except Exception as err:
+        raise SystemExit(f"Cannot open config file : {err}")
+
+    names = sys.argv[2:] if len(sys.argv) > 2 else list(Benchmarks)
+    for name in names:
+        if name not in Benchmarks:
+            raise SystemExit(f"Unknown benchmark '{name}'. Expected one of {', '.join(Benchmarks)}")
+        Benchmarks[name](config)
@@ -0,0 +1,69 @@
+import time
+import threading
+
+
+class CircuitBreaker:
+    """
+    Per-table circuit breaker, failing requests fast while upstream API keeps failing
+
+    closed    : requests pass through. After CircuitBreaker.FailureThreshold consecutive failures, breaker opens
+    open      : requests fail fast without reaching API, until CircuitBreaker.CoolDown seconds elapse
+    half-open : a single probe request passes through. Success closes breaker, failure opens it again;
+                probe released with neither lets next request probe
+
+    FailureThreshold 0 disables breaker
+    """
+
+    def __init__(self, cfg, clock=time.monotonic):
+        breaker_cfg = cfg.get('CircuitBreaker', {})
+        self.threshold = int(breaker_cfg.get('FailureThreshold', 5))
+        self.cool_down = float(breaker_cfg.get('CoolDown', 30))
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.opens = 0
+        # thread of probe request in half-open state, None if no probe is in flight
+        self.probe = None
+
+    def allowRequest(self) -> bool:
+        """True if request may be sent to API. In half-open state, only one probe request is allowed"""
+        if self.threshold <= 0:
+            return True
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and self.clock() - self.opened_at >= self.cool_down:
+                self.state = 'half-open'
+            if self.state == 'half-open' and self.probe is None:
+                self.probe = threading.get_ident()
+                return True
+            return False
+
+    def releaseProbe(self):
+        """End of request : probe of this thread, if any, ended without success or failure is no longer in flight"""
+        with self.lock:
+            if self.probe == threading.get_ident():
+                self.probe = None
+
+    def recordSuccess(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probe = None
+
+    def recordFailure(self):
+        if self.threshold <= 0:
+            return
+        with self.lock:
+            self.failures += 1
+            self.probe = None
+            if self.state == 'half-open' or (self.state == 'closed' and self.failures >= self.threshold):
+                self.state = 'open'
+                self.opened_at = self.clock()
+                self.opens += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'state': self.state, 'opens': self.opens}
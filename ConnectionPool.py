@@ -0,0 +1,72 @@
+import socket
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter with optional TCP keep-alive on pooled connections"""
+
+    def __init__(self, keep_alive=True, **kwargs):
+        # set before HTTPAdapter.__init__, which creates pool manager
+        self.keep_alive = keep_alive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        if self.keep_alive:
+            pool_kwargs['socket_options'] = HTTPConnection.default_socket_options + \
+                                            [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+
+
+class ConnectionPool:
+    """
+    HTTP transport shared by all API sessions : one HTTPAdapter, hence one pool of connections per host,
+    is mounted on every requests.Session, so connections opened by one session or thread are reused by others
+
+    Config settings (all optional) :
+        Pool.Connections : number of per-host pools to keep, defaults to 4
+        Pool.MaxSize     : max connections kept open per host, defaults to 16
+        Pool.Block       : true to wait for free connection when MaxSize connections are in use, defaults to false
+        Pool.KeepAlive   : true to enable TCP keep-alive on pooled connections, defaults to true
+        Pool.Retries     : transport-level retries of failed connects, defaults to 0
+                           (connection errors are retried by APISession with backoff)
+    """
+
+    def __init__(self, cfg):
+        pool_cfg = cfg.get('Pool', {})
+        self.adapter = KeepAliveAdapter(keep_alive=bool(pool_cfg.get('KeepAlive', True)),
+                                        pool_connections=int(pool_cfg.get('Connections', 4)),
+                                        pool_maxsize=int(pool_cfg.get('MaxSize', 16)),
+                                        pool_block=bool(pool_cfg.get('Block', False)),
+                                        max_retries=Retry(total=int(pool_cfg.get('Retries', 0)), read=0,
+                                                          redirect=None, status=0, raise_on_status=False))
+        self.lock = threading.Lock()
+        self.sessions = 0
+
+    def newSession(self) -> requests.Session:
+        """New requests.Session over shared pool"""
+        session = requests.Session()
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        with self.lock:
+            self.sessions += 1
+        return session
+
+    def stats(self) -> dict:
+        """
+        Pool utilization : { 'sessions': sessions created, 'requests': requests sent,
+                             'connections_opened': new connections, 'connections_reused': requests over warm connection }
+        """
+        pools = self.adapter.poolmanager.pools
+        host_pools = [pool for pool in map(pools.get, pools.keys()) if pool is not None]
+        requests_sent = sum(pool.num_requests for pool in host_pools)
+        opened = sum(pool.num_connections for pool in host_pools)
+        with self.lock:
+            sessions = self.sessions
+        return {'sessions': sessions,
+                'requests': requests_sent,
+                'connections_opened': opened,
+                'connections_reused': max(requests_sent - opened, 0)}
@@ -0,0 +1,79 @@
+import re
+from datetime import datetime
+from functools import lru_cache
+
+
+class DateParser:
+    """
+    Date parser for payment and payment plan dates, shared by Functional and OOP implementations
+
+    Tries formats from DateFormats config setting in order.
+    ISO 8601 formats '%Y-%m-%d' and '%Y-%m-%dT%H:%M:%SZ' are parsed by fast path, without strptime.
+    Parsed dates are memoized by raw string : payment dates repeat heavily.
+
+    Config settings (all optional) :
+        DateFormats          : list of date formats, defaults to ISO 8601 '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d'
+        DateParser.CacheSize : max number of memoized dates, defaults to 4096
+    """
+
+    DefaultFormats = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d']
+
+    # matched with fullmatch : trailing newline is rejected, as strptime rejects it
+    ISODate = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+    ISODateTime = re.compile(r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})Z")
+
+    # ============= DateParser instances : one per formats and cache size
+    _instances = {}
+
+    @classmethod
+    def Instance(cls, cfg):
+        key = (tuple(cfg.get('DateFormats', cls.DefaultFormats)),
+               int(cfg.get('DateParser', {}).get('CacheSize', 4096)))
+        if key not in cls._instances:
+            cls._instances[key] = DateParser(*key)
+        return cls._instances[key]
+
+    def __init__(self, formats=DefaultFormats, cache_size=4096):
+        self.formats = list(formats)
+
+        # fast path for each format, in order of formats; None means strptime
+        fast_paths = {'%Y-%m-%d': DateParser.ISODate, '%Y-%m-%dT%H:%M:%SZ': DateParser.ISODateTime}
+        self.parsers = [(fmt, fast_paths.get(fmt)) for fmt in self.formats]
+
+        # errors are not memoized : lru_cache does not cache raised exceptions
+        self.parseCached = lru_cache(maxsize=cache_size)(self.parseUncached)
+
+    def parseUncached(self, sdate) -> datetime:
+        """Parse date trying all formats, None if no format matches"""
+        # fast path : leading ISO formats, up to first format without fast path
+        for fmt, fast_path in self.parsers:
+            if fast_path is None:
+                break
+            match = fast_path.fullmatch(sdate)
+            if match is not None:
+                try:
+                    return datetime(*map(int, match.groups()))
+                # out of range date, e.g. 2020-02-30 : let strptime decide
+                except ValueError:
+                    break
+
+        for fmt, _ in self.parsers:
+            try:
+                return datetime.strptime(sdate, fmt)
+            except ValueError:
+                continue
+        return None
+
+    def parse(self, sdate, err_hdr="") -> datetime:
+        """Parse date, raising exception if date value is invalid or no format matches"""
+        if not isinstance(sdate, str):
+            raise Exception(f"{err_hdr} : invalid date value : '{sdate}'")
+        date = self.parseCached(sdate)
+        if date is None:
+            raise Exception(f"{err_hdr} : unrecognized date format '{sdate}'")
+        return date
+
+    def stats(self) -> dict:
+        """Memo cache counters : hits, misses, size"""
+        info = self.parseCached.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
@@ -1,14 +1,20 @@
 import sys
 import json
+import contextlib
 from datetime import datetime, timedelta
 from functools import reduce
-from APIAccess import APIAccess
+from APIAccess import APIAccess, orderedMap, raiseFirstError
+from JsonLines import writeJsonLines
+from DateParser import DateParser
+from Metrics import StageTimer
+from Hooks import hooked, Profiler
+from Sharding import ShardSpec
 
 
-def addInPaymentPlanFlag(api, debt_data) -> dict:
+def fetchDebtPaymentPlans(api, debt_data) -> list:
     """
-    Calculate in-payment-plan flag
-    Return enriched debt : {'in_payment_plan': True|False}
+    Verify debt amount and fetch payment plans for debt
+    Return list of payment plans : empty or single plan
     """
     debt_id = debt_data['id']
 
@@ -21,28 +27,28 @@ def addInPaymentPlanFlag(api, debt_data) -> dict:
 
     plans = api.fetchPaymentPlans(debt_id)
     if len(plans) > 1: raise Exception(f"Corrupt payment plan data for debt_id '{debt_id}' : multiple records")
+    return plans
+
+
+def addInPaymentPlanFlag(api, debt_data) -> dict:
+    """
+    Calculate in-payment-plan flag
+    Return enriched debt : {'in_payment_plan': True|False}
+    """
+    plans = fetchDebtPaymentPlans(api, debt_data)
     return {'in_payment_plan': len(plans) > 0}
 
 
-def addPaymentPlanExtraInfo(api, debt_data) -> dict:
+@hooked('addPaymentPlanExtraInfo')
+def addPaymentPlanExtraInfo(api, debt_data, plans=None) -> dict:
     """
     Calculate in-payment-plan, remaining-amount, next-payment-due-date
     Returns enriched data { 'in_payment_plan':True|False, 'remaining_amount':float, 'next_payment_due_date':datetime}
+    :param plans : payment plans for debt, if already fetched (optional)
     """
 
-    def parse_date(sdate, err_hdr="") -> datetime:
-        """Try all formats from config (ISO 8061 '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d' etc) """
-        date_formats = api.cfg['DateFormats']
-        for fmt in ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d']:
-            try:
-                return datetime.strptime(sdate, fmt)
-            except ValueError:
-                continue
-            # other errors, e.g date is None
-            except Exception as err:
-                raise Exception(f"{err_hdr} : invalid date value : '{sdate}'")
-
-        raise Exception(f"{err_hdr} : unrecognized date format '{sdate}'")
+    # formats from DateFormats config setting, parsed dates are memoized
+    parse_date = DateParser.Instance(api.cfg).parse
 
     def payment_amount(pmt):
         """ Verify that payment has valid amount and return amount as float"""
@@ -60,16 +66,9 @@ def addPaymentPlanExtraInfo(api, debt_data) -> dict:
             raise Exception(f"Invalid payment date : amount={pmt['amount']}, "
                             f"payment_plan_id={pmt['payment_plan_id']}, date={pmt['date']}")
 
-    debt_id = debt_data['id']
-    # verify debt amount
-    try:
-        debt_data.update({'amount': float(debt_data['amount'])})
-    except Exception:
-        raise Exception(f"Invalid debt amount : id={debt_id} amount={debt_data['amount']}")
-
-    # fetch payment plan
-    plans = api.fetchPaymentPlans(debt_id)
-    if len(plans) > 1: raise Exception(f"Corrupt payment plan data for debt_id '{debt_id}' : multiple records")
+    # verify debt amount and fetch payment plan
+    if plans is None:
+        plans = fetchDebtPaymentPlans(api, debt_data)
 
     # --- debt has no payment plan
     if len(plans) == 0:
@@ -82,6 +81,15 @@ def addPaymentPlanExtraInfo(api, debt_data) -> dict:
     pp = plans[0]
     ppid = pp['id']
 
+    # remaining amount and next payment due date precomputed for all payment plans by vectorized engine
+    # in bulk fetch modes
+    plan_info = api.paymentPlanInfo(pp, debt_data['amount'])
+    if plan_info is not None:
+        return {'in_payment_plan': True,
+                'remaining_amount': plan_info['remaining_amount'],
+                'next_payment_due_date': plan_info['next_payment_due_date']
+                }
+
     # payment plan start date
     pp_start_date = parse_date(pp['start_date'], f"Start date for payment plan id '{ppid}'")
 
@@ -125,7 +133,43 @@ def addPaymentPlanExtraInfo(api, debt_data) -> dict:
             }
 
 
-def runDebtFunctional(cfg, basic1extra2both3=3, test_run=False):
+def addPaymentPlanInfo(api, debt_data) -> tuple:
+    """
+    Calculate in-payment-plan flag and extra info in single pass : payment plans are fetched once per debt
+    Return (debt enriched with in-payment-plan flag,
+            debt enriched with extra info or exception raised while calculating extra info)
+    Error in extra info is returned rather than raised, so that list of debts with flag can still be output
+    """
+    plans = fetchDebtPaymentPlans(api, debt_data)
+    info = dict(debt_data, in_payment_plan=len(plans) > 0)
+    try:
+        extra_info = dict(debt_data, **addPaymentPlanExtraInfo(api, debt_data, plans))
+    except Exception as err:
+        extra_info = err
+    return info, extra_info
+
+
+def streamDebts(api, enrich, debts, fetch_mode="single"):
+    """
+    Generator : merge each debt with data calculated by enrich function, yielding enriched debts in order of debts
+    :param enrich : addInPaymentPlanFlag or addPaymentPlanExtraInfo
+    :param debts  : iterable of debts
+    """
+
+    def enrichDebt(dbt):
+        # debt is copied after enrich is called : enrich updates debt amount to float
+        return dict(dbt, **enrich(api, dbt))
+
+    return orderedMap(api.cfg, enrichDebt, debts, fetch_mode)
+
+
+def enrichDebts(api, enrich, debts, fetch_mode="single") -> list:
+    """Merge each debt with data calculated by enrich function : addInPaymentPlanFlag or addPaymentPlanExtraInfo"""
+    return list(streamDebts(api, enrich, debts, fetch_mode))
+
+
+def runDebtFunctional(cfg, basic1extra2both3=3, test_run=False, fetch_mode="single", output_format="table",
+                      shard=None, out=None) -> bool:
     """
     :param cfg : config dictionary
     :param basic1extra2both3
@@ -135,17 +179,59 @@ def runDebtFunctional(cfg, basic1extra2both3=3, test_run=False):
     :param test_run
         True  : print lists of dictionaries (for testing purposes)
         False : print lists as tables with headers
+    :param fetch_mode
+        single  : query payment plans and payments per debt
+        bulk    : load all tables at once and join them in memory
+        async   : query payment plans and payments for many debts concurrently
+        threads : query payment plans and payments per debt, enriching many debts in thread pool
+        batched : query payment plans and payments for chunks of debts with multi-id requests
+        incremental : load payment plans at once, and query only payments made since last run
+        processes : load all tables at once, compute payment plan info in process pool
+        sqlite  : query local SQLite mirror of all tables, synced from API if missing or older than Mirror.MaxAge
+        spill   : load all tables page by page and join them out of core, within Spill.MemoryBudget
+    :param output_format
+        table : print lists as tables with headers, or lists of dictionaries in test run
+        jsonl : stream debts to stdout as they are enriched, one JSON object per line.
+                Extended info (2 or 3) includes basic info, so each debt is output once
+    :param shard : ShardSpec (Sharding.py), restricts run to debts of shard. Optional
+    :param out   : text stream for JSON lines output, defaults to stdout
+    Return True if run completed, False if error was reported
     """
+    stages = StageTimer()
     try:
-        api = APIAccess.Instance(cfg)
-        debts = api.fetchDebts()
+        stages.begin('fetch')
+        api = APIAccess.Open(cfg, fetch_mode, shard)
+        # debts are consumed lazily, page by page when Debts table is paged : pages are timed as fetch stage
+        debts = stages.timed('fetch', api.iterDebts())
+        debts_info, debts_extra_info = None, None
 
-        # ==== Debt info with In-Payment-Plan flag
-        if basic1extra2both3 == 1 or basic1extra2both3 == 3:
+        # ==== JSON lines : debts source -> enrichment -> serializer, one debt at a time
+        if output_format == "jsonl":
+            enrich = addInPaymentPlanFlag if basic1extra2both3 == 1 else addPaymentPlanExtraInfo
+            stages.begin('output')
+            writeJsonLines(stages.timed('enrich', streamDebts(api, enrich, debts, fetch_mode)), out)
+            return True
+
+        stages.begin('enrich')
 
+        # ==== Debt info with In-Payment-Plan flag
+        if basic1extra2both3 == 1:
             # add 'in_pmt_plan' flag to each debt in list
-            debts_info = [dict(**dbt, **addInPaymentPlanFlag(api, dbt)) for dbt in debts]
+            debts_info = enrichDebts(api, addInPaymentPlanFlag, debts, fetch_mode)
 
+        # ==== Debt info with In-Payment-Plan flag, Remaining-Amount and Next-Payment-Due-Date
+        if basic1extra2both3 == 2:
+            # add 'in_pmt_plan', 'remaining_amount' and 'next_payment_due_date' to each debt in list
+            debts_extra_info = enrichDebts(api, addPaymentPlanExtraInfo, debts, fetch_mode)
+
+        # ==== Both : single pass over debts, both lists are derived from the same payment plans
+        if basic1extra2both3 == 3:
+            debts_both_info = list(orderedMap(cfg, lambda dbt: addPaymentPlanInfo(api, dbt), debts, fetch_mode))
+            debts_info = [info for info, _ in debts_both_info]
+            debts_extra_info = [extra_info for _, extra_info in debts_both_info]
+
+        stages.begin('output')
+        if debts_info is not None:
             if test_run:
                 print(debts_info)
             else:
@@ -153,11 +239,9 @@ def runDebtFunctional(cfg, basic1extra2both3=3, test_run=False):
                 for dbt in debts_info:
                     print(f"{dbt['id']:<4} {dbt['amount']:<10.2f} {'yes' if dbt['in_payment_plan'] else 'no'}")
 
-        # ==== Debt info with In-Payment-Plan flag, Remaining-Amount and Next-Payment-Due-Date
-        if basic1extra2both3 == 2 or basic1extra2both3 == 3:
-
-            # add 'in_pmt_plan', 'remaining_amount' and 'next_payment_due_date' to each debt in list
-            debts_extra_info = [dict(**dbt, **addPaymentPlanExtraInfo(api, dbt)) for dbt in debts]
+        if debts_extra_info is not None:
+            # extra info error is reported after debt info is output, as if debts were processed in 2 passes
+            raiseFirstError(debts_extra_info)
 
             if test_run:
                 print(debts_extra_info)
@@ -169,22 +253,69 @@ def runDebtFunctional(cfg, basic1extra2both3=3, test_run=False):
                           (f"{'N/A':<16}  " if dbt[
                                                    'remaining_amount'] is None else f"{dbt['remaining_amount']:<16.2f}  ") + \
                           ("N/A" if dbt['next_payment_due_date'] is None else f"{dbt['next_payment_due_date']}"))
+        return True
 
     except Exception as err:
         print(f"***ERROR*** {err}")
+        return False
+    finally:
+        stages.end()
+        APIAccess.WriteRunMetrics(cfg, stages)
 
 
 # ###################################### MAIN ############################################################
 
 if __name__ == '__main__':
+    # -- profile flag, anywhere in arguments : write cProfile dump and per-stage allocation report (Profiler)
+    profile = '--profile' in sys.argv
+    if profile:
+        sys.argv.remove('--profile')
+
+    # -- metrics flag, anywhere in arguments : write request metrics and stage timings, as with Metrics.Enabled
+    metrics = '--metrics' in sys.argv
+    if metrics:
+        sys.argv.remove('--metrics')
+
+    # -- shard, anywhere in arguments : '--shard i/n' restricts run to debts of shard i of n,
+    # debts with extended info are written as JSON lines to partition file (ShardSpec, Sharding.py)
+    shard_arg = ShardSpec.PopArg(sys.argv)
+
     # -- read config : 1st arg
     cfg_path = sys.argv[1] if (len(sys.argv) > 1) else "debt_config"
 
+    # -- fetch mode : 2nd arg
+    # 'single'  : query payment plans and payments per debt
+    # 'bulk'    : load all tables at once and join them in memory
+    # 'async'   : query payment plans and payments for many debts concurrently
+    # 'threads' : query payment plans and payments per debt, enriching many debts in thread pool
+    # 'batched' : query payment plans and payments for chunks of debts with multi-id requests
+    # 'incremental' : load payment plans at once, and query only payments made since last run
+    # 'processes' : load all tables at once, compute payment plan info in process pool
+    # 'sqlite'  : query local SQLite mirror of all tables, synced from API if missing (SQLiteMirror.py)
+    # 'spill'   : load all tables page by page and join them out of core, within memory budget (SpillJoin.py)
+    fetch_mode = sys.argv[2] if (len(sys.argv) > 2) else "single"
+
+    # -- output format : 3rd arg
+    # 'table' : print both debt lists as tables
+    # 'jsonl' : print debts with extended info, one JSON object per line
+    output_format = sys.argv[3] if (len(sys.argv) > 3) else "table"
+
     try:
         with open(cfg_path) as cfg_file:
             cfg = json.load(cfg_file)
     except Exception as err:
         raise SystemExit(f"Cannot open config file : {err}")
+    if metrics:
+        cfg['Metrics'] = dict(cfg.get('Metrics', {}), Enabled=True)
 
-    # print both debt lists as tables
-    runDebtFunctional(cfg, 3, False)  # True)
+    try:
+        shard = None if shard_arg is None else ShardSpec.Parse(shard_arg, cfg)
+    except Exception as err:
+        raise SystemExit(f"{err}")
+
+    # print both debt lists as tables, or debts as JSON lines
+    with Profiler(cfg) if profile else contextlib.nullcontext():
+        if shard is None:
+            runDebtFunctional(cfg, 3, False, fetch_mode, output_format)  # True)
+        elif not shard.writePartition(lambda out: runDebtFunctional(cfg, 3, False, fetch_mode, "jsonl", shard, out)):
+            raise SystemExit(f"Shard {shard} failed : partition {shard.partitionPath()} is not written")
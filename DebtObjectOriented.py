@@ -1,9 +1,16 @@
 import sys
 import requests
 import json
+import contextlib
+from array import array
 from datetime import datetime, timedelta
 from functools import reduce
-from APIAccess import APIAccess
+from APIAccess import APIAccess, DebtIdScanner, orderedMap
+from JsonLines import writeJsonLines
+from DateParser import DateParser
+from Metrics import StageTimer
+from Hooks import hooked, Profiler
+from Sharding import ShardSpec
 
 
 # ###################################### CLASSES #########################################################
@@ -11,13 +18,17 @@ from APIAccess import APIAccess
 class DebtRecord:
     """ Encapsulates basic debt info : debt-id, debt-amount, in-payment-plan flag"""
 
-    def __init__(self, api, debt_id, amount=None):
+    # no per-instance __dict__ : records are kept for every debt
+    __slots__ = ('id', 'amount', 'in_payment_plan', 'payment_plan')
+
+    def __init__(self, api, debt_id, amount=None, plans=None):
         """
         Init with debt id and optional amount.
         Load remaining data form API
         :param api: instance of APIAccess
         :param debt_id : debt id
         :param amount  : debt amount (optional)
+        :param plans   : payment plans for debt, if already fetched (optional)
         When amount is not provided, it is loaded from API.
         That allows to load debt info, one at a time, for generated debt ids
         If debt id is not found, marker exception APIAccess.XDebtIdNotFound is raised,
@@ -26,7 +37,15 @@ class DebtRecord:
         self.id = debt_id
         self.amount = self.verifyDebtAmount(amount if amount is not None else self.fetchDebtAmount(api))
         self.in_payment_plan = None
-        self.load(api)
+        self.payment_plan = None
+        self.load(api, plans)
+
+    @classmethod
+    def FromValues(cls, debt_id, amount, in_payment_plan):
+        """Record with given debt info, without loading data from API (used by DebtTable)"""
+        rec = cls.__new__(cls)
+        rec.id, rec.amount, rec.in_payment_plan, rec.payment_plan = debt_id, amount, in_payment_plan, None
+        return rec
 
     def __str__(self):
         # mimic enriched data from functional implementation for uniform testing
@@ -35,6 +54,10 @@ class DebtRecord:
     def __repr__(self):
         return self.__str__()
 
+    def asDict(self) -> dict:
+        """Debt info as dictionary, as in enriched data from functional implementation"""
+        return {'amount': self.amount, 'id': self.id, 'in_payment_plan': self.in_payment_plan}
+
     def verifyDebtAmount(self, amount) -> float:
         try:
             return float(amount)
@@ -47,15 +70,19 @@ class DebtRecord:
         if len(rs) > 1: raise Exception(f"Corrupt debt data for debt_id '{self.id}' : multiple records")
         return rs[0]['amount']
 
-    def load(self, api):
+    @hooked('DebtRecord.load')
+    def load(self, api, plans=None):
         """ Load basic debt data"""
+        self.loadPaymentPlan(api, plans)
 
-        # load payment plan data
-        rs = api.fetchPaymentPlans(self.id)
+    def loadPaymentPlan(self, api, plans=None):
+        """ Load payment plan data, unless already fetched : set in_payment_plan and payment_plan"""
+        rs = api.fetchPaymentPlans(self.id) if plans is None else plans
         if len(rs) > 1: raise Exception(f"Corrupt payment plan data for debt_id '{self.id}' : multiple records")
 
         # *** in_payment_plan
         self.in_payment_plan = len(rs) > 0
+        self.payment_plan = rs[0] if self.in_payment_plan else None
 
     # ============= DebtRecord : display
     @classmethod
@@ -72,13 +99,16 @@ class DebtRecord:
 
 class DebtRecordExtra(DebtRecord):
 
-    def __init__(self, api, debt_id, amount=None):
+    __slots__ = ('remaining_amount', 'next_payment_due_date')
+
+    def __init__(self, api, debt_id, amount=None, plans=None):
         """
         Init with debt id and optional amount.
         Load remaining data form API
         :param api:     instance of APIAccess
         :param debt_id: debt id
         :param amount:  debt amount (optional)
+        :param plans:   payment plans for debt, if already fetched (optional)
         When amount is not provided, it is loaded from API.
         That allows to load debt info, one at a time, for generated debt ids
         If debt id is not found, marker exception APIAccess.XDebtIdNotFound is raised,
@@ -89,7 +119,14 @@ class DebtRecordExtra(DebtRecord):
 
         # super will call 'load' override for this class
         # load will initialize remaining_amount and next_payment_due_date
-        super(DebtRecordExtra, self).__init__(api, debt_id, amount)
+        super(DebtRecordExtra, self).__init__(api, debt_id, amount, plans)
+
+    @classmethod
+    def FromValues(cls, debt_id, amount, in_payment_plan, remaining_amount=None, next_payment_due_date=None):
+        """Record with given extended debt info, without loading data from API (used by DebtTable)"""
+        rec = super(DebtRecordExtra, cls).FromValues(debt_id, amount, in_payment_plan)
+        rec.remaining_amount, rec.next_payment_due_date = remaining_amount, next_payment_due_date
+        return rec
 
     def __str__(self):
         # mimic enriched data from functional implementation for uniform testing
@@ -100,23 +137,18 @@ class DebtRecordExtra(DebtRecord):
     def __repr__(self):
         return self.__str__()
 
+    def asDict(self) -> dict:
+        return dict(super(DebtRecordExtra, self).asDict(),
+                    remaining_amount=self.remaining_amount,
+                    next_payment_due_date=self.next_payment_due_date)
+
     # ============= DebtRecordExtra : load
-    def load(self, api):
+    @hooked('DebtRecordExtra.load')
+    def load(self, api, plans=None):
         """ Override of DebtRecord::load : Load extended debt info"""
 
-        def parse_date(sdate, err_hdr="") -> datetime:
-            """parse date : try all formats from config (ISO 8061 '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d' etc) """
-            date_formats = api.cfg['DateFormats']
-            for fmt in ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d']:
-                try:
-                    return datetime.strptime(sdate, fmt)
-                except ValueError:
-                    continue
-                # other errors, e.g date is None
-                except Exception as err:
-                    raise Exception(f"{err_hdr} : invalid date value : '{sdate}'")
-
-            raise Exception(f"{err_hdr} : unrecognized date format '{sdate}'")
+        # formats from DateFormats config setting, parsed dates are memoized
+        parse_date = DateParser.Instance(api.cfg).parse
 
         def payment_amount(pmt) -> float:
             """ Verify that payment data has valid amount and return amount as a float"""
@@ -135,11 +167,12 @@ class DebtRecordExtra(DebtRecord):
                                 f"payment_plan_id={pmt['payment_plan_id']}, date={pmt['date']}")
 
         # load payment plan data
-        rs = api.fetchPaymentPlans(self.id)
-        if len(rs) > 1: raise Exception(f"Corrupt payment plan data for debt_id '{self.id}' : multiple records")
-
         # *** in_payment_plan
-        self.in_payment_plan = len(rs) > 0
+        self.loadPaymentPlan(api, plans)
+
+        # remaining amount and next payment due date, precomputed for all payment plans in bulk fetch modes :
+        # computed once per debt
+        plan_info = api.paymentPlanInfo(self.payment_plan, self.amount) if self.in_payment_plan else None
 
         # -- has payment plan, calculate from payments
         # remaining_amount  : principal
@@ -147,11 +180,19 @@ class DebtRecordExtra(DebtRecord):
         if not self.in_payment_plan:
             self.remaining_amount = self.amount
 
+        # -- has payment plan, precomputed for all payment plans by vectorized engine in bulk fetch modes
+        elif plan_info is not None:
+            self.remaining_amount = plan_info['remaining_amount']
+            self.next_payment_due_date = plan_info['next_payment_due_date']
+            # debt with no payments made is paid off too, if its amount is 0
+            if self.remaining_amount == 0:
+                self.next_payment_due_date = None
+
         # -- has payment plan, calculate from payments
         # remaining_amount
         # next payment date
         else:
-            pp = rs[0]
+            pp = self.payment_plan
             ppid = pp['id']
 
             # payment plan start date
@@ -202,9 +243,151 @@ class DebtRecordExtra(DebtRecord):
                    ("N/A" if self.next_payment_due_date is None else f"{self.next_payment_due_date}")
 
 
+class DebtTable:
+    """
+    Compact column store of debt records : ids, amounts, flags, remaining amounts, next payment due dates
+    are kept in arrays, rather than as one object per debt.
+    Rows are returned as DebtRecord or DebtRecordExtra, displayed the same way as loaded records.
+    First exception appended in place of record is kept as error, rather than stored.
+    """
+
+    # flags column bits
+    InPaymentPlan, HasRemainingAmount, HasNextPaymentDueDate = 1, 2, 4
+
+    Microsecond = timedelta(microseconds=1)
+
+    def __init__(self, record_class=DebtRecord):
+        self.record_class = record_class
+        self.extra = issubclass(record_class, DebtRecordExtra)
+        self.ids = array('q')
+        self.amounts = array('d')
+        self.flags = bytearray()
+        # extended info columns : next payment due date as microseconds since datetime.min
+        self.remaining = array('d')
+        self.due = array('q')
+        self.error = None
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __repr__(self):
+        # same as list of records
+        return "[" + ", ".join(str(rec) for rec in self) + "]"
+
+    def append(self, rec):
+        """Append DebtRecord or DebtRecordExtra, or exception raised while loading record"""
+        if isinstance(rec, Exception):
+            self.error = rec if self.error is None else self.error
+            return
+
+        # ids other than 64-bit integers are kept in list
+        if type(self.ids) is array and (type(rec.id) is not int or not -2 ** 63 <= rec.id < 2 ** 63):
+            self.ids = list(self.ids)
+        self.ids.append(rec.id)
+        self.amounts.append(rec.amount)
+        flags = DebtTable.InPaymentPlan if rec.in_payment_plan else 0
+
+        if self.extra:
+            if rec.remaining_amount is not None:
+                flags |= DebtTable.HasRemainingAmount
+            if rec.next_payment_due_date is not None:
+                flags |= DebtTable.HasNextPaymentDueDate
+            self.remaining.append(rec.remaining_amount if rec.remaining_amount is not None else 0.0)
+            self.due.append(0 if rec.next_payment_due_date is None
+                            else (rec.next_payment_due_date - datetime.min) // DebtTable.Microsecond)
+        self.flags.append(flags)
+
+    def extend(self, records):
+        for rec in records:
+            self.append(rec)
+        return self
+
+    def __getitem__(self, i):
+        flags = self.flags[i]
+        if not self.extra:
+            return self.record_class.FromValues(self.ids[i], self.amounts[i], bool(flags & DebtTable.InPaymentPlan))
+        return self.record_class.FromValues(
+            self.ids[i], self.amounts[i], bool(flags & DebtTable.InPaymentPlan),
+            self.remaining[i] if flags & DebtTable.HasRemainingAmount else None,
+            datetime.min + self.due[i] * DebtTable.Microsecond if flags & DebtTable.HasNextPaymentDueDate else None)
+
+
 # ###################################### RUN UTILITIES ###################################################
 
-def runDebtObjectOriented_LoadIds(cfg, basic1extra2both3=3, test_run=False):
+def loadDebtRecords(api, record_class, debts, fetch_mode="single") -> DebtTable:
+    """
+    Construct DebtRecord or DebtRecordExtra for each debt loaded from Debts table, stored in DebtTable
+    In 'threads' fetch mode, records are constructed in thread pool sized by config setting Threads.MaxWorkers.
+    Errors are captured per record; first error in debt order is raised
+    """
+    return DebtTable(record_class).extend(streamDebtRecords(api, record_class, debts, fetch_mode))
+
+
+def streamDebtRecords(api, record_class, debts, fetch_mode="single"):
+    """
+    Generator : construct DebtRecord or DebtRecordExtra for each debt, yielding records in order of debts
+    :param debts : iterable of debts loaded from Debts table
+    """
+
+    def loadRecord(dbt):
+        return record_class(api, dbt['id'], dbt['amount'])
+
+    return orderedMap(api.cfg, loadRecord, debts, fetch_mode)
+
+
+def generateDebtRecords(api, record_class, scanner=None):
+    """
+    Generator : construct DebtRecord or DebtRecordExtra for debt ids discovered by DebtIdScanner, in id order
+    Gaps in id sequence shorter than IdScan.MaxGap config setting are skipped
+    :param scanner : DebtIdScanner, reused to discover id range once for several passes (optional)
+    """
+    scanner = DebtIdScanner(api) if scanner is None else scanner
+    for dbt in scanner.iterDebts():
+        yield record_class(api, dbt['id'], dbt['amount'])
+
+
+def loadDebtRecordPair(api, dbt) -> tuple:
+    """
+    Construct DebtRecord and DebtRecordExtra for debt : payment plan is fetched once
+    Return (DebtRecord, DebtRecordExtra or exception raised while loading extended info)
+    """
+    basic = DebtRecord(api, dbt['id'], dbt['amount'])
+    try:
+        plans = [] if basic.payment_plan is None else [basic.payment_plan]
+        extra = DebtRecordExtra(api, basic.id, basic.amount, plans)
+    except Exception as err:
+        extra = err
+    return basic, extra
+
+
+def generateDebtRecordPairs(api, scanner=None):
+    """
+    Generator : (DebtRecord, DebtRecordExtra or exception) for debt ids discovered by DebtIdScanner, in id order
+    Each debt id is probed and its payment plan fetched once for both records
+    """
+    scanner = DebtIdScanner(api) if scanner is None else scanner
+    for dbt in scanner.iterDebts():
+        yield loadDebtRecordPair(api, dbt)
+
+
+def loadDebtRecordPairs(api, debts, fetch_mode="single") -> tuple:
+    """
+    Construct DebtRecord and DebtRecordExtra for each debt in single pass : payment plan is fetched once per debt
+    Return (DebtTable of DebtRecord, DebtTable of DebtRecordExtra)
+    Error in extended info is kept by DebtTable rather than raised, so that basic records can still be output
+    """
+    debts_basic, debts_extra = DebtTable(DebtRecord), DebtTable(DebtRecordExtra)
+    for basic, extra in orderedMap(api.cfg, lambda dbt: loadDebtRecordPair(api, dbt), debts, fetch_mode):
+        debts_basic.append(basic)
+        debts_extra.append(extra)
+    return debts_basic, debts_extra
+
+
+def runDebtObjectOriented_LoadIds(cfg, basic1extra2both3=3, test_run=False, fetch_mode="single",
+                                  output_format="table", shard=None, out=None) -> bool:
     """
     Load all debts in Debts table from API
     Print out list of debt info
@@ -216,40 +399,93 @@ def runDebtObjectOriented_LoadIds(cfg, basic1extra2both3=3, test_run=False):
     :param test_run
         True  : print lists of dictionaries (for testing purposes)
         False : print lists as tables with headers
+    :param fetch_mode
+        single  : query payment plans and payments per debt
+        bulk    : load all tables at once and join them in memory
+        async   : query payment plans and payments for many debts concurrently
+        threads : query payment plans and payments per debt, enriching many debts in thread pool
+        batched : query payment plans and payments for chunks of debts with multi-id requests
+        incremental : load payment plans at once, and query only payments made since last run
+        processes : load all tables at once, compute payment plan info in process pool
+        sqlite  : query local SQLite mirror of all tables, synced from API if missing or older than Mirror.MaxAge
+        spill   : load all tables page by page and join them out of core, within Spill.MemoryBudget
+    :param output_format
+        table : print lists as tables, or lists of records in test run
+        jsonl : stream records to stdout as they are loaded, one JSON object per line.
+                Extended info (2 or 3) includes basic info, so each debt is output once
+    :param shard : ShardSpec (Sharding.py), restricts run to debts of shard. Optional
+    :param out   : text stream for JSON lines output, defaults to stdout
+    Return True if run completed, False if error was reported
     """
+    stages = StageTimer()
     try:
         # load all debts
-        api = APIAccess.Instance(cfg)
-        debts = api.fetchDebts()
+        stages.begin('fetch')
+        api = APIAccess.Open(cfg, fetch_mode, shard)
+        # debts are consumed lazily, page by page when Debts table is paged : pages are timed as fetch stage
+        debts = stages.timed('fetch', api.iterDebts())
+
+        # ==== JSON lines : debts source -> record construction -> serializer, one debt at a time
+        if output_format == "jsonl":
+            record_class = DebtRecord if basic1extra2both3 == 1 else DebtRecordExtra
+            stages.begin('output')
+            writeJsonLines((rec.asDict() for rec in
+                            stages.timed('enrich', streamDebtRecords(api, record_class, debts, fetch_mode))), out)
+            return True
+
+        stages.begin('enrich')
+        debts_basic, debts_extra = None, None
 
         # ==== Debt info with In-Payment-Plan flag
-        if basic1extra2both3 == 1 or basic1extra2both3 == 3:
-            debts_basic = [DebtRecord(api, dbt['id'], dbt['amount']) for dbt in debts]
+        if basic1extra2both3 == 1:
+            debts_basic = loadDebtRecords(api, DebtRecord, debts, fetch_mode)
+
+        # ==== Debt info with In-Payment-Plan flag, Remaining-Amount and Next-Payment-Due-Date
+        if basic1extra2both3 == 2:
+            debts_extra = loadDebtRecords(api, DebtRecordExtra, debts, fetch_mode)
+
+        # ==== Both : single pass over debts, both lists are derived from the same payment plans
+        if basic1extra2both3 == 3:
+            debts_basic, debts_extra = loadDebtRecordPairs(api, debts, fetch_mode)
 
+        stages.begin('output')
+        if debts_basic is not None:
             if test_run:
                 print(debts_basic)
             else:
+                print(DebtRecord.displayHeaders())
                 for dbt in debts_basic:
                     print(dbt.display(False))
 
-        # ==== Debt info with In-Payment-Plan flag, Remaining-Amount and Next-Payment-Due-Date
-        if basic1extra2both3 == 2 or basic1extra2both3 == 3:
-            debts_extra = [DebtRecordExtra(api, dbt['id'], dbt['amount']) for dbt in debts]
+        if debts_extra is not None:
+            # extended info error is reported after basic info is output, as if debts were processed in 2 passes
+            if debts_extra.error is not None:
+                raise debts_extra.error
 
             if test_run:
                 print(debts_extra)
             else:
+                if debts_basic is not None:
+                    print("-" * 80)
+                print(DebtRecordExtra.displayHeaders())
                 for dbt in debts_extra:
                     print(dbt.display(False))
 
+        return True
+
     except Exception as err:
         print(f"***ERROR*** {err}")
+        return False
+    finally:
+        stages.end()
+        APIAccess.WriteRunMetrics(cfg, stages)
 
 
-def runDebtObjectOriented_GenerateIds(cfg, basic1extra2both3=3, test_run=False):
+def runDebtObjectOriented_GenerateIds(cfg, basic1extra2both3=3, test_run=False, fetch_mode="single",
+                                      output_format="table", shard=None, out=None) -> bool:
     """
-        Generate sequential debt ids
-        Load debt info for each id from API
+        Discover debt ids in Debts table by probing id space, tolerating gaps shorter than IdScan.MaxGap
+        Load debts for discovered id range in chunks, then load debt info for each debt from API
         Print out list of debt info
         :param cfg : config dictionary
         :param basic1extra2both3
@@ -259,42 +495,87 @@ def runDebtObjectOriented_GenerateIds(cfg, basic1extra2both3=3, test_run=False):
         :param test_run
             True  : print lists of dictionaries (for testing purposes)
             False : print lists as tables with headers
+        :param fetch_mode
+            single : query debts, payment plans and payments per debt id
+            bulk   : load all tables at once and look up generated ids in memory
+        :param output_format
+            table : print lists as tables, or records in test run
+            jsonl : print records with extended info (2 or 3) or basic info (1), one JSON object per line
+        :param shard : ShardSpec (Sharding.py), only debt ids of shard are fetched. Optional
+        :param out   : text stream for JSON lines output, defaults to stdout
+        Return True if run completed, False if error was reported
         """
+    stages = StageTimer()
     try:
-        api = APIAccess.Instance(cfg)
+        stages.begin('fetch')
+        api = APIAccess.Open(cfg, fetch_mode)
+        # id range is discovered over all debts : scanner fetches only debt ids of shard
+        scanner = DebtIdScanner(api, shard)
+
+        # records are generated while being output : record construction, including debt id scan, is timed
+        # as enrich stage
+        stages.begin('output')
+
+        # ==== JSON lines
+        if output_format == "jsonl":
+            record_class = DebtRecord if basic1extra2both3 == 1 else DebtRecordExtra
+            writeJsonLines((rec.asDict() for rec in
+                            stages.timed('enrich', generateDebtRecords(api, record_class, scanner))), out)
+            return True
+
+        # ==== Both : single pass over debt ids, basic records are output as they are generated, extended records
+        # are buffered in DebtTable up to first error, and output after basic list
+        if basic1extra2both3 == 3:
+            if not test_run:
+                print(DebtRecord.displayHeaders())
+            debts_extra = DebtTable(DebtRecordExtra)
+            # iteration loop
+            for basic, extra in stages.timed('enrich', generateDebtRecordPairs(api, scanner)):
+                print(basic if test_run else basic.display(False))
+                if debts_extra.error is None:
+                    debts_extra.append(extra)
+
+            if not test_run:
+                print("-" * 80)
+                print(DebtRecordExtra.displayHeaders())
+            for dbt in debts_extra:
+                print(dbt if test_run else dbt.display(False))
+            # extended info error is reported after extended records before it, as if debts were processed in 2 passes
+            if debts_extra.error is not None:
+                raise debts_extra.error
+            return True
 
         # ==== Debt info with In-Payment-Plan flag
-        if basic1extra2both3 == 1 or basic1extra2both3 == 3:
+        # records are output as they are generated, keeping memory constant
+        if basic1extra2both3 == 1:
+            if not test_run:
+                print(DebtRecord.displayHeaders())
             # iteration loop
-            try:
-                debt_id = 0
-                while True:
-                    dbt = DebtRecord(api, debt_id)
-                    if test_run:
-                        print(dbt)
-                    else:
-                        print(dbt.display(False))
-                    debt_id += 1
-            except APIAccess.XDebtIdNotFound:
-                pass
+            for dbt in stages.timed('enrich', generateDebtRecords(api, DebtRecord, scanner)):
+                if test_run:
+                    print(dbt)
+                else:
+                    print(dbt.display(False))
 
         # ==== Debt info with In-Payment-Plan flag, Remaining-Amount and Next-Payment-Due-Date
-        if basic1extra2both3 == 2 or basic1extra2both3 == 3:
+        if basic1extra2both3 == 2:
+            if not test_run:
+                print(DebtRecordExtra.displayHeaders())
             # iteration loop
-            try:
-                debt_id = 0
-                while True:
-                    dbt = DebtRecordExtra(api, debt_id)
-                    if test_run:
-                        print(dbt)
-                    else:
-                        print(dbt.display(False))
-                    debt_id += 1
-            except APIAccess.XDebtIdNotFound:
-                pass
+            for dbt in stages.timed('enrich', generateDebtRecords(api, DebtRecordExtra, scanner)):
+                if test_run:
+                    print(dbt)
+                else:
+                    print(dbt.display(False))
+
+        return True
 
     except Exception as err:
         print(f"***ERROR*** {err}")
+        return False
+    finally:
+        stages.end()
+        APIAccess.WriteRunMetrics(cfg, stages)
 
 
 # ###################################### MAIN ############################################################
@@ -309,15 +590,38 @@ if __name__ == '__main__':
     """ 
     Program arguments: 
     value '-' means use default setting
+    --profile  : anywhere in arguments, write cProfile dump and per-stage allocation report (Profiler)
+    --metrics  : anywhere in arguments, write request metrics and stage timings, as with Metrics.Enabled setting
+    --shard i/n : anywhere in arguments, restrict run to debts of shard i of n, 0 <= i < n, and write debts with
+                  extended info as JSON lines to partition file (ShardSpec, Sharding.py)
     :argument1 : path to config file or '-'. Optional. Defaults to "debt_config"
     :argument2 : run mode or '-'. Optional 
          (l)oad      : load all debts from Debts API
-         (g)enerate] : genrate sequential debt ids, and load debts form API one at a time
-    :argument3 : test mode ('test' or none). 
+         (g)enerate] : discover debt ids by probing Debts API, and load debts in chunks of ids
+    :argument3 : test mode ('test'), JSON lines output ('jsonl') or none. 
                  If test mode is specified, output produced will mimic data from API
                  This output format is expected by test suite
+                 If 'jsonl' is specified, debts with extended info are output one JSON object per line
+    :argument4 : fetch mode or '-'. Optional. Defaults to 'single'
+         single  : query payment plans and payments per debt
+         bulk    : load all tables at once and join them in memory
+         async   : query payment plans and payments for many debts concurrently
+         threads : query payment plans and payments per debt, enriching many debts in thread pool
+         batched : query payment plans and payments for chunks of debts with multi-id requests
+         incremental : load payment plans at once, and query only payments made since last run
+         processes : load all tables at once, compute payment plan info in process pool
+         sqlite  : query local SQLite mirror of all tables, synced from API if missing or older than Mirror.MaxAge
+         spill   : load all tables page by page and join them out of core, within Spill.MemoryBudget
     """
 
+    profile = '--profile' in sys.argv
+    if profile:
+        sys.argv.remove('--profile')
+    metrics = '--metrics' in sys.argv
+    if metrics:
+        sys.argv.remove('--metrics')
+    shard_arg = ShardSpec.PopArg(sys.argv)
+
     # -- read config : 1st arg
     cfg_path = arg(1, "debt_config")
     try:
@@ -325,6 +629,8 @@ if __name__ == '__main__':
             config = json.load(cfg_file)
     except Exception as err:
         raise SystemExit(f"Cannot open config file : {err}")
+    if metrics:
+        config['Metrics'] = dict(config.get('Metrics', {}), Enabled=True)
 
     # -- run mode : 2nd arg
     # 'load' or 'l'     : load all debt records from debt table upfront
@@ -334,27 +640,32 @@ if __name__ == '__main__':
     # -- test mode : 3rd arg
     # test : run in test mode
     test_run = sys.argv[3] == "test" if (len(sys.argv) > 3) else False
+    # jsonl : output JSON lines
+    output_format = "jsonl" if (len(sys.argv) > 3 and sys.argv[3] == "jsonl") else "table"
 
-    if run_mode == "load" or run_mode == "l":
-        if not test_run:
-            print("Load " + "=" * 75)
-            print(DebtRecord.displayHeaders())
-        runDebtObjectOriented_LoadIds(config, 1, test_run)
-
-        if not test_run:
-            print("-" * 80)
-            print(DebtRecordExtra.displayHeaders())
-        runDebtObjectOriented_LoadIds(config, 2, test_run)
-
-    elif run_mode == "generate" or run_mode == "g":
-        if not test_run:
-            print("Generate " + "=" * 71)
-            print(DebtRecord.displayHeaders())
-        runDebtObjectOriented_GenerateIds(config, 1, test_run)
-
-        if not test_run:
-            print("-" * 80)
-            print(DebtRecordExtra.displayHeaders())
-        runDebtObjectOriented_GenerateIds(config, 2, test_run)
-    else:
+    # -- fetch mode : 4th arg
+    fetch_mode = arg(4, "single")
+
+    if run_mode not in ["load", "l", "generate", "g"]:
         raise SystemExit(f"Incorrect run mode '{run_mode}'.Expected 'g' or 'l' ")
+
+    try:
+        shard = None if shard_arg is None else ShardSpec.Parse(shard_arg, config)
+    except Exception as err:
+        raise SystemExit(f"{err}")
+
+    with Profiler(config) if profile else contextlib.nullcontext():
+        if shard is not None:
+            run = runDebtObjectOriented_LoadIds if run_mode in ["load", "l"] else runDebtObjectOriented_GenerateIds
+            if not shard.writePartition(lambda out: run(config, 3, False, fetch_mode, "jsonl", shard, out)):
+                raise SystemExit(f"Shard {shard} failed : partition {shard.partitionPath()} is not written")
+
+        elif run_mode == "load" or run_mode == "l":
+            if not test_run and output_format == "table":
+                print("Load " + "=" * 75)
+            runDebtObjectOriented_LoadIds(config, 3, test_run, fetch_mode, output_format)
+
+        elif run_mode == "generate" or run_mode == "g":
+            if not test_run and output_format == "table":
+                print("Generate " + "=" * 71)
+            runDebtObjectOriented_GenerateIds(config, 3, test_run, fetch_mode, output_format)
@@ -0,0 +1,145 @@
+import sys
+import cProfile
+import functools
+import tracemalloc
+
+
+class Hooks:
+    """
+    Registry of before/after callbacks on hot paths, e.g. to attach span tracer, sampling profiler
+    or tracemalloc snapshots without patching the code
+
+    Hook points :
+        httpRequest             : APISession.httpRequest and .httpRequestStream, every API request
+        addPaymentPlanExtraInfo : functional enrichment of one debt
+        DebtRecord.load         : OOP load of basic debt info
+        DebtRecordExtra.load    : OOP load of extended debt info
+        stage                   : StageTimer, end of time segment of run stage (fetch, enrich, output)
+
+    Callbacks :
+        before(point, args, kwargs) -> state
+        after(point, state, result, error) : error is exception raised by hooked function or None
+    Callbacks run in the thread calling hooked function. Function without callbacks is called directly.
+    """
+
+    # { hook point : [(before, after)] }, lists are shared with hooked functions
+    points = {}
+
+    @classmethod
+    def callbacks(cls, point) -> list:
+        return cls.points.setdefault(point, [])
+
+    @classmethod
+    def register(cls, point, before=None, after=None) -> tuple:
+        """Add callbacks to hook point. Return handle for unregister"""
+        hook = (before, after)
+        cls.callbacks(point).append(hook)
+        return point, hook
+
+    @classmethod
+    def unregister(cls, handle):
+        point, hook = handle
+        if hook in cls.callbacks(point):
+            cls.callbacks(point).remove(hook)
+
+    @classmethod
+    def clear(cls):
+        for callbacks in cls.points.values():
+            callbacks.clear()
+
+
+def hooked(point):
+    """Decorator : call callbacks registered for hook point before and after function"""
+    callbacks = Hooks.callbacks(point)
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # disabled : one list check per call
+            if not callbacks:
+                return func(*args, **kwargs)
+
+            hooks = tuple(callbacks)
+            states = [before(point, args, kwargs) if before is not None else None for before, _ in hooks]
+            try:
+                result = func(*args, **kwargs)
+            except Exception as err:
+                for (_, after), state in zip(hooks, states):
+                    if after is not None:
+                        after(point, state, None, err)
+                raise
+            for (_, after), state in zip(hooks, states):
+                if after is not None:
+                    after(point, state, result, None)
+            return result
+
+        return wrapper
+
+    return decorate
+
+
+class Profiler:
+    """
+    Built-in run profiler : cProfile dump of the run, and per-stage allocation report by tracemalloc
+    Allocation report lists, per run stage, net memory allocated and peak traced memory, followed by top
+    allocation sites of the run. cProfile covers the thread running the solution only.
+
+    Config settings (all optional) :
+        Profile.Path        : cProfile dump, readable by pstats or snakeviz, defaults to "debt_profile.prof"
+        Profile.AllocReport : allocation report file, defaults to "debt_profile_alloc.txt"
+        Profile.TopSites    : number of top allocation sites reported, defaults to 10
+    """
+
+    def __init__(self, cfg):
+        profile_cfg = cfg.get('Profile', {})
+        self.path = profile_cfg.get('Path', "debt_profile.prof")
+        self.report_path = profile_cfg.get('AllocReport', "debt_profile_alloc.txt")
+        self.top_sites = int(profile_cfg.get('TopSites', 10))
+        self.profile = cProfile.Profile()
+        self.stages = {}
+        self.last_current = 0
+        self.handle = None
+
+    def stageEnded(self, point, state, result, error):
+        # StageTimer.add(stage, since, now) : memory traced since previous segment is attributed to stage
+        stage = state
+        current, peak = tracemalloc.get_traced_memory()
+        net, stage_peak = self.stages.get(stage, (0, 0))
+        self.stages[stage] = (net + current - self.last_current, max(stage_peak, peak))
+        self.last_current = current
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def start(self):
+        tracemalloc.start()
+        self.last_current = tracemalloc.get_traced_memory()[0]
+        self.handle = Hooks.register('stage', before=lambda point, args, kwargs: args[1], after=self.stageEnded)
+        self.profile.enable()
+        return self
+
+    def stop(self):
+        self.profile.disable()
+        Hooks.unregister(self.handle)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        self.profile.dump_stats(self.path)
+        with open(self.report_path, 'w') as report:
+            report.write(self.report(snapshot))
+        sys.stderr.write(f"Profile written to {self.path}, allocation report to {self.report_path}\n")
+
+    def report(self, snapshot) -> str:
+        lines = [f"{'stage':<10} {'net allocated, KB':>18} {'peak traced, KB':>16}"]
+        for stage, (net, peak) in self.stages.items():
+            lines.append(f"{stage:<10} {net / 1024:>18.1f} {peak / 1024:>16.1f}")
+        lines.append("")
+        lines.append(f"Top {self.top_sites} allocation sites")
+        for stat in snapshot.statistics('lineno')[:self.top_sites]:
+            lines.append(str(stat))
+        return "\n".join(lines) + "\n"
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
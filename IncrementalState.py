@@ -0,0 +1,72 @@
+import os
+import json
+import hashlib
+import threading
+
+
+class IncrementalState:
+    """
+    Persistent per-payment-plan state of incremental fetch mode, stored in single JSON file
+
+    For each payment plan : signature of payment plan and debt amount, date and time the state is computed as of,
+    remaining amount as of that time, and whether any payments were seen.
+
+    Config settings (all optional) :
+        Incremental.Path : state file, defaults to ".debt_state.json". Shard i of n (ShardSpec, Sharding.py) keeps
+                           its state in separate file, e.g. ".debt_state.i_of_n.json"
+    """
+
+    def __init__(self, cfg, shard=None):
+        self.path = cfg.get('Incremental', {}).get('Path', '.debt_state.json')
+        if shard is not None:
+            root, ext = os.path.splitext(self.path)
+            self.path = f"{root}.{shard.index}_of_{shard.count}{ext}"
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as state_file:
+                self.plans = json.load(state_file)['plans']
+        # missing or corrupt state file : full recompute
+        except (OSError, ValueError, KeyError, TypeError):
+            self.plans = {}
+
+    @staticmethod
+    def key(payment_plan_id) -> str:
+        return json.dumps(payment_plan_id)
+
+    @staticmethod
+    def signature(payment_plan, debt_amount) -> str:
+        """Changes when payment plan or debt amount changes"""
+        data = json.dumps([payment_plan, repr(debt_amount)], sort_keys=True, default=str)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def get(self, payment_plan_id) -> dict:
+        """State of payment plan {'signature', 'as_of', 'remaining', 'has_payments'} or None"""
+        with self.lock:
+            return self.plans.get(IncrementalState.key(payment_plan_id))
+
+    def put(self, payment_plan_id, state):
+        with self.lock:
+            self.plans[IncrementalState.key(payment_plan_id)] = state
+
+    def drop(self, payment_plan_id):
+        with self.lock:
+            self.plans.pop(IncrementalState.key(payment_plan_id), None)
+
+    def prune(self, payment_plan_ids):
+        """Keep state of given payment plans only : plans paid off or removed no longer hold back watermark"""
+        keys = {IncrementalState.key(ppid) for ppid in payment_plan_ids}
+        with self.lock:
+            self.plans = {key: state for key, state in self.plans.items() if key in keys}
+
+    def watermark(self) -> str:
+        """Earliest date any payment plan state is computed as of, None if there is no state"""
+        with self.lock:
+            return min((state['as_of'] for state in self.plans.values()), default=None)
+
+    def save(self):
+        # write to temp file and rename : state file is never partially written
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with self.lock:
+            with open(tmp_path, 'w') as state_file:
+                json.dump({'plans': self.plans}, state_file)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,34 @@
+import sys
+import json
+import datetime
+
+
+def jsonValue(value):
+    """JSON encoder for values not supported by json module : datetime is encoded as ISO 8601 UTC date"""
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def jsonLine(record) -> str:
+    return json.dumps(record, default=jsonValue) + "\n"
+
+
+def writeJsonLines(records, out=None, flush_every=1000) -> int:
+    """
+    Write records to buffered output, one JSON object per line, as they are produced by records iterator
+    Output is flushed after first record, then every flush_every records : first records appear immediately
+    :param records     : iterable of dictionaries
+    :param out         : text stream, defaults to stdout
+    :param flush_every : number of records between flushes
+    Return number of records written
+    """
+    out = sys.stdout if out is None else out
+    nrecords = 0
+    for record in records:
+        out.write(jsonLine(record))
+        nrecords += 1
+        if nrecords == 1 or nrecords % flush_every == 0:
+            out.flush()
+    out.flush()
+    return nrecords
@@ -0,0 +1,104 @@
+import re
+import json
+
+# orjson is optional : without it, JSON is decoded by json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+Separator = re.compile(rb'\s*,')
+
+
+def jsonLoads(cfg):
+    """
+    JSON decoder function, loads(bytes) -> value, selected by Decode.Backend config setting :
+        orjson : orjson.loads, falls back to json.loads if orjson is not installed
+        json   : json.loads
+        auto   : orjson if installed, json otherwise (default)
+    """
+    backend = cfg.get('Decode', {}).get('Backend', 'auto')
+    if backend not in ['auto', 'orjson', 'json']:
+        raise Exception(f"Unknown JSON decoder backend '{backend}'. Expected auto, orjson or json")
+    return orjson.loads if orjson is not None and backend != 'json' else json.loads
+
+
+class StreamDecoder:
+    """
+    Incremental decoder of JSON response body, fed chunk by chunk as it arrives
+
+    Body with JSON array of records is decoded as records complete : each fed chunk is cut after last '}' and
+    complete records before the cut are decoded with loads in one call. Cut inside a record leaves it unbalanced,
+    so that decode fails and earlier cut is tried. Memory is bounded by one chunk and one incomplete record,
+    rather than whole body, its text and all records at once.
+    Any other body, e.g. error response { 'error' : error-description }, is decoded whole when body is complete.
+    Invalid JSON raises ValueError.
+    """
+
+    # cuts tried per chunk before waiting for more data : records with nested objects need more than one
+    MaxCuts = 4
+
+    def __init__(self, loads=json.loads):
+        self.loads = loads
+        self.buffer = bytearray()
+        # None until first non-blank byte, then True for array body, False for other value
+        self.array = None
+        self.nrecords = 0
+
+    def feed(self, chunk) -> list:
+        """Add chunk of body. Return records completed by chunk, in order"""
+        self.buffer += chunk
+        if self.array is None:
+            start = len(self.buffer) - len(self.buffer.lstrip())
+            if start == len(self.buffer):
+                return []
+            self.array = self.buffer[start] == ord('[')
+            if self.array:
+                del self.buffer[:start + 1]
+        return self.decodeRecords() if self.array else []
+
+    def decodeRecords(self) -> list:
+        cut = len(self.buffer)
+        for _ in range(StreamDecoder.MaxCuts):
+            cut = self.buffer.rfind(b'}', 0, cut)
+            if cut < 0:
+                return []
+            try:
+                records = self.decodeArray(self.buffer[:cut + 1] + b']')
+            except ValueError:
+                continue
+            del self.buffer[:cut + 1]
+            return records
+        return []
+
+    def decodeArray(self, text) -> list:
+        """Decode records in text, closed by ']' : text after first record starts with comma separator"""
+        if self.nrecords > 0 and Separator.match(text):
+            # placeholder record keeps array strict : separator is required between records
+            records = self.loads(b'[0' + text)[1:]
+        else:
+            records = self.loads(b'[' + text)
+            if self.nrecords > 0 and len(records) > 0:
+                raise ValueError("Expecting ',' delimiter between records")
+        self.nrecords += len(records)
+        return records
+
+    def close(self):
+        """
+        End of body. Return records not returned by feed, if body is JSON array; decoded value otherwise
+        """
+        if not self.array:
+            return self.loads(bytes(self.buffer))
+        records = self.decodeArray(bytes(self.buffer))
+        self.buffer = bytearray()
+        return records
+
+
+def decodeChunks(chunks, loads=json.loads):
+    """Decode JSON body from iterable of byte chunks : list of records if body is JSON array, decoded value otherwise"""
+    decoder = StreamDecoder(loads)
+    records = []
+    for chunk in chunks:
+        records.extend(decoder.feed(chunk))
+    rest = decoder.close()
+    return records + rest if decoder.array else rest
@@ -0,0 +1,212 @@
+import sys
+import json
+import time
+import bisect
+import threading
+import contextlib
+from Hooks import hooked
+
+
+class LatencyHistogram:
+    """
+    Histogram of request latencies with fixed bucket upper bounds, in seconds (Prometheus histogram buckets)
+    Quantiles are estimated by linear interpolation within bucket, as Prometheus histogram_quantile does
+    """
+
+    Buckets = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0]
+
+    def __init__(self, buckets=Buckets):
+        self.bounds = list(buckets)
+        # last bucket counts latencies above all bounds (+Inf)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q) -> float:
+        """Estimated q-quantile of latencies, None if no latency is observed"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count > 0 and cumulative + count >= rank:
+                # above highest bound : highest bound is the best estimate
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                return lower + (self.bounds[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.bounds[-1]
+
+    def snapshot(self) -> dict:
+        """{ 'count', 'sum', 'buckets': [[upper bound, cumulative count]], 'p50', 'p95', 'p99' }"""
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.bounds + ["+Inf"], self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets,
+                'p50': self.quantile(0.50), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99)}
+
+
+class RequestMetrics:
+    """
+    Response metrics of one API table, updated by APISession.httpRequest from any thread :
+    latency histogram, response bytes, JSON decode time and throughput, errors by class
+    Error classes : timeout, connection, http_4xx, http_5xx, response (error or invalid response body),
+                    circuit_open
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = LatencyHistogram()
+        self.response_bytes = 0
+        self.decode_seconds = 0.0
+        self.decoded_bytes = 0
+        self.errors = {}
+
+    def observeResponse(self, seconds, nbytes):
+        with self.lock:
+            self.latency.observe(seconds)
+            self.response_bytes += nbytes
+
+    def observeDecode(self, seconds, nbytes=0):
+        with self.lock:
+            self.decode_seconds += seconds
+            self.decoded_bytes += nbytes
+
+    def observeError(self, error_class):
+        with self.lock:
+            self.errors[error_class] = self.errors.get(error_class, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'response_bytes': self.response_bytes,
+                    'decode_seconds': self.decode_seconds,
+                    'decoded_bytes': self.decoded_bytes,
+                    'decode_bytes_per_second': self.decoded_bytes / self.decode_seconds if self.decode_seconds
+                                               else None,
+                    'errors': dict(self.errors),
+                    'latency': self.latency.snapshot()}
+
+
+class StageTimer:
+    """
+    Wall time of run stages : fetch, enrich, output
+    Stages nest : time of inner stage is excluded from enclosing stage, e.g. debts fetched page by page
+    while being enriched count as fetch time. Stages are timed in the thread running the solution.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        # [stage, time stage was entered or resumed]
+        self.stack = []
+
+    @hooked('stage')
+    def add(self, stage, since, now):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + now - since
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            self.add(*self.stack[-1], now)
+        self.stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.add(*self.stack.pop(), now)
+            if self.stack:
+                self.stack[-1][1] = now
+
+    def begin(self, name):
+        """End current stage, if any, and begin next one : for stages run one after another"""
+        now = time.perf_counter()
+        if self.stack:
+            self.add(*self.stack.pop(), now)
+        self.stack.append([name, now])
+
+    def end(self):
+        """End all stages"""
+        now = time.perf_counter()
+        while self.stack:
+            self.add(*self.stack.pop(), now)
+
+    def timed(self, name, iterable):
+        """Generator : yield items of iterable, timing production of each item as stage"""
+        items = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    def snapshot(self) -> dict:
+        return dict(self.seconds)
+
+
+# ============= Metrics export
+
+def prometheusText(metrics) -> str:
+    """Metrics in Prometheus text exposition format"""
+    lines = []
+
+    def family(name, kind, samples):
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            slabels = ",".join(f'{key}="{val}"' for key, val in labels.items())
+            lines.append(f"{name}{{{slabels}}} {value}")
+
+    tables = metrics.get('tables', {})
+    for counter, name in [('requests', 'debt_api_requests_total'), ('retries', 'debt_api_retries_total'),
+                          ('response_bytes', 'debt_api_response_bytes_total'),
+                          ('decode_seconds', 'debt_api_decode_seconds_total'),
+                          ('decoded_bytes', 'debt_api_decoded_bytes_total')]:
+        family(name, "counter", [({'table': table}, tm[counter]) for table, tm in tables.items()])
+    family("debt_api_errors_total", "counter",
+           [({'table': table, 'class': error_class}, count)
+            for table, tm in tables.items() for error_class, count in tm['errors'].items()])
+
+    lines.append("# TYPE debt_api_request_duration_seconds histogram")
+    for table, tm in tables.items():
+        latency = tm['latency']
+        for bound, count in latency['buckets']:
+            lines.append(f'debt_api_request_duration_seconds_bucket{{table="{table}",le="{bound}"}} {count}')
+        lines.append(f'debt_api_request_duration_seconds_sum{{table="{table}"}} {latency["sum"]}')
+        lines.append(f'debt_api_request_duration_seconds_count{{table="{table}"}} {latency["count"]}')
+
+    family("debt_api_request_latency_seconds", "gauge",
+           [({'table': table, 'quantile': q}, tm['latency'][p]) for table, tm in tables.items()
+            for q, p in [("0.5", 'p50'), ("0.95", 'p95'), ("0.99", 'p99')] if tm['latency'][p] is not None])
+    family("debt_run_stage_seconds", "gauge",
+           [({'stage': stage}, seconds) for stage, seconds in metrics.get('stages', {}).items()])
+    return "\n".join(lines) + "\n"
+
+
+def writeMetrics(cfg, metrics):
+    """
+    Write run metrics { 'stages': {...}, 'tables': {...} } if enabled by config
+    Config settings (all optional) :
+        Metrics.Enabled : true to write metrics at the end of each run, defaults to false
+        Metrics.Format  : json or prometheus, defaults to json
+        Metrics.Path    : file to write metrics to, '-' for stderr, defaults to "debt_metrics.json"
+    """
+    metrics_cfg = cfg.get('Metrics', {})
+    if not metrics_cfg.get('Enabled', False):
+        return
+    fmt = metrics_cfg.get('Format', 'json')
+    text = prometheusText(metrics) if fmt == 'prometheus' else json.dumps(metrics, indent=2) + "\n"
+
+    path = metrics_cfg.get('Path', "debt_metrics.json")
+    if path == '-':
+        sys.stderr.write(text)
+    else:
+        with open(path, 'w') as metrics_file:
+            metrics_file.write(text)
@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from SyntheticData import loadTables
+
+
+def syntheticTables(ndebts) -> tuple:
+    """
+    Debts DB with ndebts debts : every other debt has weekly payment plan with 2 payments made
+    Return (debts, payment plans, payments)
+    """
+    debts = [{"amount": 100 + i, "id": i} for i in range(ndebts)]
+    plans = [{"amount_to_pay": 100 + i, "debt_id": i, "id": i, "installment_amount": 25,
+              "installment_frequency": "WEEKLY", "start_date": "2020-08-01"} for i in range(0, ndebts, 2)]
+    payments = [{"amount": 25, "date": date, "payment_plan_id": pp['id']}
+                for pp in plans for date in ["2020-08-01", "2020-08-08"]]
+    return debts, plans, payments
+
+
+class MockServer:
+    """
+    Local stand-in for Debts DB API, compatible with json-server queries used by APIAccess :
+        field=value (repeated : any of values), field_gte / field_lte / field_ne,
+        _page/_limit and _start/_end/_limit paging
+    Serves /debts, /payment_plans and /payments over HTTP/1.1 keep-alive connections, on localhost.
+
+    Every request is delayed by latency plus random jitter (seconds), and fails with 500 Internal Server Error
+    with probability error_rate.
+    """
+
+    Paths = {'Debts': 'debts', 'PaymentPlans': 'payment_plans', 'Payments': 'payments'}
+
+    def __init__(self, tables, latency=0.0, jitter=0.0, error_rate=0.0, seed=None, port=0):
+        """
+        :param tables : (debts, payment plans, payments)
+        :param port   : port to listen on, 0 for any free port
+        """
+        self.data = dict(zip(MockServer.Paths.values(), tables))
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'errors': 0}
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), MockServer.handler(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    # ============= MockServer : start / stop
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def config(self, cfg) -> dict:
+        """Copy of config with URLs of Debts DB tables pointing to this server"""
+        return dict(cfg, URL={table: f"{self.url}/{path}" for table, path in MockServer.Paths.items()})
+
+    # ============= MockServer : counters
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self) -> dict:
+        """Number of requests served and errors injected"""
+        with self.lock:
+            return dict(self.counters)
+
+    def resetStats(self):
+        with self.lock:
+            self.counters = {counter: 0 for counter in self.counters}
+
+    # ============= MockServer : queries
+    @staticmethod
+    def matches(rec, key, values) -> bool:
+        for suffix, compare in [('_gte', lambda value, arg: value >= arg),
+                                ('_lte', lambda value, arg: value <= arg),
+                                ('_ne', lambda value, arg: value != arg)]:
+            if key.endswith(suffix):
+                field = rec.get(key[:-len(suffix)])
+                # numbers are compared as numbers, other values as strings
+                try:
+                    return all(compare(float(field), float(arg)) for arg in values)
+                except (TypeError, ValueError):
+                    return all(compare(str(field), arg) for arg in values)
+        return str(rec.get(key)) in values
+
+    def query(self, path, params) -> list:
+        """Records of table at path matching query params, paged. None if there is no such table"""
+        rs = self.data.get(path.strip('/'))
+        if rs is None:
+            return None
+
+        filters = {key: values for key, values in params.items() if not key.startswith('_')}
+        rs = [rec for rec in rs if all(MockServer.matches(rec, key, values) for key, values in filters.items())]
+
+        if '_page' in params:
+            limit = int(params.get('_limit', ['10'])[0])
+            start = (int(params['_page'][0]) - 1) * limit
+            return rs[start:start + limit]
+        if '_start' in params or '_end' in params or '_limit' in params:
+            start = int(params.get('_start', ['0'])[0])
+            end = int(params['_end'][0]) if '_end' in params else start + int(params.get('_limit', [len(rs)])[0])
+            return rs[start:end]
+        return rs
+
+    def delay(self) -> tuple:
+        """(seconds to delay request, True if request fails)"""
+        with self.lock:
+            return self.latency + self.random.uniform(0, self.jitter), self.random.random() < self.error_rate
+
+    @staticmethod
+    def handler(mock):
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately : without TCP_NODELAY, delayed ACK stalls every response
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                mock.count('requests')
+                delay, fail = mock.delay()
+                time.sleep(delay)
+
+                url = urlsplit(self.path)
+                rs = mock.query(url.path, parse_qs(url.query))
+                if fail:
+                    mock.count('errors')
+                    self.reply(500, {"error": "injected server error"})
+                elif rs is None:
+                    self.reply(404, {})
+                else:
+                    self.reply(200, rs)
+
+            def reply(self, status, data):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+# ###################################### MAIN ############################################################
+
+if __name__ == '__main__':
+    """
+    Serve synthetic Debts DB until interrupted
+    Program arguments, all optional :
+    :argument1 : number of debts, or directory with tables written by SyntheticData.py, defaults to 1000
+    :argument2 : port, defaults to 3000
+    :argument3 : latency in seconds, defaults to 0
+    :argument4 : jitter in seconds, defaults to 0
+    :argument5 : error rate, defaults to 0
+    """
+
+    def arg(argn, dflt, convert):
+        return convert(sys.argv[argn]) if len(sys.argv) > argn and sys.argv[argn] != '-' else dflt
+
+    data = arg(1, "1000", str)
+    tables = loadTables(data) if os.path.isdir(data) else syntheticTables(int(data))
+    server = MockServer(tables, arg(3, 0.0, float), arg(4, 0.0, float),
+                        arg(5, 0.0, float), port=arg(2, 3000, int))
+    print(f"Serving {server.url}/debts, /payment_plans, /payments")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.server.server_close()
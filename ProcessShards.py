@@ -0,0 +1,80 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from APIAccess import APIAccess, APIBulkAccess
+from VectorizedPayments import PaymentColumns, paymentPlanInfoColumns, np
+
+
+def shardColumns(columns, nshards) -> list:
+    """
+    Partition columns of payment plans into contiguous ranges of payment plan indexes, with their payments
+    :param columns : (debt amounts, start dates, installment frequencies, payment plan index of each payment,
+                      payment amounts, payment dates), as returned by APIBulkAccess.paymentPlanColumns
+    Return arguments of paymentPlanInfoColumns per shard, payment plan indexes local to shard
+    """
+    amounts, start_dates, frequencies, payment_plans, payment_amounts, payment_dates = columns
+    nplans = len(amounts)
+    bounds = np.linspace(0, nplans, min(nshards, nplans) + 1).astype(np.int64)
+
+    # payments grouped by shard in one stable sort : table order is kept within shard
+    in_plan = np.flatnonzero(payment_plans >= 0)
+    payment_shards = np.searchsorted(bounds, payment_plans[in_plan], side='right') - 1
+    order = in_plan[np.argsort(payment_shards, kind='stable')]
+    splits = np.cumsum(np.bincount(payment_shards, minlength=len(bounds) - 1))[:-1]
+    payment_amounts = np.fromiter(payment_amounts, object, len(payment_amounts))
+    payment_dates = np.fromiter(payment_dates, object, len(payment_dates))
+
+    return [(amounts[lo:hi], start_dates[lo:hi], frequencies[lo:hi], payment_plans[payments] - lo,
+             payment_amounts[payments], payment_dates[payments])
+            for lo, hi, payments in zip(bounds[:-1], bounds[1:], np.split(order, splits))]
+
+
+class APIShardedAccess(APIBulkAccess):
+    """
+    In-memory replica of Debts DB, as APIBulkAccess, with payment plan info computed in process pool
+    Used by 'processes' fetch mode, for CPU-bound enrichment of large portfolios
+
+    Payment plans are partitioned into shards of contiguous payment plan indexes, as table columns. Workers run
+    vectorized engine (VectorizedPayments.py) on their shard's columns, and result columns are concatenated
+    in payment plan index order. Debts are then enriched in debt id order with precomputed info.
+
+    Config settings (all optional) :
+        Processes.MaxWorkers  : number of worker processes, defaults to number of CPUs
+        Processes.Shards      : number of shards, defaults to 4 per worker
+        Processes.StartMethod : multiprocessing start method, defaults to spawn
+    """
+
+    def paymentPlanInfo(self, payment_plan, debt_amount):
+        """
+        Remaining amount and next payment due date of payment plan as of APIAccess.Today, computed for all payment
+        plans at once in process pool. None if not computed : caller computes it from payment plan and payments
+        """
+        if not PaymentColumns.Available(self.cfg):
+            return None
+        with self.lock:
+            if self.planInfo is None or self.planInfo[0] != APIAccess.Today:
+                self.planInfo = (APIAccess.Today, self.computePaymentPlanInfo())
+            plan_index, remaining, next_due, computed = self.planInfo[1]
+        i = plan_index.get(payment_plan['id'])
+        if i is None or not computed[i]:
+            return None
+        return {'remaining_amount': float(remaining[i]), 'next_payment_due_date': next_due[i].item()}
+
+    def computePaymentPlanInfo(self) -> tuple:
+        """
+        ({ payment plan id : index }, remaining amounts, next payment due dates, computed mask) by payment plan index
+        """
+        processes_cfg = self.cfg.get('Processes', {})
+        max_workers = int(processes_cfg.get('MaxWorkers', 0)) or os.cpu_count() or 1
+        nshards = int(processes_cfg.get('Shards', 0)) or 4 * max_workers
+        context = multiprocessing.get_context(processes_cfg.get('StartMethod', 'spawn'))
+
+        plan_index, *columns = self.paymentPlanColumns()
+        shards = shardColumns(columns, nshards)
+        # workers import VectorizedPayments only
+        with ProcessPoolExecutor(max_workers, mp_context=context) as executor:
+            futures = [executor.submit(paymentPlanInfoColumns, self.cfg, APIAccess.Today, *shard) for shard in shards]
+            results = [future.result() for future in futures]
+        if not results:
+            return plan_index, np.zeros(0), np.zeros(0, dtype='datetime64[us]'), np.zeros(0, dtype=bool)
+        return (plan_index,) + tuple(np.concatenate(result) for result in zip(*results))
@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+class ResponseCache:
+    """
+    Persistent file-based cache of API responses, keyed by table and request params
+
+    Each response is stored in its own JSON file in cache directory, along with its ETag and Last-Modified headers.
+    Response younger than table TTL is served from cache without request.
+    Expired response is revalidated with If-None-Match / If-Modified-Since request headers :
+    unchanged table comes back as 304 Not Modified, and cached response is reused.
+
+    Config settings (all optional) :
+        Cache.Enabled : true to use cache, defaults to false
+        Cache.Path    : cache directory, defaults to ".debt_cache"
+        Cache.TTL     : { table : time to live in seconds }, defaults to 0 (always revalidate)
+    """
+
+    def __init__(self, cfg):
+        cache_cfg = cfg.get('Cache', {})
+        self.path = cache_cfg.get('Path', '.debt_cache')
+        self.ttl = cache_cfg.get('TTL', {})
+        self.lock = threading.Lock()
+        self.counters = {}
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def Enabled(cfg) -> bool:
+        return bool(cfg.get('Cache', {}).get('Enabled', False))
+
+    # ============= ResponseCache : counters
+    def count(self, table, counter):
+        with self.lock:
+            table_counters = self.counters.setdefault(table, {'hits': 0, 'misses': 0, 'revalidated': 0})
+            table_counters[counter] += 1
+
+    def stats(self) -> dict:
+        """Hit/miss counters per table : { table : {'hits': n, 'misses': n, 'revalidated': n} }"""
+        with self.lock:
+            return {table: dict(table_counters) for table, table_counters in self.counters.items()}
+
+    # ============= ResponseCache : entries
+    def entryPath(self, table, request_params) -> str:
+        key = json.dumps([table, sorted(request_params.items())], default=str)
+        return os.path.join(self.path, f"{table}-{hashlib.sha1(key.encode()).hexdigest()}.json")
+
+    def get(self, table, request_params) -> dict:
+        """Cached entry {'time', 'etag', 'last_modified', 'data'} or None"""
+        try:
+            with open(self.entryPath(table, request_params)) as entry_file:
+                return json.load(entry_file)
+        # missing or partially written entry is a cache miss
+        except (OSError, ValueError):
+            return None
+
+    def isFresh(self, table, entry) -> bool:
+        return time.time() - entry['time'] < float(self.ttl.get(table, 0))
+
+    @staticmethod
+    def validators(entry) -> dict:
+        """Conditional request headers for revalidation of cached entry"""
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, table, request_params, data, etag=None, last_modified=None):
+        entry = {'time': time.time(), 'etag': etag, 'last_modified': last_modified, 'data': data}
+        path = self.entryPath(table, request_params)
+
+        # write to temp file and rename : readers never see partially written entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(tmp_path, path)
+
+    def refresh(self, table, request_params, entry):
+        """Entry revalidated by server : restart its time to live"""
+        self.put(table, request_params, entry['data'], entry.get('etag'), entry.get('last_modified'))
@@ -0,0 +1,336 @@
+import os
+import sys
+import json
+import time
+import datetime
+import sqlite3
+import threading
+from APIAccess import APIAccess
+from DateParser import DateParser
+from JsonStream import jsonLoads
+
+# table : (key columns stored next to JSON record, indexed key columns)
+Schema = {
+    'debts': (['id', 'amount'], ['id']),
+    'payment_plans': (['id', 'debt_id'], ['id', 'debt_id']),
+    'payments': (['payment_plan_id', 'date', 'amount'], ['payment_plan_id', 'date']),
+}
+
+# SQLite limit on number of query parameters is 999 in older versions
+MaxParams = 900
+
+
+def floatOrNone(value):
+    """Debt amount as float, as enrichment verifies it; None if not a number"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RemainingAmount:
+    """
+    SQLite aggregate : remaining amount of payment plan from its payments, fed in table order
+    Arguments per payment : debt amount, payment amount, payment date.
+    Payments dated before today are subtracted one by one from debt amount, as per-debt calculation does,
+    so that result is exactly equal. None if any payment date or amount is invalid, or debt amount is unknown
+    """
+
+    def __init__(self, parse, today):
+        self.parse = parse
+        self.today = today
+        self.remaining = None
+        self.valid = True
+
+    def step(self, debt_amount, amount, date):
+        if not self.valid:
+            return
+        try:
+            if self.remaining is None:
+                self.remaining = float(debt_amount)
+            if self.parse(date) < self.today:
+                self.remaining -= float(amount)
+        except Exception:
+            self.valid = False
+
+    def finalize(self):
+        return self.remaining if self.valid else None
+
+
+class SQLiteMirror:
+    """
+    Local SQLite mirror of Debts DB, compatible with APIAccess fetch methods : used by 'sqlite' fetch mode
+
+    Each table stores records as JSON, in API order, with indexed key columns : lookups of payment plans by debt id
+    and of payments by payment plan id are index searches, with no request to API.
+    Mirror is synced by bulk load of the 3 tables from API into new database file, which replaces mirror
+    when load completes : readers never see partial mirror.
+
+    Remaining amounts of all payment plans are computed with single GROUP BY query over Payments (RemainingAmount).
+
+    Config settings (all optional) :
+        Mirror.Path   : SQLite database file, defaults to "debt_mirror.sqlite"
+        Mirror.MaxAge : seconds since last sync after which mirror is synced again when opened,
+                        defaults to none (synced only when missing, or by SQLiteMirror.py)
+    Mirror is always synced with all debts : opened for shard (ShardSpec, Sharding.py), it iterates records of
+    shard's debts only, so that shard runs and unsharded runs share the same mirror.
+    """
+
+    def __init__(self, cfg, path=None):
+        self.cfg = cfg
+        self.path = path if path is not None else cfg.get('Mirror', {}).get('Path', "debt_mirror.sqlite")
+        self.loads = jsonLoads(cfg)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.planInfo = None
+        self.shard = None
+
+    @classmethod
+    def Open(cls, api, shard=None):
+        """
+        Open mirror set by config, synced from API first if it is missing or older than Mirror.MaxAge
+        :param api   : APIAccess, not restricted to shard
+        :param shard : ShardSpec restricting iteration to debts of shard. Optional
+        """
+        mirror = cls(api.cfg)
+        mirror.shard = shard
+        max_age = api.cfg.get('Mirror', {}).get('MaxAge')
+        if not os.path.exists(mirror.path) or \
+                (max_age is not None and time.time() - mirror.syncedAt() > float(max_age)):
+            mirror.sync(api)
+        return mirror
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Read-only connection of this thread"""
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        return self.local.connection
+
+    # ============= SQLiteMirror : sync
+    def sync(self, api) -> dict:
+        """Load all 3 tables from API into mirror. Return { table : number of records }"""
+        # temporary file per process : shard runs may sync missing mirror at the same time
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        counts = {}
+        db = sqlite3.connect(tmp_path)
+        try:
+            # new file replaces mirror only when load completes : no journal needed
+            db.execute("PRAGMA journal_mode = OFF")
+            db.execute("PRAGMA synchronous = OFF")
+            for table, records in [('debts', api.iterDebts()), ('payment_plans', api.iterPaymentPlans()),
+                                   ('payments', api.iterPayments())]:
+                counts[table] = self.loadTable(db, table, records)
+            self.addDebtAmounts(db)
+            db.execute("CREATE TABLE sync (synced_at REAL, counts TEXT)")
+            db.execute("INSERT INTO sync VALUES (?, ?)", (time.time(), json.dumps(counts)))
+            db.commit()
+        finally:
+            db.close()
+
+        os.replace(tmp_path, self.path)
+        # connections of all threads are reopened on new file
+        self.local = threading.local()
+        with self.lock:
+            self.planInfo = None
+        return counts
+
+    @staticmethod
+    def loadTable(db, table, records) -> int:
+        """Bulk insert records, in order, then index key columns"""
+        keys, indexed = Schema[table]
+        db.execute(f"CREATE TABLE {table} ({', '.join(keys)}, record TEXT)")
+        encode = json.JSONEncoder(check_circular=False, separators=(',', ':')).encode
+        placeholders = ", ".join("?" * (len(keys) + 1))
+        cursor = db.executemany(f"INSERT INTO {table} VALUES ({placeholders})",
+                                (tuple(SQLiteMirror.column(rec.get(key)) for key in keys) + (encode(rec),)
+                                 for rec in records))
+        for key in indexed:
+            db.execute(f"CREATE INDEX {table}_{key} ON {table} ({key})")
+        return cursor.rowcount
+
+    @staticmethod
+    def column(value):
+        """Key column value : numbers and strings are stored as is, other values as JSON text"""
+        if value is None or type(value) in [int, float, str, bool]:
+            return value
+        return json.dumps(value)
+
+    @staticmethod
+    def addDebtAmounts(db):
+        """
+        Debt amount of payment plan, as float, for payment plans with unique id and single debt with valid amount
+        """
+        db.create_function('float_or_null', 1, floatOrNone)
+        db.execute("ALTER TABLE payment_plans ADD COLUMN debt_amount REAL")
+        db.execute("""
+            UPDATE payment_plans SET debt_amount =
+                (SELECT float_or_null(debts.amount) FROM debts WHERE debts.id = payment_plans.debt_id)
+            WHERE (SELECT COUNT(*) FROM debts WHERE debts.id = payment_plans.debt_id) = 1
+              AND (SELECT COUNT(*) FROM payment_plans AS other WHERE other.id = payment_plans.id) = 1""")
+
+    def syncedAt(self) -> float:
+        """Time of last sync, in seconds since epoch"""
+        return self.connection.execute("SELECT synced_at FROM sync").fetchone()[0]
+
+    def stats(self) -> dict:
+        """{ 'synced_at' : ISO date and time of last sync, table : number of records }"""
+        synced_at, counts = self.connection.execute("SELECT synced_at, counts FROM sync").fetchone()
+        return dict(json.loads(counts), synced_at=datetime.datetime.fromtimestamp(synced_at).isoformat())
+
+    # ============= SQLiteMirror : fetch methods
+    def query(self, sql, params=()) -> list:
+        return [self.loads(record) for record, in self.connection.execute(sql, params)]
+
+    def iterTable(self, table, where="", params=()):
+        """Generator : iterate over records of table in API order, without loading whole table"""
+        cursor = self.connection.execute(f"SELECT record FROM {table} {where} ORDER BY rowid", params)
+        while True:
+            rows = cursor.fetchmany(1000)
+            if len(rows) == 0:
+                return
+            for record, in rows:
+                yield self.loads(record)
+
+    def fetchBatch(self, table, key, ids) -> dict:
+        """Records for list of ids : { id : [records] }, every requested id is present"""
+        grouped = {id: [] for id in ids}
+        ids = list(grouped)
+        for start in range(0, len(ids), MaxParams):
+            chunk = ids[start:start + MaxParams]
+            for rec in self.query(f"SELECT record FROM {table} WHERE {key} IN ({', '.join('?' * len(chunk))}) "
+                                  f"ORDER BY rowid", chunk):
+                grouped.setdefault(rec.get(key), []).append(rec)
+        return grouped
+
+    def iterDebts(self, page_size=None):
+        """Generator : debts in API order, of shard only if mirror is opened for shard"""
+        debts = self.iterTable('debts')
+        return debts if self.shard is None else (dbt for dbt in debts if self.shard.contains(dbt.get('id')))
+
+    def iterPaymentPlans(self, page_size=None):
+        """Generator : payment plans in API order, of shard's debts only if mirror is opened for shard"""
+        plans = self.iterTable('payment_plans')
+        return plans if self.shard is None else (pp for pp in plans if self.shard.contains(pp.get('debt_id')))
+
+    def iterPayments(self, page_size=None):
+        """Generator : payments in API order, of shard's payment plans only if mirror is opened for shard"""
+        payments = self.iterTable('payments')
+        if self.shard is None:
+            return payments
+        plan_ids = {pp.get('id') for pp in self.iterPaymentPlans()}
+        return (pmt for pmt in payments if pmt.get('payment_plan_id') in plan_ids)
+
+    def iterPaymentsSince(self, date, page_size=None):
+        """Payments dated on or after date ('YYYY-MM-DD'), by date index"""
+        return self.iterTable('payments', "WHERE date >= ?", (date,))
+
+    def fetchDebtsBatch(self, debt_ids) -> dict:
+        return self.fetchBatch('debts', 'id', debt_ids)
+
+    def fetchPaymentPlansBatch(self, debt_ids) -> dict:
+        return self.fetchBatch('payment_plans', 'debt_id', debt_ids)
+
+    def fetchPaymentsBatch(self, payment_plan_ids) -> dict:
+        return self.fetchBatch('payments', 'payment_plan_id', payment_plan_ids)
+
+    def fetchDebts(self, debt_id=None) -> list:
+        """lookup Debts table, throws XDebtIdNotFound if debt id is not present"""
+        if debt_id is None:
+            return list(self.iterDebts())
+        debts = self.query("SELECT record FROM debts WHERE id = ? ORDER BY rowid", (debt_id,))
+        if len(debts) == 0: raise APIAccess.XDebtIdNotFound
+        return debts
+
+    def fetchPaymentPlans(self, debt_id=None) -> list:
+        """lookup PaymentPlans table by debt id"""
+        if debt_id is None:
+            return list(self.iterPaymentPlans())
+        return self.query("SELECT record FROM payment_plans WHERE debt_id = ? ORDER BY rowid", (debt_id,))
+
+    def fetchPayments(self, payment_plan_id=None) -> list:
+        """lookup Payments table by payment plan id"""
+        if payment_plan_id is None:
+            return list(self.iterPayments())
+        return self.query("SELECT record FROM payments WHERE payment_plan_id = ? ORDER BY rowid", (payment_plan_id,))
+
+    # ============= SQLiteMirror : payment plan info
+    def paymentPlanInfo(self, payment_plan, debt_amount):
+        """
+        Remaining amount and next payment due date of payment plan as of APIAccess.Today :
+        { 'remaining_amount': float, 'next_payment_due_date': datetime or None if debt is paid off }
+        Remaining amounts are computed for all payment plans with payments at once (remainingAmounts).
+        None if payment plan or its payments are invalid : caller computes it from payments and reports the error
+        """
+        with self.lock:
+            if self.planInfo is None or self.planInfo[0] != APIAccess.Today:
+                self.planInfo = (APIAccess.Today, self.remainingAmounts())
+            remaining_amounts = self.planInfo[1]
+
+        try:
+            start_date = DateParser.Instance(self.cfg).parse(payment_plan['start_date'])
+            period = self.cfg["Tables"]["PaymentPlans"]["FrequencyToDays"][payment_plan['installment_frequency']]
+        except Exception:
+            return None
+        elapsed_days = (APIAccess.Today - start_date).days
+        next_payment_due_date = start_date + datetime.timedelta(-(-elapsed_days // period) * period)
+
+        ppid = payment_plan['id']
+        if ppid not in remaining_amounts:
+            # no payments made
+            return {'remaining_amount': debt_amount, 'next_payment_due_date': next_payment_due_date}
+
+        remaining_amount, plan_debt_amount = remaining_amounts[ppid]
+        # debt amount differs from mirror : caller computes from payments
+        if remaining_amount is None or plan_debt_amount != debt_amount:
+            return None
+        return {'remaining_amount': remaining_amount,
+                'next_payment_due_date': None if remaining_amount == 0 else next_payment_due_date}
+
+    def remainingAmounts(self) -> dict:
+        """
+        { payment plan id : (remaining amount or None if invalid, debt amount) } for payment plans with payments,
+        by single GROUP BY query. Payments index is scanned in payment plan id order, then table order :
+        payments of each plan are subtracted in the same order as per-debt calculation does
+        """
+        parse, today = DateParser.Instance(self.cfg).parse, APIAccess.Today
+        db = self.connection
+        db.create_aggregate('remaining_amount', 3, lambda: RemainingAmount(parse, today))
+        rows = db.execute("""
+            SELECT payment_plan_id, debt_amount, remaining_amount(debt_amount, amount, date)
+            FROM (SELECT payment_plan_id, amount, date,
+                         (SELECT debt_amount FROM payment_plans WHERE payment_plans.id = payment_plan_id) AS debt_amount
+                  FROM payments INDEXED BY payments_payment_plan_id
+                  WHERE payment_plan_id IS NOT NULL)
+            GROUP BY payment_plan_id""")
+        return {ppid: (remaining, debt_amount) for ppid, debt_amount, remaining in rows}
+
+
+# ###################################### MAIN ############################################################
+
+if __name__ == '__main__':
+    """
+    Sync local SQLite mirror of Debts DB from API
+    Program arguments:
+    :argument1 : path to config file or '-'. Optional. Defaults to "debt_config"
+    :argument2 : mirror file. Optional. Defaults to Mirror.Path config setting
+    """
+
+    cfg_path = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] != '-' else "debt_config"
+    try:
+        with open(cfg_path) as cfg_file:
+            config = json.load(cfg_file)
+    except Exception as err:
+        raise SystemExit(f"Cannot open config file : {err}")
+
+    mirror = SQLiteMirror(config, sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] != '-' else None)
+    start = time.perf_counter()
+    try:
+        synced = mirror.sync(APIAccess.Instance(config))
+    except Exception as err:
+        raise SystemExit(f"Cannot sync mirror : {err}")
+    print(f"Synced {mirror.path} in {time.perf_counter() - start:.1f}s : "
+          + ", ".join(f"{table} {count}" for table, count in synced.items()))
@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import heapq
+import zlib
+from SpillJoin import ExternalSorter, joinKey
+
+
+def shardOf(debt_id, nshards) -> int:
+    """Shard of debt id : stable hash, the same in every process and run (unlike hash of str)"""
+    return zlib.crc32(str(debt_id).encode()) % nshards
+
+
+class ShardSpec:
+    """
+    Shard i of n of Debts DB, for runs spread across several processes or machines : shards 0..n-1 together
+    cover every debt exactly once
+
+    Partitions :
+        hash  : debt is in shard shardOf(debt id, n). Debts table is fetched whole and filtered by each shard
+        range : debt ids in [lo, hi) are split into n contiguous ranges. Each shard queries Debts and PaymentPlans
+                with id range filters (id_gte / id_lte), first and last shards take ids below lo and above hi
+    In both partitions, payment plans and payments are fetched for the shard's debts only, except in fetch modes
+    loading whole tables (bulk, processes), where loaded tables are filtered.
+
+    Config settings (all optional) :
+        Shards.Partition     : hash or range, defaults to hash
+        Shards.IdRange       : [lo, hi) range of debt ids for range partition, required by range partition
+        Shards.PartitionPath : partition file of shard, formatted with index and count,
+                               defaults to "debt_part_{index}_of_{count}.jsonl"
+        Shards.SortBudget    : bytes of partition lines sorted in memory, spilled to run files beyond,
+                               defaults to 64MB
+    """
+
+    def __init__(self, index, count, partition="hash", id_range=None, partition_path=None, sort_budget=None):
+        if not 0 <= index < count:
+            raise Exception(f"Incorrect shard {index}/{count} : expected 0 <= shard < number of shards")
+        if partition not in ["hash", "range"]:
+            raise Exception(f"Unknown shard partition '{partition}'. Expected hash or range")
+        if partition == "range" and id_range is None:
+            raise Exception("Range shard partition requires Shards.IdRange config setting")
+        self.index = index
+        self.count = count
+        self.partition = partition
+        self.lo, self.hi = (None, None)
+        if partition == "range":
+            lo, hi = map(int, id_range)
+            # first and last shards are open-ended : ids out of configured range are not lost
+            self.lo = lo + (hi - lo) * index // count if index > 0 else None
+            self.hi = lo + (hi - lo) * (index + 1) // count if index < count - 1 else None
+        self.partition_path = partition_path if partition_path is not None else "debt_part_{index}_of_{count}.jsonl"
+        self.sort_budget = int(sort_budget) if sort_budget is not None else 64 * 2 ** 20
+
+    @classmethod
+    def Parse(cls, text, cfg):
+        """Shard from 'i/n' string, 0 <= i < n, partitioned as set by Shards config"""
+        try:
+            index, count = map(int, text.split('/'))
+        except ValueError:
+            raise Exception(f"Incorrect shard '{text}'. Expected i/n")
+        shards_cfg = cfg.get('Shards', {})
+        return cls(index, count, shards_cfg.get('Partition', "hash"), shards_cfg.get('IdRange'),
+                   shards_cfg.get('PartitionPath'), shards_cfg.get('SortBudget'))
+
+    @staticmethod
+    def PopArg(argv) -> str:
+        """Remove '--shard i/n' from program arguments. Return 'i/n', None if there is no shard argument"""
+        if '--shard' not in argv:
+            return None
+        pos = argv.index('--shard')
+        if pos + 1 >= len(argv):
+            raise SystemExit("Missing shard after --shard. Expected --shard i/n")
+        text = argv[pos + 1]
+        del argv[pos:pos + 2]
+        return text
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+    def contains(self, debt_id) -> bool:
+        if self.partition == "hash":
+            return shardOf(debt_id, self.count) == self.index
+        try:
+            return (self.lo is None or debt_id >= self.lo) and (self.hi is None or debt_id < self.hi)
+        except TypeError:
+            # non-numeric id is not in any range : it goes to first shard, so that it is reported once
+            return self.index == 0
+
+    def rangeParams(self, key) -> dict:
+        """Query params selecting shard's id range by key field, empty for hash partition or open range"""
+        params = {}
+        if self.lo is not None:
+            params[f"{key}_gte"] = self.lo
+        if self.hi is not None:
+            params[f"{key}_lte"] = self.hi - 1
+        return params
+
+    def partitionPath(self) -> str:
+        return self.partition_path.format(index=self.index, count=self.count)
+
+    def writePartition(self, run):
+        """
+        Write partition file of shard : run(out) writes JSON lines to out, returns True if run completed
+        Lines are written in API order to temporary file, sorted by debt id when run completes, so that partitions
+        can be merged whatever the order of Debts table. Failed run leaves no partition
+        Return True if partition is written
+        """
+        path = self.partitionPath()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', buffering=2 ** 20) as out:
+            completed = run(out)
+        if completed:
+            self.sortPartition(tmp_path, path)
+        os.remove(tmp_path)
+        return completed
+
+    def sortPartition(self, src, path):
+        """
+        Write JSON lines of src to partition file ordered by debt id, debts of equal id in src order
+        Lines are sorted out of core within sort budget (ExternalSorter), run files next to partition file
+        """
+        sorter = ExternalSorter(self.sort_budget, os.path.dirname(os.path.abspath(path)))
+        try:
+            with open(src) as lines:
+                for seq, line in enumerate(lines):
+                    if line.strip():
+                        sorter.add([joinKey(json.loads(line)['id']), seq], line)
+            sorter.finish()
+            sorted_path = path + ".sorted.tmp"
+            with open(sorted_path, 'w', buffering=2 ** 20) as out:
+                for _, line in sorter:
+                    out.write(line)
+            os.replace(sorted_path, path)
+        finally:
+            sorter.close()
+
+
+class APIShardAccess:
+    """
+    APIAccess restricted to debts of one shard (ShardSpec) : whole-table iteration and fetch return records of
+    shard's debts only, lookups by id are passed through.
+    Payment plans and payments are filtered by debt ids seen in Debts and PaymentPlans, in fetch modes loading
+    whole tables; per-debt fetch modes query payment plans and payments for the shard's debts only.
+    """
+
+    def __init__(self, api, shard):
+        self.api = api
+        self.cfg = api.cfg
+        self.shard = shard
+        self.planIds = None
+
+    def iterDebts(self, page_size=None):
+        debts = self.api.iterTable(self.api.sessionDebts, page_size, self.shard.rangeParams('id'))
+        return (dbt for dbt in debts if self.shard.contains(dbt.get('id')))
+
+    def iterPaymentPlans(self, page_size=None):
+        """Generator : payment plans of shard's debts, recording their ids for iterPayments"""
+        self.planIds = set()
+        for pp in self.api.iterTable(self.api.sessionPaymentPlans, page_size, self.shard.rangeParams('debt_id')):
+            if self.shard.contains(pp.get('debt_id')):
+                self.planIds.add(pp.get('id'))
+                yield pp
+
+    def iterPayments(self, page_size=None):
+        """Generator : payments of shard's payment plans : payment plans are iterated first, if they were not"""
+        if self.planIds is None:
+            for _ in self.iterPaymentPlans():
+                pass
+        return (pmt for pmt in self.api.iterPayments(page_size) if pmt.get('payment_plan_id') in self.planIds)
+
+    def iterPaymentsSince(self, date, page_size=None):
+        return self.api.iterPaymentsSince(date, page_size)
+
+    def paymentPlanInfo(self, payment_plan, debt_amount):
+        return self.api.paymentPlanInfo(payment_plan, debt_amount)
+
+    def fetchDebtsBatch(self, debt_ids) -> dict:
+        return self.api.fetchDebtsBatch(debt_ids)
+
+    def fetchPaymentPlansBatch(self, debt_ids) -> dict:
+        return self.api.fetchPaymentPlansBatch(debt_ids)
+
+    def fetchPaymentsBatch(self, payment_plan_ids) -> dict:
+        return self.api.fetchPaymentsBatch(payment_plan_ids)
+
+    def fetchDebts(self, debt_id=None) -> list:
+        """fetch Debts table restricted to shard, or debt by id"""
+        if debt_id is not None:
+            return self.api.fetchDebts(debt_id)
+        return list(self.iterDebts())
+
+    def fetchPaymentPlans(self, debt_id=None) -> list:
+        if debt_id is not None:
+            return self.api.fetchPaymentPlans(debt_id)
+        return list(self.iterPaymentPlans())
+
+    def fetchPayments(self, payment_plan_id=None) -> list:
+        if payment_plan_id is not None:
+            return self.api.fetchPayments(payment_plan_id)
+        return list(self.iterPayments())
+
+
+# ============= Partitions : merge
+
+def iterPartition(path):
+    """
+    Generator : (join key of debt id, JSON line) of partition file, checking lines are ordered by debt id,
+    as ShardSpec.writePartition writes them
+    """
+    last_id, last_key = None, None
+    with open(path) as partition:
+        for line in partition:
+            if not line.strip():
+                continue
+            debt_id = json.loads(line)['id']
+            key = joinKey(debt_id)
+            if last_key is not None and key < last_key:
+                raise Exception(f"Partition '{path}' is not ordered by debt id : {debt_id} follows {last_id}. "
+                                f"Partitions are written ordered by ShardSpec.writePartition")
+            last_id, last_key = debt_id, key
+            yield key, line
+
+
+def mergePartitions(paths, out=None) -> int:
+    """
+    Merge partition files written by shards into JSON lines ordered by debt id : identical to single run output
+    when Debts table is in id order. Lines are copied as written by shards. Partitions are read line by line : memory is bounded by one line per
+    partition
+    :param out : text stream, defaults to stdout
+    Return number of lines written
+    """
+    out = sys.stdout if out is None else out
+    nlines = 0
+    for _, line in heapq.merge(*[iterPartition(path) for path in paths], key=lambda item: item[0]):
+        out.write(line if line.endswith("\n") else line + "\n")
+        nlines += 1
+    out.flush()
+    return nlines
+
+
+# ###################################### MAIN ############################################################
+
+if __name__ == '__main__':
+    """
+    Merge partition files of sharded run into JSON lines ordered by debt id
+    Program arguments:
+    :argument1  : output file, or '-' for stdout
+    :argument2+ : partition files written by runs with --shard i/n
+    """
+    if len(sys.argv) < 3:
+        raise SystemExit("Usage : Sharding.py <output file or -> <partition file> ...")
+
+    try:
+        if sys.argv[1] == '-':
+            merged = mergePartitions(sys.argv[2:])
+        else:
+            with open(sys.argv[1], 'w', buffering=2 ** 20) as merged_file:
+                merged = mergePartitions(sys.argv[2:], merged_file)
+    except Exception as err:
+        raise SystemExit(f"Cannot merge partitions : {err}")
+    sys.stderr.write(f"Merged {len(sys.argv) - 2} partitions : {merged} debts\n")
@@ -0,0 +1,281 @@
+import os
+import json
+import heapq
+import shutil
+import weakref
+import tempfile
+from operator import itemgetter
+from JsonStream import jsonLoads
+from ResponseCache import ResponseCache
+
+# approximate bytes held per buffered record, in addition to its JSON line : line object, key and buffer entry
+RecordOverhead = 200
+
+# at most as many run files are merged at once : more runs are merged in several passes
+MaxFanIn = 64
+
+# bytes of file buffer of each run file read by merge, and of run file written : at most RunBuffer, reduced down to
+# MinRunBuffer before fan-in is reduced, so that small budgets do not take many merge passes. Budgets below 3 buffers
+# of MinRunBuffer merge 2 runs at once with smaller buffers
+RunBuffer = 2 ** 16
+MinRunBuffer = 2 ** 12
+
+
+def joinKey(value) -> list:
+    """
+    Sort key of join field value, comparable across value types : numbers, then strings, then other values.
+    Keys are equal when values are equal as dictionary keys of bulk fetch mode (1 == 1.0), whatever their type
+    """
+    if isinstance(value, (int, float)):
+        return [0, value]
+    if isinstance(value, str):
+        return [1, value]
+    return [2, json.dumps(value, sort_keys=True)]
+
+
+class ExternalSorter:
+    """
+    Sort of records by key, with memory bounded by budget : records are buffered as JSON lines, buffer is sorted
+    and spilled to run file whenever it exceeds budget. Runs are merged when sorted records are iterated.
+    Records which fit in budget are never written to disk.
+    File buffers of runs count against budget : buffer size and merge fan-in are set so that buffers of runs merged
+    at once, and of merged run written, fit in budget; buffered records leave room for buffer of spilled run
+    Keys are JSON-serializable and comparable, e.g. lists of joinKey and sequence number
+    """
+
+    def __init__(self, budget, directory, loads=json.loads):
+        self.budget = budget
+        self.directory = directory
+        self.loads = loads
+        self.buffer = []
+        self.nbytes = 0
+        self.runs = []
+        self.fanIn = max(2, min(MaxFanIn, budget // MinRunBuffer - 1))
+        self.runBuffer = max(512, min(RunBuffer, budget // (self.fanIn + 1)))
+        self.stats = {'records': 0, 'runs': 0, 'spilled_bytes': 0, 'peak_buffered_bytes': 0}
+
+    def add(self, key, record):
+        line = json.dumps([key, record], separators=(',', ':'))
+        size = len(line) + RecordOverhead
+        if self.buffer and self.nbytes + size > self.budget - self.runBuffer:
+            self.spill()
+        self.buffer.append((key, line))
+        self.nbytes += size
+        self.stats['records'] += 1
+        self.buffered(self.nbytes)
+
+    def buffered(self, nbytes):
+        self.stats['peak_buffered_bytes'] = max(self.stats['peak_buffered_bytes'], nbytes)
+
+    def spill(self):
+        """Write buffer sorted by key to new run file"""
+        self.buffer.sort(key=itemgetter(0))
+        self.buffered(self.nbytes + self.runBuffer)
+        self.runs.append(self.writeRun(line for _, line in self.buffer))
+        self.buffer, self.nbytes = [], 0
+
+    def writeRun(self, lines) -> str:
+        fd, path = tempfile.mkstemp(suffix=".jsonl", dir=self.directory)
+        with open(fd, 'w', buffering=self.runBuffer) as run:
+            for line in lines:
+                run.write(line + "\n")
+            self.stats['spilled_bytes'] += run.tell()
+        self.stats['runs'] += 1
+        return path
+
+    def iterRun(self, path):
+        with open(path, 'rb', buffering=self.runBuffer) as run:
+            for line in run:
+                yield self.loads(line)
+
+    def finish(self):
+        """End of records : buffer is spilled if runs were spilled, and runs are merged down to fan-in runs"""
+        if self.runs and self.buffer:
+            self.spill()
+        while len(self.runs) > self.fanIn:
+            runs, self.runs = self.runs, []
+            for i in range(0, len(runs), self.fanIn):
+                group = runs[i:i + self.fanIn]
+                self.buffered((len(group) + 1) * self.runBuffer)
+                merged = heapq.merge(*[self.iterRun(path) for path in group], key=itemgetter(0))
+                self.runs.append(self.writeRun(json.dumps(item, separators=(',', ':')) for item in merged))
+                for path in group:
+                    os.remove(path)
+
+    def __iter__(self):
+        """Generator : [key, record] in key order. Call finish first"""
+        if not self.runs:
+            self.buffer.sort(key=itemgetter(0))
+            return (self.loads(line) for _, line in self.buffer)
+        self.buffered(len(self.runs) * self.runBuffer)
+        return heapq.merge(*[self.iterRun(path) for path in self.runs], key=itemgetter(0))
+
+    def close(self):
+        """Remove run files and buffer"""
+        for path in self.runs:
+            os.remove(path)
+        self.runs, self.buffer, self.nbytes = [], [], 0
+
+
+def mergeJoin(left, right):
+    """
+    Generator : (join key, sequence number, left record, right records with equal join key) for each left record
+    Both sorters are ordered by [join key, sequence number] : right records are in sequence order
+    """
+    right = iter(right)
+    pending = next(right, None)
+    last_key, group = None, []
+    for (key, seq), record in left:
+        if key != last_key:
+            group = []
+            while pending is not None and pending[0][0] < key:
+                pending = next(right, None)
+            while pending is not None and pending[0][0] == key:
+                group.append(pending[1])
+                pending = next(right, None)
+            last_key = key
+        yield key, seq, record, group
+
+
+class APISpillAccess:
+    """
+    APIAccess-compatible access used by 'spill' fetch mode : bulk join of the 3 tables with memory bounded by budget,
+    for portfolios which do not fit in memory
+
+    Each table is streamed page by page and sorted by join key out of core (ExternalSorter) : Payments are
+    merge-joined to PaymentPlans on payment_plan_id, PaymentPlans with their payments to Debts on debt_id, then
+    joined debts are sorted back in API order. Debts are iterated from joined records : payment plans and payments
+    of current debt are served from its record, lookups for other debts are delegated to API.
+    Shard run (ShardSpec, Sharding.py) iterates debts and payment plans of shard's debts; payments of other shards'
+    payment plans have no payment plan to join to and are dropped by merge join : no set of shard's payment plan
+    ids is kept, unlike APIShardAccess.
+    Memory is bounded by budget, pages of tables and records of one debt; run files are written to temporary
+    directory, removed when access is released. Tables which are not paged (Tables.<table>.PageSize) are streamed
+    as response body is decoded, or paged by Spill.PageSize when response would be read whole (Decode.Streaming
+    disabled, or responses cached)
+
+    Config settings (all optional) :
+        Spill.MemoryBudget : bytes of records and run file buffers in memory, shared by sorts in progress,
+                             defaults to 64MB
+        Spill.Directory    : directory of run files, defaults to system temporary directory
+        Spill.PageSize     : page size of tables which are not paged and not streamed, defaults to 1000
+    """
+
+    # sorts in progress at once : 2 joined tables and sort of join result
+    Sorts = 3
+
+    def __init__(self, api, shard=None):
+        self.api = api
+        self.shard = shard
+        self.cfg = api.cfg
+        spill_cfg = self.cfg.get('Spill', {})
+        self.budget = int(spill_cfg.get('MemoryBudget', 64 * 2 ** 20))
+        self.pageSize = int(spill_cfg.get('PageSize', 1000))
+        self.directory = tempfile.mkdtemp(prefix="debt_spill_", dir=spill_cfg.get('Directory'))
+        self.finalizer = weakref.finalize(self, shutil.rmtree, self.directory, True)
+        self.loads = jsonLoads(self.cfg)
+        self.sortStats = []
+        self.joined = None
+        self.currentKey, self.currentPlans = None, []
+
+    @classmethod
+    def Load(cls, api, shard=None):
+        """
+        Load and join all 3 tables from API : 3 requests regardless of number of debts, unless tables are paged
+        :param shard : ShardSpec, restricts debts and payment plans to shard's debts. Optional
+        """
+        access = cls(api, shard)
+        access.join()
+        return access
+
+    def tablePageSize(self, table):
+        """
+        Page size of table iteration : None to iterate table as configured, when table is paged or its response
+        is streamed, else Spill.PageSize, so that whole table is never read before it is spilled
+        """
+        streamed = self.cfg.get('Decode', {}).get('Streaming', True) and not ResponseCache.Enabled(self.cfg)
+        if streamed or self.cfg.get('Tables', {}).get(table, {}).get('PageSize'):
+            return None
+        return self.pageSize
+
+    def iterShard(self, session, key_field):
+        """Generator : records of table whose key field is debt id of shard, all records if no shard"""
+        if self.shard is None:
+            return self.api.iterTable(session, self.tablePageSize(session.table))
+        records = self.api.iterTable(session, self.tablePageSize(session.table), self.shard.rangeParams(key_field))
+        return (rec for rec in records if self.shard.contains(rec.get(key_field)))
+
+    def sorter(self) -> ExternalSorter:
+        sorter = ExternalSorter(self.budget // APISpillAccess.Sorts, self.directory, self.loads)
+        self.sortStats.append(sorter.stats)
+        return sorter
+
+    def sort(self, records, key_field) -> ExternalSorter:
+        """Sort records by [join key of key field, sequence number]"""
+        sorter = self.sorter()
+        for seq, rec in enumerate(records):
+            sorter.add([joinKey(rec.get(key_field)), seq], rec)
+        sorter.finish()
+        return sorter
+
+    def join(self):
+        # payment plans with their payments, by debt id
+        # payments of all payment plans : payments of plans not in shard are not joined
+        plans = self.sort(self.iterShard(self.api.sessionPaymentPlans, 'debt_id'), 'id')
+        payments = self.sort(self.api.iterPayments(self.tablePageSize('Payments')), 'payment_plan_id')
+        plans_by_debt = self.sorter()
+        for _, seq, pp, pmts in mergeJoin(plans, payments):
+            plans_by_debt.add([joinKey(pp.get('debt_id')), seq], {'plan': pp, 'payments': pmts})
+        plans_by_debt.finish()
+        plans.close()
+        payments.close()
+
+        # debts with their payment plans, in API order
+        debts = self.sort(self.iterShard(self.api.sessionDebts, 'id'), 'id')
+        self.joined = self.sorter()
+        for key, seq, dbt, dbt_plans in mergeJoin(debts, plans_by_debt):
+            self.joined.add([seq], {'key': key, 'debt': dbt, 'plans': dbt_plans})
+        self.joined.finish()
+        debts.close()
+        plans_by_debt.close()
+
+    def spillStats(self) -> dict:
+        """Records sorted, run files and bytes spilled, peak bytes of records and file buffers of any sort"""
+        return {'records': sum(stats['records'] for stats in self.sortStats),
+                'runs': sum(stats['runs'] for stats in self.sortStats),
+                'spilled_bytes': sum(stats['spilled_bytes'] for stats in self.sortStats),
+                'peak_buffered_bytes': max([stats['peak_buffered_bytes'] for stats in self.sortStats], default=0)}
+
+    def iterDebts(self, page_size=None):
+        """Generator : iterate over joined debts in API order, setting payment plans and payments of current debt"""
+        for _, joined in self.joined:
+            self.currentKey, self.currentPlans = joined['key'], joined['plans']
+            yield joined['debt']
+        self.currentKey, self.currentPlans = None, []
+
+    def fetchDebts(self, debt_id=None) -> list:
+        return self.api.fetchDebts(debt_id)
+
+    def fetchDebtsBatch(self, debt_ids) -> dict:
+        return self.api.fetchDebtsBatch(debt_ids)
+
+    def fetchPaymentPlans(self, debt_id=None) -> list:
+        if debt_id is None or joinKey(debt_id) != self.currentKey:
+            return self.api.fetchPaymentPlans(debt_id)
+        return [plan['plan'] for plan in self.currentPlans]
+
+    def fetchPayments(self, payment_plan_id=None) -> list:
+        if payment_plan_id is not None:
+            key = joinKey(payment_plan_id)
+            for plan in self.currentPlans:
+                if joinKey(plan['plan'].get('id')) == key:
+                    return plan['payments']
+        return self.api.fetchPayments(payment_plan_id)
+
+    def paymentPlanInfo(self, payment_plan, debt_amount):
+        """Payment plan info is not precomputed : None, caller computes it from payments of current debt"""
+        return None
+
+    def close(self):
+        """Remove run files"""
+        self.finalizer()
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import random
+import datetime
+
+# records hold plain values only : no datetime encoding or circular reference checks needed
+encodeRecord = json.JSONEncoder(check_circular=False).encode
+
+
+class PortfolioGenerator:
+    """
+    Seeded generator of Debts DB for scale testing : Debts, PaymentPlans and Payments tables in the same format
+    as Debts DB API. Records are generated debt by debt in one pass, so tables of any size are written to files
+    without being held in memory. Same seed and settings produce the same tables.
+
+    Each debt is in payment plan with probability PlanCoverage. Payment plan has random number of installments,
+    WEEKLY / BI_WEEKLY frequency mix and start date such that payments made are dated before AsOf date.
+    Paid off payment plans have all installments paid, the last installment paying the remainder;
+    other payment plans have fewer payments than installments.
+    Amounts are multiples of 0.25, exact in floating point : remaining amount of paid off debt is exactly 0.
+
+    Rare corruption cases, with probability CorruptionRate per debt :
+        multiple_plans     : debt has two payment plans
+        bad_debt_amount    : debt amount is not a number
+        bad_payment_amount : payment amount is not a number
+
+    Config settings (all optional), Synthetic section :
+        Seed           : random seed, defaults to 1
+        AsOf           : date all payments are made before, defaults to "2021-01-28"
+        PlanCoverage   : share of debts in payment plan, defaults to 0.6
+        Frequencies    : { installment frequency : weight }, defaults to WEEKLY 0.7, BI_WEEKLY 0.3
+        Installments   : [min, max] number of installments per payment plan, defaults to [4, 26]
+        PaidOffRate    : share of payment plans paid off, defaults to 0.2
+        CorruptionRate : share of debts with corrupt data, defaults to 0
+    """
+
+    Files = {'Debts': 'debts', 'PaymentPlans': 'payment_plans', 'Payments': 'payments'}
+    Corruptions = ['multiple_plans', 'bad_debt_amount', 'bad_payment_amount']
+    BadAmounts = ["N/A", "", None, "12,50"]
+
+    def __init__(self, cfg, ndebts, seed=None):
+        """
+        :param ndebts : number of debts, with ids 0..ndebts-1
+        :param seed   : random seed, defaults to Synthetic.Seed config setting
+        """
+        synthetic_cfg = cfg.get('Synthetic', {})
+        self.ndebts = ndebts
+        self.seed = synthetic_cfg.get('Seed', 1) if seed is None else seed
+        self.as_of = datetime.date.fromisoformat(synthetic_cfg.get('AsOf', "2021-01-28"))
+        self.plan_coverage = float(synthetic_cfg.get('PlanCoverage', 0.6))
+        frequencies = synthetic_cfg.get('Frequencies', {"WEEKLY": 0.7, "BI_WEEKLY": 0.3})
+        self.frequencies = list(frequencies)
+        self.frequency_weights = [float(weight) for weight in frequencies.values()]
+        self.min_installments, self.max_installments = map(int, synthetic_cfg.get('Installments', [4, 26]))
+        self.paid_off_rate = float(synthetic_cfg.get('PaidOffRate', 0.2))
+        self.corruption_rate = float(synthetic_cfg.get('CorruptionRate', 0.0))
+        self.frequency_to_days = cfg.get("Tables", {}).get("PaymentPlans", {}) \
+                                    .get("FrequencyToDays", {"WEEKLY": 7, "BI_WEEKLY": 14})
+
+    # ============= PortfolioGenerator : records
+    def records(self):
+        """Iterate over (table, record) : each debt, followed by its payment plans and their payments"""
+        rnd = random.Random(self.seed)
+        plan_id = 0
+        for debt_id in range(self.ndebts):
+            corruption = rnd.choice(PortfolioGenerator.Corruptions) if rnd.random() < self.corruption_rate else None
+
+            # debt amount, in quarters of dollar
+            amount = rnd.randint(200, 20000) / 4
+            yield 'Debts', {"amount": rnd.choice(PortfolioGenerator.BadAmounts)
+                            if corruption == 'bad_debt_amount' else amount, "id": debt_id}
+
+            # corrupt payment plans and payments are generated for debts in payment plan only
+            if corruption not in ['multiple_plans', 'bad_payment_amount'] and rnd.random() >= self.plan_coverage:
+                continue
+            for _ in range(2 if corruption == 'multiple_plans' else 1):
+                yield from self.paymentPlan(rnd, plan_id, debt_id, amount, corruption == 'bad_payment_amount')
+                plan_id += 1
+
+    def paymentPlan(self, rnd, plan_id, debt_id, amount, bad_payment_amount):
+        """Iterate over (table, record) : payment plan, followed by its payments"""
+        frequency = rnd.choices(self.frequencies, self.frequency_weights)[0]
+        period = self.frequency_to_days.get(frequency, 7)
+        ninstallments = rnd.randint(self.min_installments, self.max_installments)
+        installment = max(amount / ninstallments // 0.25 * 0.25, 0.25)
+        npayments = ninstallments if rnd.random() < self.paid_off_rate \
+            else rnd.randint(1 if bad_payment_amount else 0, ninstallments - 1)
+
+        # last payment is made up to one period before AsOf date
+        start_date = self.as_of - datetime.timedelta(days=npayments * period + rnd.randint(1, period))
+        yield 'PaymentPlans', {"amount_to_pay": amount, "debt_id": debt_id, "id": plan_id,
+                               "installment_amount": installment, "installment_frequency": frequency,
+                               "start_date": start_date.isoformat()}
+
+        paid = 0.0
+        bad_payment = rnd.randrange(npayments) if bad_payment_amount else None
+        for i in range(npayments):
+            pmt_amount = installment if i < ninstallments - 1 else amount - paid
+            paid += pmt_amount
+            yield 'Payments', {"amount": rnd.choice(PortfolioGenerator.BadAmounts) if i == bad_payment
+                               else pmt_amount,
+                               "date": (start_date + datetime.timedelta(days=i * period)).isoformat(),
+                               "payment_plan_id": plan_id}
+
+    def tables(self) -> tuple:
+        """Generate tables in memory. Return (debts, payment plans, payments)"""
+        tables = {table: [] for table in PortfolioGenerator.Files}
+        for table, record in self.records():
+            tables[table].append(record)
+        return tuple(tables.values())
+
+    # ============= PortfolioGenerator : files
+    def write(self, directory, fmt="jsonl") -> dict:
+        """
+        Write tables to debts, payment_plans and payments files in directory, as records are generated
+        :param fmt : jsonl - one JSON object per line
+                     json  - JSON array, one record per line
+        Return { table : number of records written }
+        """
+        os.makedirs(directory, exist_ok=True)
+        files = {table: open(os.path.join(directory, f"{name}.{fmt}"), 'w', buffering=2 ** 20)
+                 for table, name in PortfolioGenerator.Files.items()}
+        counts = dict.fromkeys(files, 0)
+        try:
+            for table, record in self.records():
+                if fmt == "json":
+                    files[table].write(",\n" if counts[table] else "[\n")
+                    files[table].write(encodeRecord(record))
+                else:
+                    files[table].write(encodeRecord(record) + "\n")
+                counts[table] += 1
+            if fmt == "json":
+                for table, out in files.items():
+                    out.write("\n]\n" if counts[table] else "[]\n")
+        finally:
+            for out in files.values():
+                out.close()
+        return counts
+
+
+# ============= Generated tables : load
+
+def iterTableFile(path):
+    """Iterate over records of JSON lines file, or of JSON array file"""
+    with open(path) as table_file:
+        if path.endswith(".json"):
+            yield from json.load(table_file)
+        else:
+            for line in table_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def loadTables(directory) -> tuple:
+    """Load tables written by PortfolioGenerator. Return (debts, payment plans, payments)"""
+    tables = []
+    for name in PortfolioGenerator.Files.values():
+        path = os.path.join(directory, f"{name}.jsonl")
+        if not os.path.exists(path):
+            path = os.path.join(directory, f"{name}.json")
+        tables.append(list(iterTableFile(path)))
+    return tuple(tables)
+
+
+# ###################################### MAIN ############################################################
+
+if __name__ == '__main__':
+    """
+    Write synthetic Debts DB to directory
+    Program arguments:
+    :argument1 : path to config file or '-'. Optional. Defaults to "debt_config"
+    :argument2 : number of debts. Optional. Defaults to 1000
+    :argument3 : output directory. Optional. Defaults to "synthetic"
+    :argument4 : file format, jsonl or json. Optional. Defaults to jsonl
+    :argument5 : random seed. Optional. Defaults to Synthetic.Seed config setting
+    """
+
+    def arg(argn, dflt, convert=str):
+        return convert(sys.argv[argn]) if len(sys.argv) > argn and sys.argv[argn] != '-' else dflt
+
+    cfg_path = arg(1, "debt_config")
+    try:
+        with open(cfg_path) as cfg_file:
+            config = json.load(cfg_file)
+    except Exception as err:
+        raise SystemExit(f"Cannot open config file : {err}")
+
+    out_fmt = arg(4, "jsonl")
+    if out_fmt not in ["jsonl", "json"]:
+        raise SystemExit(f"Unknown file format '{out_fmt}'. Expected jsonl or json")
+
+    out_dir = arg(3, "synthetic")
+    written = PortfolioGenerator(config, arg(2, 1000, int), arg(5, None, int)).write(out_dir, out_fmt)
+    print(f"Written to {out_dir} : " + ", ".join(f"{table} {count}" for table, count in written.items()))
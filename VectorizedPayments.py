@@ -0,0 +1,179 @@
+from itertools import repeat
+from DateParser import DateParser
+
+# NumPy is optional : without it, remaining amounts are computed per debt
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class PaymentColumns:
+    """
+    Payments table as column arrays : payment plan index (int64), amount (float64), date (datetime64)
+    Remaining amounts of all payment plans are computed at once with masked group-by over columns.
+
+    Payments with invalid amount or date are marked invalid : remaining amount of their payment plan
+    is not computed, so that per-debt calculation reports the error.
+
+    Config settings (all optional) :
+        Vectorized.Enabled : false to compute remaining amounts per debt, defaults to true
+    """
+
+    @staticmethod
+    def Available(cfg) -> bool:
+        return np is not None and bool(cfg.get('Vectorized', {}).get('Enabled', True))
+
+    def __init__(self, cfg, payments, plan_index):
+        """
+        :param payments   : list of payments
+        :param plan_index : { payment plan id : index of payment plan }, payments of other plans are ignored
+        """
+        plans = np.fromiter(map(plan_index.get, [pmt.get('payment_plan_id') for pmt in payments], repeat(-1)),
+                            np.int64, len(payments))
+        self.load(cfg, len(plan_index), plans, [pmt.get('amount') for pmt in payments],
+                  [pmt.get('date') for pmt in payments])
+
+    @classmethod
+    def FromColumns(cls, cfg, nplans, plans, amounts, dates):
+        """
+        :param plans   : int64 array of payment plan indexes, -1 for payments of other plans
+        :param amounts : payment amounts as in Payments table
+        :param dates   : payment dates as in Payments table
+        """
+        columns = cls.__new__(cls)
+        columns.load(cfg, nplans, plans, amounts, dates)
+        return columns
+
+    def load(self, cfg, nplans, plans, amounts, dates):
+        self.nplans = nplans
+        self.plan = plans
+        self.amount, amount_valid = PaymentColumns.floatColumn(amounts)
+        self.date, date_valid = PaymentColumns.dateColumn(dates, DateParser.Instance(cfg))
+        self.valid = amount_valid & date_valid
+
+    @staticmethod
+    def floatColumn(values) -> tuple:
+        """Column of values converted by float : (float64 array, valid mask)"""
+        try:
+            return np.fromiter(map(float, values), np.float64, len(values)), np.ones(len(values), dtype=bool)
+        except (TypeError, ValueError):
+            column, valid = np.zeros(len(values)), np.ones(len(values), dtype=bool)
+            for i, value in enumerate(values):
+                try:
+                    column[i] = float(value)
+                except (TypeError, ValueError):
+                    valid[i] = False
+            return column, valid
+
+    @staticmethod
+    def dateColumn(values, parser) -> tuple:
+        """Column of dates : (datetime64 array, valid mask). Each distinct date string is parsed once"""
+        try:
+            codes = {value: code for code, value in enumerate(set(values))}
+        # unhashable values, e.g. lists, are invalid dates
+        except TypeError:
+            values = [value if isinstance(value, str) else None for value in values]
+            codes = {value: code for code, value in enumerate(set(values))}
+        date_codes = np.fromiter(map(codes.__getitem__, values), np.int64, len(values))
+
+        distinct = np.full(len(codes), np.datetime64('NaT'), dtype='datetime64[us]')
+        distinct_valid = np.zeros(len(codes), dtype=bool)
+        for sdate, code in codes.items():
+            try:
+                distinct[code] = np.datetime64(parser.parse(sdate), 'us')
+                distinct_valid[code] = True
+            except Exception:
+                pass
+        return distinct[date_codes], distinct_valid[date_codes]
+
+    def remainingAmounts(self, amounts, today):
+        """
+        Remaining amount of each payment plan : debt amount less payments made before today
+        :param amounts : float64 array of debt amounts, by payment plan index
+        Return (remaining amounts, computed mask) by payment plan index
+        """
+        in_plan = self.plan >= 0
+        computed = np.ones(self.nplans, dtype=bool)
+        computed[self.plan[in_plan & ~self.valid]] = False
+
+        # bincount sums weights in order : debt amount first, then payments in table order,
+        # so result is the same as subtracting payments one by one
+        paid = in_plan & self.valid & (self.date < np.datetime64(today, 'us'))
+        index = np.concatenate([np.arange(self.nplans, dtype=np.int64), self.plan[paid]])
+        weights = np.concatenate([amounts, -self.amount[paid]])
+        return np.bincount(index, weights, minlength=self.nplans), computed
+
+    def paymentCounts(self):
+        """Number of payments of each payment plan, by payment plan index"""
+        return np.bincount(self.plan[self.plan >= 0], minlength=self.nplans)
+
+
+class PaymentSchedule:
+    """
+    Payment plans as column arrays : start date (datetime64), installment period in days (int64)
+    Next payment due dates of all payment plans are computed at once.
+
+    Payment plans with invalid start date or unrecognized installment frequency are marked invalid :
+    their next payment due date is not computed, so that per-debt calculation reports the error.
+    """
+
+    def __init__(self, cfg, plans):
+        self.load(cfg, [pp.get('start_date') for pp in plans], [pp.get('installment_frequency') for pp in plans])
+
+    @classmethod
+    def FromColumns(cls, cfg, start_dates, frequencies):
+        """
+        :param start_dates : start dates as in PaymentPlans table, by payment plan index
+        :param frequencies : installment frequencies as in PaymentPlans table, by payment plan index
+        """
+        schedule = cls.__new__(cls)
+        schedule.load(cfg, start_dates, frequencies)
+        return schedule
+
+    def load(self, cfg, start_dates, frequencies):
+        self.start, start_valid = PaymentColumns.dateColumn(start_dates, DateParser.Instance(cfg))
+
+        # frequency is looked up in config once per distinct frequency
+        frequency_to_days = cfg["Tables"]["PaymentPlans"]["FrequencyToDays"]
+        periods = {}
+        for frequency in frequencies:
+            if isinstance(frequency, str) and frequency not in periods:
+                periods[frequency] = frequency_to_days.get(frequency)
+        self.period = np.fromiter((periods.get(frequency) or 0 if isinstance(frequency, str) else 0
+                                   for frequency in frequencies), np.int64, len(frequencies))
+        self.valid = start_valid & (self.period > 0)
+
+    def nextPaymentDueDates(self, today):
+        """
+        First date in payment schedule after or including today, by payment plan index
+        Return (datetime64 array, computed mask)
+        """
+        start = np.where(self.valid, self.start, np.datetime64(today, 'us'))
+        period = np.where(self.valid, self.period, 1)
+
+        # elapsed whole days, rounded down as timedelta.days; periods to next payment rounded up
+        elapsed_days = (np.datetime64(today, 'us') - start) // np.timedelta64(1, 'D')
+        periods_to_next_pmt = -(-elapsed_days // period)
+        return start + (periods_to_next_pmt * period).astype('timedelta64[D]'), self.valid
+
+
+def paymentPlanInfoColumns(cfg, today, amounts, start_dates, frequencies, payment_plans, payment_amounts,
+                           payment_dates) -> tuple:
+    """
+    Remaining amounts and next payment due dates of payment plans as of today, from table columns
+    :param amounts       : debt amount of each payment plan, as in Debts table
+    :param start_dates   : start date of each payment plan
+    :param frequencies   : installment frequency of each payment plan
+    :param payment_plans : int64 array of payment plan index of each payment, -1 for payments of other plans
+    Return (remaining amounts, next payment due dates or NaT if paid off, computed mask) by payment plan index
+    """
+    amounts, amounts_valid = PaymentColumns.floatColumn(amounts)
+    columns = PaymentColumns.FromColumns(cfg, len(amounts), payment_plans, payment_amounts, payment_dates)
+    remaining, payments_valid = columns.remainingAmounts(amounts, today)
+    next_due, schedule_valid = PaymentSchedule.FromColumns(cfg, start_dates, frequencies).nextPaymentDueDates(today)
+
+    # debt with payments made is paid off : no next payment due
+    paid_off = (columns.paymentCounts() > 0) & (remaining == 0)
+    next_due = np.where(paid_off, np.datetime64('NaT'), next_due)
+    return remaining, next_due, amounts_valid & payments_valid & schedule_valid
@@ -1,14 +1,64 @@
+import io
+import os
+import re
+import sys
+import pstats
+import json
+import time
+import random
+import subprocess
 import pytest
 import responses
 import datetime
+from urllib.parse import urlsplit, parse_qs
+from responses import matchers
 from APIAccess import *
-from DebtFunctional import runDebtFunctional
-from DebtObjectOriented import runDebtObjectOriented_LoadIds, runDebtObjectOriented_GenerateIds
+from DebtFunctional import runDebtFunctional, addPaymentPlanExtraInfo, enrichDebts
+from DebtObjectOriented import runDebtObjectOriented_LoadIds, runDebtObjectOriented_GenerateIds, \
+    DebtRecord, DebtRecordExtra, DebtTable, loadDebtRecords
+from JsonLines import writeJsonLines
+from CircuitBreaker import CircuitBreaker
+from DateParser import DateParser
+from MockServer import MockServer
+from SyntheticData import PortfolioGenerator, loadTables
+from Metrics import LatencyHistogram
+from Hooks import Hooks, Profiler
+from ProcessShards import APIShardedAccess, shardColumns
+from Sharding import ShardSpec, shardOf, mergePartitions
+from JsonStream import decodeChunks, jsonLoads, orjson
+from SQLiteMirror import SQLiteMirror
+from IncrementalState import IncrementalState
+import SpillJoin
+from SpillJoin import APISpillAccess
 
 # ====== Test Config ===============================================
 
 config = {
     "RetryConnection": 3,
+    "Async": {
+        "MaxConcurrency": 4
+    },
+    "Threads": {
+        "MaxWorkers": 4
+    },
+    "Batch": {
+        "Size": 2,
+        "MaxURLLength": 2000
+    },
+    "IdScan": {
+        "MaxGap": 3
+    },
+    "Processes": {
+        "MaxWorkers": 2,
+        "Shards": 3
+    },
+    # no delay between retries; circuit breaker is disabled, as API instance is shared between tests
+    "Retry": {
+        "BackoffBase": 0
+    },
+    "CircuitBreaker": {
+        "FailureThreshold": 0
+    },
     "DateFormats": ["%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%d"],
     "URL": {
         "Debts": "https://my-json-server.typicode.com/druska/trueaccord-mock-payments-api/debts",
@@ -58,6 +108,69 @@ Payments = [
     {"amount": 1230.085, "date": "2020-08-15", "payment_plan_id": 3}
 ]
 
+def mockQueries(debts, plans, payments):
+    """Mock parametrized queries to PaymentPlans per debt id and to Payments per payment plan id"""
+    responses.add(responses.GET,
+                  config['URL']['Debts'],
+                  json=debts,
+                  content_type="application/json")
+    for dbt in debts:
+        responses.add(responses.GET,
+                      config['URL']['PaymentPlans'] + f"?debt_id={dbt['id']}",
+                      json=[pp for pp in plans if pp['debt_id'] == dbt['id']],
+                      content_type="application/json")
+    for pp in plans:
+        responses.add(responses.GET,
+                      config['URL']['Payments'] + f"?payment_plan_id={pp['id']}",
+                      json=[pmt for pmt in payments if pmt['payment_plan_id'] == pp['id']],
+                      content_type="application/json")
+
+
+def mockFilteredTables(debts, plans, payments):
+    """
+    Mock all 3 tables, filtering records by query params as json-server does :
+    repeated params (debt_id=0&debt_id=1) select records matching any of the values,
+    params with _gte suffix (date_gte=2021-01-01) select records with value greater or equal
+    """
+
+    def matches(rec, key, values):
+        if key.endswith('_gte'):
+            return str(rec.get(key[:-4])) >= values[0]
+        return str(rec.get(key)) in values
+
+    def table_callback(data):
+        def callback(request):
+            params = parse_qs(urlsplit(request.url).query)
+            rs = [rec for rec in data if all(matches(rec, key, values) for key, values in params.items())]
+            return 200, {}, json.dumps(rs)
+
+        return callback
+
+    for table, data in [('Debts', debts), ('PaymentPlans', plans), ('Payments', payments)]:
+        responses.add_callback(responses.GET,
+                               re.compile(re.escape(config['URL'][table]) + r"(\?.*)?$"),
+                               callback=table_callback(data),
+                               content_type="application/json")
+
+
+# Expected output of base case for both simple and extra info
+BaseCaseOutput = \
+    "[{'amount': 123.46, 'id': 0, 'in_payment_plan': True}, " \
+    "{'amount': 100.0, 'id': 1, 'in_payment_plan': True}, " \
+    "{'amount': 4920.34, 'id': 2, 'in_payment_plan': True}, " \
+    "{'amount': 12938.0, 'id': 3, 'in_payment_plan': True}, " \
+    "{'amount': 9238.02, 'id': 4, 'in_payment_plan': False}]\n" \
+    "[{'amount': 123.46, 'id': 0, 'in_payment_plan': True, 'remaining_amount': 20.959999999999994, " \
+    "'next_payment_due_date': datetime.datetime(2021, 2, 1, 0, 0)}, " \
+    "{'amount': 100.0, 'id': 1, 'in_payment_plan': True, 'remaining_amount': 50.0, " \
+    "'next_payment_due_date': datetime.datetime(2021, 1, 30, 0, 0)}, " \
+    "{'amount': 4920.34, 'id': 2, 'in_payment_plan': True, 'remaining_amount': 607.6700000000001, " \
+    "'next_payment_due_date': datetime.datetime(2021, 2, 10, 0, 0)}, " \
+    "{'amount': 12938.0, 'id': 3, 'in_payment_plan': True, 'remaining_amount': 9247.745000000003, " \
+    "'next_payment_due_date': datetime.datetime(2021, 1, 30, 0, 0)}, " \
+    "{'amount': 9238.02, 'id': 4, 'in_payment_plan': False, 'remaining_amount': 9238.02, " \
+    "'next_payment_due_date': None}]\n"
+
 
 # ====== Test APIAccess ============================================
 
@@ -93,13 +206,673 @@ def test_APIAccess_HTTPResponseStatus(capfd, status, error):
     assert out == output
 
 
+# ====== Test Retries and Circuit Breaker ==========================
+
+def breakerConfig(threshold):
+    return dict(config,
+                Retry={"BackoffBase": 0.5, "BackoffMax": 0.75},
+                CircuitBreaker={"FailureThreshold": threshold, "CoolDown": 30},
+                Tables=dict(config['Tables'], Debts={"Timeout": {"Connect": 1, "Read": 5}}))
+
+
+@responses.activate
+def test_Retry_BackoffWithJitter(monkeypatch):
+    """ Test connection errors are retried with exponential backoff with jitter, capped by BackoffMax """
+    # === Mock Responses
+    responses.add(responses.GET, config['URL']['Debts'], body=requests.exceptions.ConnectionError("refused"))
+    delays = []
+    monkeypatch.setattr(APIAccess.APISession, 'sleep', staticmethod(delays.append))
+
+    # === Assertions
+    api = APIAccess(breakerConfig(0))
+    with pytest.raises(Exception, match="Error fetching data from Debts for no params: refused"):
+        api.fetchDebts()
+
+    assert len(responses.calls) == 3
+    assert len(delays) == 2
+    assert 0 <= delays[0] <= 0.5 and 0 <= delays[1] <= 0.75
+    assert api.sessionDebts.timeout == (1.0, 5.0)
+    assert api.retryStats()['Debts'] == {'requests': 3, 'retries': 2, 'failures': 3, 'fast_failures': 0,
+                                         'breaker': {'state': 'closed', 'opens': 0}}
+
+
+@responses.activate
+def test_CircuitBreaker_FailFast(monkeypatch):
+    """ Test circuit breaker opens after consecutive failures, and further requests fail without reaching API """
+    # === Mock Responses
+    responses.add(responses.GET, config['URL']['Debts'], status=503)
+    monkeypatch.setattr(APIAccess.APISession, 'sleep', staticmethod(lambda delay: None))
+
+    # === Assertions
+    api = APIAccess(breakerConfig(2))
+    for _ in range(2):
+        with pytest.raises(Exception, match="503 Server Error"):
+            api.fetchDebts()
+    with pytest.raises(Exception, match="Error fetching data from Debts for no params: circuit breaker open"):
+        api.fetchDebts()
+
+    assert len(responses.calls) == 2
+    assert api.retryStats()['Debts']['fast_failures'] == 1
+    assert api.retryStats()['Debts']['breaker'] == {'state': 'open', 'opens': 1}
+
+
+def test_CircuitBreaker_HalfOpenProbe():
+    """ Test circuit breaker lets single probe request through after cool-down, and closes on its success """
+    now = [0]
+    breaker = CircuitBreaker({"CircuitBreaker": {"FailureThreshold": 2, "CoolDown": 30}}, clock=lambda: now[0])
+
+    breaker.recordFailure()
+    assert breaker.allowRequest()
+    breaker.recordFailure()
+    assert not breaker.allowRequest()
+
+    # cool-down elapsed : one probe, failure opens breaker again
+    now[0] = 30
+    assert breaker.allowRequest()
+    assert not breaker.allowRequest()
+    breaker.recordFailure()
+    assert not breaker.allowRequest()
+
+    # probe succeeds : breaker closes
+    now[0] = 60
+    assert breaker.allowRequest()
+    breaker.recordSuccess()
+    assert breaker.allowRequest() and breaker.allowRequest()
+    assert breaker.stats() == {'state': 'closed', 'opens': 2}
+
+
+@responses.activate
+def test_CircuitBreaker_ClientErrorProbe(monkeypatch):
+    """
+    Test probe answered with client error closes breaker, as API is reachable; probe ended without success or
+    failure is released, so that next request probes
+    """
+    # === Mock Responses
+    responses.add(responses.GET, config['URL']['Debts'], status=503)
+    responses.add(responses.GET, config['URL']['Debts'], status=404)
+    responses.add(responses.GET, config['URL']['Debts'], json=Debts)
+    monkeypatch.setattr(APIAccess.APISession, 'sleep', staticmethod(lambda delay: None))
+
+    # === Assertions
+    api = APIAccess(breakerConfig(1))
+    breaker = api.sessionDebts.breaker
+    with pytest.raises(Exception, match="503 Server Error"):
+        api.fetchDebts()
+    breaker.opened_at -= 30
+    with pytest.raises(Exception, match="404 Client Error"):
+        api.fetchDebts()
+    assert api.fetchDebts() == Debts
+    assert breaker.stats() == {'state': 'closed', 'opens': 1}
+
+    breaker.recordFailure()
+    breaker.opened_at -= 30
+    assert breaker.allowRequest() and not breaker.allowRequest()
+    breaker.releaseProbe()
+    assert breaker.allowRequest()
+
+
+# ====== Test Date Parser ==========================================
+
+@pytest.mark.parametrize("sdate, expected", [
+    ("2020-08-01", datetime.datetime(2020, 8, 1)),
+    ("2020-08-01T10:20:30Z", datetime.datetime(2020, 8, 1, 10, 20, 30)),
+    ("2020-8-1", datetime.datetime(2020, 8, 1)),
+])
+def test_DateParser_SameAsStrptime(sdate, expected):
+    """ Test ISO fast path and strptime fallback parse dates as strptime does """
+    assert DateParser().parse(sdate) == expected
+
+
+@pytest.mark.parametrize("sdate, error", [
+    (None, "Payment : invalid date value : 'None'"),
+    ("2020-02-30", "Payment : unrecognized date format '2020-02-30'"),
+    ("08/01/2020", "Payment : unrecognized date format '08/01/2020'"),
+    ("2020-08-01\n", "Payment : unrecognized date format '2020-08-01\n'"),
+    ("2020-08-01T10:20:30Z\n", "Payment : unrecognized date format '2020-08-01T10:20:30Z\n'"),
+])
+def test_DateParser_InvalidDate(sdate, error):
+    """ Test invalid and unrecognized dates raise exception """
+    with pytest.raises(Exception, match=re.escape(error)):
+        DateParser().parse(sdate, "Payment")
+
+
+def test_DateParser_ConfiguredFormatsMemoized():
+    """ Test parser uses DateFormats config setting, and parses repeated dates once """
+    parser = DateParser.Instance(dict(config, DateFormats=["%d/%m/%Y"], DateParser={"CacheSize": 2}))
+    assert parser is DateParser.Instance(dict(config, DateFormats=["%d/%m/%Y"], DateParser={"CacheSize": 2}))
+
+    for sdate in ["01/08/2020", "08/08/2020", "01/08/2020", "01/08/2020"]:
+        parser.parse(sdate)
+    assert parser.parse("15/08/2020") == datetime.datetime(2020, 8, 15)
+    assert parser.stats() == {'hits': 2, 'misses': 3, 'size': 2}
+
+    with pytest.raises(Exception, match="unrecognized date format '2020-08-01'"):
+        parser.parse("2020-08-01")
+
+
+# ====== Test Connection Pool ======================================
+
+@pytest.fixture
+def mockServer():
+    with MockServer((Debts, PaymentPlans, Payments)) as server:
+        yield server
+
+
+def test_ConnectionPool_SharedAcrossSessions():
+    """ Test sessions of all tables share single HTTP adapter configured from Pool settings """
+    api = APIAccess(dict(config, Pool={"MaxSize": 5, "Connections": 2}))
+    adapters = {id(session.session.get_adapter(config['URL'][session.table]))
+                for session in [api.sessionDebts, api.sessionPaymentPlans, api.sessionPayments]}
+
+    assert adapters == {id(api.pool.adapter)}
+    assert api.pool.adapter._pool_maxsize == 5 and api.pool.adapter._pool_connections == 2
+    assert api.poolStats()['sessions'] == 3
+
+
+def test_ConnectionPool_ReusesConnections(mockServer):
+    """ Test requests from several tables and threads reuse warm connections of shared pool """
+    api = APIAccess(mockServer.config(config))
+
+    api.fetchDebts()
+    api.fetchPaymentPlans(0)
+    api.fetchPayments(0)
+    parallelMap(api.cfg, lambda id: api.fetchDebts(id), range(20))
+
+    stats = api.poolStats()
+    assert stats['requests'] == 23
+    assert stats['connections_opened'] <= config['Threads']['MaxWorkers'] + 1
+    assert stats['connections_reused'] == stats['requests'] - stats['connections_opened']
+
+
+# ====== Test Mock Server ==========================================
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@pytest.mark.parametrize("fetch_mode", ["single", "batched"])
+def test_MockServer_BaseCase(capfd, monkeypatch, mockServer, impl, fetch_mode):
+    """ Test Functional and OOP implementation over real HTTP, against local mock server with assessment data """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    monkeypatch.setattr(APIAccess, '_instance', None)
+    cfg = mockServer.config(config)
+
+    if impl == "Functional":
+        runDebtFunctional(cfg, basic1extra2both3=3, test_run=True, fetch_mode=fetch_mode)
+    if impl == "OOP":
+        runDebtObjectOriented_LoadIds(cfg, basic1extra2both3=3, test_run=True, fetch_mode=fetch_mode)
+    out, err = capfd.readouterr()
+
+    assert out == BaseCaseOutput
+    assert mockServer.stats() == {'requests': 10 if fetch_mode == "single" else 6, 'errors': 0}
+
+
+def test_MockServer_QueriesAndErrors():
+    """ Test mock server filters and pages as json-server does, and injects server errors """
+    with MockServer((Debts, PaymentPlans, Payments)) as server:
+        api = APIAccess(server.config(config))
+        assert api.fetchPaymentsBatch([1, 3]) == {1: Payments[2:4], 3: Payments[5:8]}
+        assert api.sessionPayments.httpRequest({'date_gte': '2020-09-01'}) == Payments[0:2]
+        assert api.sessionDebts.httpRequest({'_page': 2, '_limit': 2}) == Debts[2:4]
+        assert api.sessionDebts.httpRequest({'_start': 1, '_end': 3}) == Debts[1:3]
+
+    with MockServer((Debts, PaymentPlans, Payments), error_rate=1.0) as server:
+        api = APIAccess(server.config(config))
+        with pytest.raises(Exception, match="500 Server Error"):
+            api.fetchDebts()
+        assert server.stats() == {'requests': 1, 'errors': 1}
+
+
+# ====== Test Synthetic Data =======================================
+
+@pytest.mark.parametrize("fmt", ["jsonl", "json"])
+def test_SyntheticData_SeededAndStreamed(tmp_path, fmt):
+    """ Test same seed generates same tables, and tables written to files load back unchanged """
+    tables = PortfolioGenerator(config, 300, seed=7).tables()
+    assert PortfolioGenerator(config, 300, seed=7).tables() == tables
+    assert PortfolioGenerator(config, 300, seed=8).tables() != tables
+
+    counts = PortfolioGenerator(config, 300, seed=7).write(tmp_path, fmt)
+    assert counts == {'Debts': 300, 'PaymentPlans': len(tables[1]), 'Payments': len(tables[2])}
+    assert loadTables(tmp_path) == tables
+
+
+def test_SyntheticData_Portfolio():
+    """ Test plan coverage, frequency mix and paid off debts of generated portfolio """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    cfg = dict(config, Synthetic={"PlanCoverage": 0.5, "Frequencies": {"BI_WEEKLY": 1}, "PaidOffRate": 0.3})
+    debts, plans, payments = PortfolioGenerator(cfg, 1000).tables()
+    assert 400 < len(plans) < 600
+    assert {pp['installment_frequency'] for pp in plans} == {"BI_WEEKLY"}
+    assert all(pmt['date'] < "2021-01-28" for pmt in payments)
+
+    api = APIBulkAccess(dict(cfg, Vectorized={"Enabled": False}), debts, plans, payments)
+    results = enrichDebts(api, addPaymentPlanExtraInfo, debts)
+    paid_off = [rec for rec in results if rec['remaining_amount'] == 0]
+    assert 100 < len(paid_off) < 200
+    assert all(rec['next_payment_due_date'] is None for rec in paid_off)
+    assert all(rec['remaining_amount'] > 0 for rec in results if rec not in paid_off)
+
+
+def test_SyntheticData_Corruption():
+    """ Test every corruption case is generated and reported as error by enrichment """
+    debts, plans, payments = PortfolioGenerator(dict(config, Synthetic={"CorruptionRate": 1.0}), 30).tables()
+    api = APIBulkAccess(config, debts, plans, payments)
+    errors = set()
+    for debt in debts:
+        with pytest.raises(Exception) as err:
+            addPaymentPlanExtraInfo(api, dict(debt))
+        errors.add(str(err.value).split(" :")[0].split(" for")[0])
+    assert errors == {"Invalid debt amount", "Corrupt payment plan data", "Invalid payment amount"}
+
+
+# ====== Test Metrics ==============================================
+
+def test_Metrics_LatencyHistogram():
+    """ Test latency buckets are cumulative, and quantiles are interpolated within bucket """
+    histogram = LatencyHistogram([0.01, 0.1, 1.0])
+    for seconds in [0.005] * 50 + [0.05] * 45 + [0.5] * 4 + [2.0]:
+        histogram.observe(seconds)
+
+    snapshot = histogram.snapshot()
+    assert snapshot['buckets'] == [[0.01, 50], [0.1, 95], [1.0, 99], ["+Inf", 100]]
+    assert snapshot['count'] == 100
+    assert snapshot['p50'] == pytest.approx(0.01)
+    assert snapshot['p95'] == pytest.approx(0.1)
+    assert snapshot['p99'] == pytest.approx(1.0)
+    assert LatencyHistogram().quantile(0.5) is None
+
+
+@responses.activate
+def test_Metrics_ErrorsByClass(monkeypatch):
+    """ Test errors are counted by class : connection, http status class, error response """
+    monkeypatch.setattr(APIAccess.APISession, 'sleep', staticmethod(lambda delay: None))
+    responses.add(responses.GET, config['URL']['Debts'], body=requests.exceptions.ConnectionError("refused"))
+    responses.add(responses.GET, config['URL']['PaymentPlans'], json={}, status=404)
+    responses.add(responses.GET, config['URL']['Payments'], json={'error': 'unavailable'})
+
+    api = APIAccess(config)
+    for fetch in [api.fetchDebts, api.fetchPaymentPlans, api.fetchPayments]:
+        with pytest.raises(Exception):
+            fetch()
+
+    metrics = api.metrics()
+    assert metrics['Debts']['errors'] == {'connection': 3}
+    assert metrics['Debts']['retries'] == 2
+    assert metrics['PaymentPlans']['errors'] == {'http_4xx': 1}
+    assert metrics['Payments']['errors'] == {'response': 1}
+    assert metrics['Payments']['latency']['count'] == 1
+    assert metrics['Payments']['response_bytes'] == len('{"error": "unavailable"}')
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP_Load", "OOP_Generate"])
+def test_Metrics_WriteErrorReported(capfd, monkeypatch, tmp_path, mockServer, impl):
+    """ Test error writing metrics file is reported to stderr, run result and output stand """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    monkeypatch.setattr(APIAccess, '_instance', None)
+    cfg = dict(mockServer.config(config), Metrics={"Enabled": True, "Path": str(tmp_path / "missing" / "metrics")})
+
+    if impl == "Functional":
+        assert runDebtFunctional(cfg, basic1extra2both3=3, test_run=True)
+    if impl == "OOP_Load":
+        assert runDebtObjectOriented_LoadIds(cfg, basic1extra2both3=3, test_run=True)
+    if impl == "OOP_Generate":
+        assert runDebtObjectOriented_GenerateIds(cfg, basic1extra2both3=1, test_run=True)
+    out, err = capfd.readouterr()
+    assert "***ERROR***" not in out
+    assert err.startswith("***ERROR*** Cannot write metrics : ")
+
+
+def test_Metrics_DisabledInShippedConfig(capfd, monkeypatch, tmp_path, mockServer):
+    """ Test run with shipped debt_config writes no metrics file, unless metrics are enabled """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    monkeypatch.setattr(APIAccess, '_instance', None)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "debt_config")) as cfg_file:
+        cfg = mockServer.config(json.load(cfg_file))
+    monkeypatch.chdir(tmp_path)
+
+    runDebtFunctional(cfg, basic1extra2both3=3, test_run=True)
+    out, err = capfd.readouterr()
+    assert out == BaseCaseOutput
+    assert not (tmp_path / cfg['Metrics']['Path']).exists()
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@pytest.mark.parametrize("fmt", ["json", "prometheus"])
+def test_Metrics_RunDump(capfd, monkeypatch, tmp_path, mockServer, impl, fmt):
+    """ Test run writes per-table request metrics and stage timings to metrics file """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    monkeypatch.setattr(APIAccess, '_instance', None)
+    path = tmp_path / "metrics"
+    cfg = dict(mockServer.config(config), Metrics={"Enabled": True, "Format": fmt, "Path": str(path)})
+
+    if impl == "Functional":
+        runDebtFunctional(cfg, basic1extra2both3=3, test_run=True)
+    if impl == "OOP":
+        runDebtObjectOriented_LoadIds(cfg, basic1extra2both3=3, test_run=True)
+    out, err = capfd.readouterr()
+    assert out == BaseCaseOutput
+
+    if fmt == "json":
+        metrics = json.loads(path.read_text())
+        assert set(metrics['stages']) == {'fetch', 'enrich', 'output'}
+        assert {table: tm['requests'] for table, tm in metrics['tables'].items()} == \
+               {'Debts': 1, 'PaymentPlans': 5, 'Payments': 4}
+        assert all(tm['latency']['count'] == tm['requests'] and tm['response_bytes'] > 0 and tm['errors'] == {}
+                   for tm in metrics['tables'].values())
+    else:
+        lines = path.read_text().splitlines()
+        assert 'debt_api_requests_total{table="PaymentPlans"} 5' in lines
+        assert 'debt_api_request_duration_seconds_count{table="Payments"} 4' in lines
+        assert any(line.startswith('debt_run_stage_seconds{stage="enrich"}') for line in lines)
+
+
+# ====== Test Hooks and Profiler ===================================
+
+@pytest.fixture
+def hookCalls():
+    """Register recording callbacks on all hook points, unregister after test"""
+    calls = []
+    handles = [Hooks.register(point,
+                              before=lambda point, args, kwargs: len(calls),
+                              after=lambda point, state, result, error: calls.append((point, state, error)))
+               for point in ['httpRequest', 'addPaymentPlanExtraInfo', 'DebtRecord.load', 'DebtRecordExtra.load']]
+    yield calls
+    for handle in handles:
+        Hooks.unregister(handle)
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_Hooks_BeforeAfter(capfd, hookCalls, impl):
+    """ Test callbacks are called around hooked functions, and see errors raised by them """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    mockQueries(Debts, PaymentPlans, Payments)
+
+    if impl == "Functional":
+        runDebtFunctional(config, basic1extra2both3=2, test_run=True)
+    if impl == "OOP":
+        runDebtObjectOriented_LoadIds(config, basic1extra2both3=2, test_run=True)
+    out, err = capfd.readouterr()
+    assert out == BaseCaseOutput.splitlines(True)[1]
+
+    points = [point for point, _, _ in hookCalls]
+    assert points.count('httpRequest') == 10
+    assert points.count('addPaymentPlanExtraInfo' if impl == "Functional" else 'DebtRecordExtra.load') == 5
+    assert all(error is None for _, _, error in hookCalls)
+
+    # error raised by hooked function is passed to after callback, and raised
+    hookCalls.clear()
+    responses.reset()
+    responses.add(responses.GET, config['URL']['Debts'], json={}, status=404)
+    with pytest.raises(Exception, match="404 Client Error"):
+        APIAccess(config).fetchDebts()
+    assert hookCalls[0][0] == 'httpRequest' and isinstance(hookCalls[0][2], Exception)
+
+
+@responses.activate
+def test_Profiler_StageAllocations(capfd, tmp_path):
+    """ Test profiler writes cProfile dump and allocation report per run stage """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    mockQueries(Debts, PaymentPlans, Payments)
+    cfg = dict(config, Profile={"Path": str(tmp_path / "run.prof"), "AllocReport": str(tmp_path / "alloc.txt")})
+
+    with Profiler(cfg):
+        runDebtFunctional(cfg, basic1extra2both3=3, test_run=True)
+    out, err = capfd.readouterr()
+    assert out == BaseCaseOutput
+    assert Hooks.callbacks('stage') == []
+
+    stats = pstats.Stats(str(tmp_path / "run.prof"))
+    assert any(func[2] == 'runDebtFunctional' for func in stats.stats)
+    report = (tmp_path / "alloc.txt").read_text().splitlines()
+    assert [line.split()[0] for line in report[1:4]] == ['fetch', 'enrich', 'output']
+
+
+# ====== Test Sharding ============================================
+
+@pytest.mark.parametrize("partition", ["hash", "range"])
+def test_Sharding_ShardsCoverDebts(partition):
+    """ Test shards cover every debt id exactly once, ids out of configured range included """
+    cfg = dict(config, Shards={"Partition": partition, "IdRange": [0, 100]})
+    shards = [ShardSpec.Parse(f"{i}/3", cfg) for i in range(3)]
+    for debt_id in range(-5, 120):
+        assert sum(shard.contains(debt_id) for shard in shards) == 1
+
+    if partition == "range":
+        assert [shard.rangeParams('id') for shard in shards] == \
+               [{'id_lte': 32}, {'id_gte': 33, 'id_lte': 65}, {'id_gte': 66}]
+    for text in ["3/3", "1", "a/b"]:
+        with pytest.raises(Exception, match="Incorrect shard"):
+            ShardSpec.Parse(text, cfg)
+
+
+@pytest.mark.parametrize("impl, fetch_mode, partition", [("Functional", "single", "hash"),
+                                                          ("Functional", "bulk", "range"),
+                                                          ("OOP", "batched", "range"),
+                                                          ("Functional", "spill", "hash"),
+                                                          ("OOP", "spill", "range")])
+def test_Sharding_MultiProcessRun(tmp_path, impl, fetch_mode, partition):
+    """
+    Test n shards, run as separate processes against local mock server, write partitions of disjoint debts,
+    merged into the same JSON lines as unsharded run
+    """
+    debts, plans, payments = PortfolioGenerator(config, 200).tables()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "DebtFunctional.py" if impl == "Functional" else "DebtObjectOriented.py")
+    with MockServer((debts, plans, payments)) as server:
+        cfg = dict(server.config(config), Shards={"Partition": partition, "IdRange": [0, 200],
+                                                  "PartitionPath": str(tmp_path / "part_{index}_of_{count}.jsonl")})
+        cfg_path = tmp_path / "debt_config"
+        cfg_path.write_text(json.dumps(cfg))
+        args = [str(cfg_path), fetch_mode, "jsonl"] if impl == "Functional" else [str(cfg_path), "l", "jsonl", fetch_mode]
+
+        nodes = [subprocess.Popen([sys.executable, script] + args + ["--shard", f"{i}/3"], cwd=tmp_path)
+                 for i in range(3)]
+        assert [node.wait() for node in nodes] == [0, 0, 0]
+        single = subprocess.run([sys.executable, script] + args, cwd=tmp_path, stdout=subprocess.PIPE, text=True)
+
+    paths = [str(tmp_path / f"part_{i}_of_3.jsonl") for i in range(3)]
+    shard_ids = [[json.loads(line)['id'] for line in open(path)] for path in paths]
+    assert all(len(ids) > 0 for ids in shard_ids)
+    assert sorted(sum(shard_ids, [])) == [dbt['id'] for dbt in debts]
+
+    merged = io.StringIO()
+    assert mergePartitions(paths, merged) == len(debts)
+    assert merged.getvalue() == single.stdout
+
+
+def test_Sharding_PartitionsSortedById(tmp_path):
+    """
+    Test partitions are written ordered by debt id whatever the order of Debts table, sorted out of core beyond
+    sort budget, so that merge outputs debts by id; partition not ordered by id is reported
+    """
+    ids = [(i * 37) % 101 for i in range(101)] + ["x"]
+    paths = []
+    for i in range(2):
+        shard = ShardSpec(i, 2, partition_path=str(tmp_path / "part_{index}_of_{count}.jsonl"), sort_budget=2000)
+
+        def run(out):
+            for debt_id in ids:
+                if shard.contains(debt_id):
+                    out.write(json.dumps({'id': debt_id, 'amount': 1}) + "\n")
+            return True
+
+        assert shard.writePartition(run)
+        paths.append(shard.partitionPath())
+    assert sorted(os.listdir(tmp_path)) == ["part_0_of_2.jsonl", "part_1_of_2.jsonl"]
+
+    merged = io.StringIO()
+    assert mergePartitions(paths, merged) == len(ids)
+    assert [json.loads(line)['id'] for line in merged.getvalue().splitlines()] == list(range(101)) + ["x"]
+
+    unordered = tmp_path / "unordered.jsonl"
+    unordered.write_text('{"id": 2}\n{"id": 1}\n')
+    with pytest.raises(Exception, match="not ordered by debt id : 1 follows 2"):
+        mergePartitions([str(unordered)], io.StringIO())
+
+
+# ====== Test JSON Stream ==========================================
+
+@pytest.mark.parametrize("backend", ["json", pytest.param("orjson", marks=pytest.mark.skipif(
+    orjson is None, reason="orjson is not installed"))])
+def test_JsonStream_ChunkedSameAsWhole(backend):
+    """ Test body decoded chunk by chunk is decoded as whole body, nested records and error response included """
+    loads = jsonLoads({'Decode': {'Backend': backend}})
+    records = [dict(pmt, note=note, nested={"a": [{"b": 1}]} if i % 3 == 0 else None)
+               for i, (pmt, note) in enumerate(zip(Payments, ["}", "},{", "[]", "é", "x"] * 10))]
+    for body in [json.dumps(records), json.dumps(records, indent=2), " [ ] ", '{"error": "unavailable"}', "[1, 2]"]:
+        body = body.encode()
+        for size in [1, 7, 64, len(body)]:
+            assert decodeChunks([body[i:i + size] for i in range(0, len(body), size)], loads) == json.loads(body)
+
+    for body in [b"", b'[{"a": 1},]', b'[{"a": 1}', b'[{"a": 1} {"b": 2}]', b'[,{"a": 1}]', b'[{"a": 1}] x']:
+        for size in [1, 4, 64]:
+            with pytest.raises(ValueError):
+                decodeChunks([body[i:i + size] for i in range(0, len(body), size)], loads)
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+@responses.activate
+def test_JsonStream_HttpRequest(streaming):
+    """ Test response body is decoded as it streams, error responses and invalid JSON are reported as before """
+    cfg = dict(config, Decode={"Streaming": streaming, "ChunkSize": 16})
+    body = json.dumps(Payments)
+    responses.add(responses.GET, config['URL']['Payments'], body=body)
+    responses.add(responses.GET, config['URL']['Debts'], json={'error': 'unavailable'})
+    responses.add(responses.GET, config['URL']['PaymentPlans'], body='[{"id": 0}, {"id": 1')
+
+    api = APIAccess(cfg)
+    assert api.fetchPayments() == Payments
+    with pytest.raises(Exception, match="Error fetching data from Debts for no params: http response error: "
+                                        "unavailable"):
+        api.fetchDebts()
+    with pytest.raises(Exception, match="Error fetching data from PaymentPlans for no params: Invalid JSON response"):
+        api.fetchPaymentPlans()
+
+    metrics = api.metrics()
+    assert metrics['Payments']['response_bytes'] == metrics['Payments']['decoded_bytes'] == len(body)
+    assert metrics['Payments']['decode_bytes_per_second'] > 0
+    assert metrics['Debts']['errors'] == {'response': 1}
+    assert metrics['PaymentPlans']['errors'] == {'response': 1}
+
+
+def test_JsonStream_RecordsBeforeBodyIsRead():
+    """ Test records of streamed body are yielded as chunks are decoded, before the rest of body is read """
+    class ChunkedResponse:
+        def __init__(self, body, size):
+            self.chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            self.nread = 0
+
+        def iter_content(self, chunk_size):
+            for chunk in self.chunks:
+                self.nread += 1
+                yield chunk
+
+    session = APIAccess(dict(config, Decode={"Streaming": True})).sessionPayments
+    rsp = ChunkedResponse(json.dumps(Payments).encode(), 100)
+    records = session.iterBody(rsp, time.perf_counter())
+    assert next(records) == Payments[0]
+    assert rsp.nread < len(rsp.chunks)
+    assert [Payments[0]] + list(records) == Payments
+    assert session.metricsSnapshot()['response_bytes'] == sum(len(chunk) for chunk in rsp.chunks)
+
+
+def cacheConfig(path, ttl):
+    return dict(config, Cache={"Enabled": True, "Path": str(path), "TTL": {"Debts": ttl}})
+
+
+@responses.activate
+def test_ResponseCache_FreshHit(tmp_path):
+    """ Test response younger than TTL is served from disk cache without request, across APIAccess instances """
+    # === Mock Responses
+    responses.add(responses.GET, config['URL']['Debts'], json=Debts, headers={'ETag': '"v1"'})
+
+    # === Assertions
+    cold = APIAccess(cacheConfig(tmp_path, 60))
+    assert cold.fetchDebts() == Debts
+    assert cold.cacheStats() == {'Debts': {'hits': 0, 'misses': 1, 'revalidated': 0}}
+
+    warm = APIAccess(cacheConfig(tmp_path, 60))
+    assert warm.fetchDebts() == Debts
+    assert warm.cacheStats() == {'Debts': {'hits': 1, 'misses': 0, 'revalidated': 0}}
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_ResponseCache_Revalidation(tmp_path):
+    """ Test expired response is revalidated with If-None-Match and reused when server returns 304 """
+    # === Mock Responses
+    responses.add(responses.GET, config['URL']['Debts'], json=Debts, headers={'ETag': '"v1"'})
+    responses.add(responses.GET, config['URL']['Debts'], status=304,
+                  match=[matchers.header_matcher({'If-None-Match': '"v1"'})])
+
+    # === Assertions
+    api = APIAccess(cacheConfig(tmp_path, 0))
+    assert api.fetchDebts() == Debts
+    assert api.fetchDebts() == Debts
+    assert api.cacheStats() == {'Debts': {'hits': 0, 'misses': 1, 'revalidated': 1}}
+    assert 'If-None-Match' not in responses.calls[0].request.headers
+    assert responses.calls[1].request.headers['If-None-Match'] == '"v1"'
+
+
+# ====== Test Paging ===============================================
+
+def pagingConfig(paging, prefetch):
+    tables = dict(config['Tables'], Debts={"PageSize": 2, "Paging": paging, "Prefetch": prefetch})
+    return dict(config, Tables=tables)
+
+
+@pytest.mark.parametrize("paging, prefetch", [("page", False), ("page", True), ("range", False)])
+@responses.activate
+def test_Paging_IterDebts(paging, prefetch):
+    """ Test Debts table is iterated page by page, until page with less records than page size """
+    # === Mock Responses
+    for npage in range(3):
+        params = f"_page={npage + 1}&_limit=2" if paging == "page" else f"_start={npage * 2}&_end={npage * 2 + 2}"
+        responses.add(responses.GET,
+                      config['URL']['Debts'] + f"?{params}",
+                      json=Debts[npage * 2: npage * 2 + 2],
+                      content_type="application/json")
+
+    # === Assertions
+    api = APIAccess(pagingConfig(paging, prefetch))
+    debts = api.iterDebts()
+    assert next(debts) == Debts[0]
+    # pages are fetched lazily : only first page is fetched, second one may be in flight with prefetch
+    assert len(responses.calls) <= (2 if prefetch else 1)
+    assert list(debts) == Debts[1:]
+    assert len(responses.calls) == 3
+
+
+@responses.activate
+def test_Paging_LastPageFull():
+    """ Test iteration stops at empty page, when number of records is multiple of page size """
+    # === Mock Responses
+    for npage, page in enumerate([Debts[0:2], Debts[2:4], []]):
+        responses.add(responses.GET,
+                      config['URL']['Debts'] + f"?_page={npage + 1}&_limit=2",
+                      json=page,
+                      content_type="application/json")
+
+    # === Assertions
+    api = APIAccess(pagingConfig("page", False))
+    assert list(api.iterDebts()) == Debts[0:4]
+
+
 # ====== Test Functional and OOP implementation ============================================
 
-def runImplementation(impl):
+def runImplementation(impl, fetch_mode="single"):
     if impl == "Functional":
-        runDebtFunctional(config, basic1extra2both3=3, test_run=True)
+        runDebtFunctional(config, basic1extra2both3=3, test_run=True, fetch_mode=fetch_mode)
     if impl == "OOP":
-        runDebtObjectOriented_LoadIds(config, basic1extra2both3=3, test_run=True)
+        runDebtObjectOriented_LoadIds(config, basic1extra2both3=3, test_run=True, fetch_mode=fetch_mode)
+
+
+def mockTables(debts, plans, payments):
+    """Mock no param queries to all 3 tables, as used by bulk fetch mode"""
+    for table, data in [('Debts', debts), ('PaymentPlans', plans), ('Payments', payments)]:
+        responses.add(responses.GET,
+                      config['URL'][table],
+                      json=data,
+                      content_type="application/json")
 
 
 @pytest.mark.parametrize("impl", ["Functional", "OOP"])
@@ -138,28 +911,655 @@ def test_Regression_BaseCase(capfd, impl):
                       content_type="application/json")
 
     # === Assertions
-    output = \
-        "[{'amount': 123.46, 'id': 0, 'in_payment_plan': True}, " \
-        "{'amount': 100.0, 'id': 1, 'in_payment_plan': True}, " \
-        "{'amount': 4920.34, 'id': 2, 'in_payment_plan': True}, " \
-        "{'amount': 12938.0, 'id': 3, 'in_payment_plan': True}, " \
-        "{'amount': 9238.02, 'id': 4, 'in_payment_plan': False}]\n" \
-        "[{'amount': 123.46, 'id': 0, 'in_payment_plan': True, 'remaining_amount': 20.959999999999994, " \
-        "'next_payment_due_date': datetime.datetime(2021, 2, 1, 0, 0)}, " \
-        "{'amount': 100.0, 'id': 1, 'in_payment_plan': True, 'remaining_amount': 50.0, " \
-        "'next_payment_due_date': datetime.datetime(2021, 1, 30, 0, 0)}, " \
-        "{'amount': 4920.34, 'id': 2, 'in_payment_plan': True, 'remaining_amount': 607.6700000000001, " \
-        "'next_payment_due_date': datetime.datetime(2021, 2, 10, 0, 0)}, " \
-        "{'amount': 12938.0, 'id': 3, 'in_payment_plan': True, 'remaining_amount': 9247.745000000003, " \
-        "'next_payment_due_date': datetime.datetime(2021, 1, 30, 0, 0)}, " \
-        "{'amount': 9238.02, 'id': 4, 'in_payment_plan': False, 'remaining_amount': 9238.02, " \
-        "'next_payment_due_date': None}]\n"
-
     runImplementation(impl)
     out, err = capfd.readouterr()
+    assert out == BaseCaseOutput
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_Regression_BulkFetch(capfd, impl):
+    """
+    Test Functional and OOP implementation in bulk fetch mode with full dataset as presented in assessment
+    Output must be identical to per-debt fetch mode, using exactly 3 API requests
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    # === Mock Responses
+    mockTables(Debts, PaymentPlans, Payments)
+
+    # === Assertions
+    runImplementation(impl, "bulk")
+    out, err = capfd.readouterr()
+    assert out == BaseCaseOutput
+    assert len(responses.calls) == 3
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_Regression_ProcessesFetch(capfd, impl):
+    """ Test Functional and OOP implementation with payment plan info computed in process pool, using 3 API requests """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    # === Mock Responses
+    mockTables(Debts, PaymentPlans, Payments)
+
+    # === Assertions
+    runImplementation(impl, "processes")
+    out, err = capfd.readouterr()
+    assert out == BaseCaseOutput
+    assert len(responses.calls) == 3
+
+
+def test_ProcessShards_SameAsBulk():
+    """ Test sharded payment plan info is identical to bulk calculation, errors included, with shards of contiguous payment plans """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    tables = PortfolioGenerator(dict(config, Synthetic={"CorruptionRate": 0.1}), 300).tables()
+    bulk = APIBulkAccess(dict(config, Vectorized={"Enabled": False}), *tables)
+    sharded = APIShardedAccess(config, *tables)
+
+    def planInfo(api, dbt):
+        try:
+            return addPaymentPlanExtraInfo(api, dict(dbt))
+        except Exception as err:
+            return str(err)
+
+    assert [planInfo(sharded, dbt) for dbt in tables[0]] == [planInfo(bulk, dbt) for dbt in tables[0]]
+
+    # shards are contiguous payment plan ranges, each with its payments in table order
+    plan_index, *columns = sharded.paymentPlanColumns()
+    shards = shardColumns(columns, 4)
+    sizes = [len(shard[0]) for shard in shards]
+    assert sum(sizes) == len(plan_index) and max(sizes) - min(sizes) <= 1
+    assert sum((list(shard[2]) for shard in shards), []) == columns[2]
+    payments = [pmt for pmt in tables[2] if pmt.get('payment_plan_id') in plan_index]
+    assert sum((list(shard[5]) for shard in shards), []) == [pmt.get('date') for pmt in payments]
+    assert all(0 <= shard[3].min() and shard[3].max() < len(shard[0]) for shard in shards)
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_Regression_SQLiteFetch(capfd, monkeypatch, tmp_path, impl):
+    """
+    Test Functional and OOP implementation against local SQLite mirror : mirror is synced with 3 API requests
+    when missing, next run makes no request
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    monkeypatch.setitem(config, 'Mirror', {"Path": str(tmp_path / "mirror.sqlite")})
+    # === Mock Responses
+    mockTables(Debts, PaymentPlans, Payments)
+
+    # === Assertions
+    for _ in range(2):
+        runImplementation(impl, "sqlite")
+        out, err = capfd.readouterr()
+        assert out == BaseCaseOutput
+        assert len(responses.calls) == 3
+
+
+@responses.activate
+def test_SQLiteMirror_ShardedThenUnsharded(monkeypatch, tmp_path):
+    """
+    Test shard runs in sqlite fetch mode output disjoint debts of their shards, and do not restrict shared mirror :
+    unsharded run afterwards outputs all debts, with mirror synced once
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    monkeypatch.setitem(config, 'Mirror', {"Path": str(tmp_path / "mirror.sqlite")})
+    # === Mock Responses
+    mockTables(Debts, PaymentPlans, Payments)
+
+    # === Assertions
+    def runIds(shard):
+        out = io.StringIO()
+        assert runDebtFunctional(config, 2, False, "sqlite", "jsonl", shard, out)
+        return [json.loads(line)['id'] for line in out.getvalue().splitlines()]
+
+    for i in range(2):
+        assert runIds(ShardSpec(i, 2)) == [dbt['id'] for dbt in Debts if shardOf(dbt['id'], 2) == i]
+    assert runIds(None) == [dbt['id'] for dbt in Debts]
+    assert len(responses.calls) == 3
+
+
+def test_SQLiteMirror_SameAsBulk(tmp_path):
+    """
+    Test mirror lookups and payment plan info from GROUP BY query are identical to bulk calculation,
+    errors included; stale mirror is synced again
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    tables = PortfolioGenerator(dict(config, Synthetic={"CorruptionRate": 0.1}), 300).tables()
+    bulk = APIBulkAccess(dict(config, Vectorized={"Enabled": False}), *tables)
+    with MockServer(tables) as server:
+        cfg = dict(server.config(config), Mirror={"Path": str(tmp_path / "mirror.sqlite"), "MaxAge": 3600})
+        mirror = SQLiteMirror.Open(APIAccess(cfg))
+        assert SQLiteMirror.Open(APIAccess(cfg)).stats() == mirror.stats()
+        assert server.stats()['requests'] == 3
+        SQLiteMirror.Open(APIAccess(dict(cfg, Mirror=dict(cfg['Mirror'], MaxAge=0))))
+        assert server.stats()['requests'] == 6
+
+    def planInfo(api, dbt):
+        try:
+            return addPaymentPlanExtraInfo(api, dict(dbt))
+        except Exception as err:
+            return str(err)
+
+    assert [planInfo(mirror, dbt) for dbt in tables[0]] == [planInfo(bulk, dbt) for dbt in tables[0]]
+    assert sum(info is not None for info, _ in mirror.remainingAmounts().values()) > 100
+    assert mirror.fetchPaymentsBatch([0, 1, -1]) == {ppid: bulk.fetchPayments(ppid) for ppid in [0, 1, -1]}
+    assert list(mirror.iterPaymentsSince("2021-01-01")) == [pmt for pmt in tables[2] if pmt['date'] >= "2021-01-01"]
+    with pytest.raises(APIAccess.XDebtIdNotFound):
+        mirror.fetchDebts(-1)
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_Regression_SpillFetch(capfd, monkeypatch, impl):
+    """ Test Functional and OOP implementation with tables joined out of core, spilled to disk, using 3 API requests """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    monkeypatch.setitem(config, 'Spill', {"MemoryBudget": 2000})
+    # === Mock Responses
+    mockTables(Debts, PaymentPlans, Payments)
+
+    # === Assertions
+    runImplementation(impl, "spill")
+    out, err = capfd.readouterr()
+    assert out == BaseCaseOutput
+    assert len(responses.calls) == 3
+
+
+def test_SpillJoin_MergeBuffersInBudget(tmp_path):
+    """
+    Test run file buffers of merge count against sorter budget : buffer size, then fan-in, are reduced so that merge
+    fits budget
+    """
+    budget = 2 ** 16
+    sorter = SpillJoin.ExternalSorter(budget, str(tmp_path))
+    assert sorter.runBuffer == SpillJoin.MinRunBuffer and sorter.fanIn == 15 < SpillJoin.MaxFanIn
+    keys = [(i * 7919) % 5000 for i in range(5000)]
+    for key in keys:
+        sorter.add([key], {'pad': 'x' * 100})
+    sorter.finish()
+    assert sorter.stats['runs'] > sorter.fanIn + 1 and len(sorter.runs) <= sorter.fanIn
+    assert [key for (key,), _ in sorter] == sorted(keys)
+    assert 0 < sorter.stats['peak_buffered_bytes'] <= budget
+    sorter.close()
+
+
+@pytest.mark.parametrize("streaming, requests",
+                         [(True, 3), (False, sum(len(table) // 2 + 1 for table in [Debts, PaymentPlans, Payments]))])
+def test_SpillJoin_UnpagedTables(monkeypatch, streaming, requests):
+    """
+    Test tables without PageSize are streamed by spill fetch mode, or paged by Spill.PageSize when response would
+    be read whole, so that no table is held in memory before it is spilled
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    with MockServer((Debts, PaymentPlans, Payments)) as server:
+        cfg = dict(server.config(config), Decode={"Streaming": streaming}, Spill={"PageSize": 2})
+        spill = APISpillAccess.Load(APIAccess(cfg))
+        assert server.stats()['requests'] == requests
+        assert list(spill.iterDebts()) == Debts
+    spill.close()
+
+
+# child process : tracemalloc peak of mode, measured after API access is created
+SpillJoinPeakScript = """
+import sys, json, tracemalloc
+from APIAccess import APIAccess, APIBulkAccess
+from SpillJoin import APISpillAccess
+api = APIAccess(json.loads(sys.argv[1]))
+tracemalloc.start()
+if sys.argv[2] == "stream":
+    for records in [api.iterDebts(), api.iterPaymentPlans(), api.iterPayments()]:
+        for rec in records:
+            pass
+else:
+    access = APISpillAccess.Load(api) if sys.argv[2] == "spill" else APIBulkAccess.Load(api)
+    for dbt in access.iterDebts():
+        access.fetchPaymentPlans(dbt['id'])
+print(tracemalloc.get_traced_memory()[1])
+"""
+
+
+def test_SpillJoin_MemoryCap():
+    """
+    Test spill join, run in fresh process, allocates at most budget more than streaming the paged tables without
+    join, while join in memory (bulk) of the same portfolio exceeds that bound
+    """
+    tables = PortfolioGenerator(config, 1000).tables()
+    budget = 2 ** 18
+    with MockServer(tables) as server:
+        paged = {table: dict(config['Tables'].get(table, {}), PageSize=200)
+                 for table in ['Debts', 'PaymentPlans', 'Payments']}
+        cfg = json.dumps(dict(server.config(config), Tables=paged, Spill={"MemoryBudget": budget}))
+        peaks = {mode: int(subprocess.run([sys.executable, "-c", SpillJoinPeakScript, cfg, mode], check=True,
+                                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                                          stdout=subprocess.PIPE, text=True).stdout)
+                 for mode in ["stream", "spill", "bulk"]}
+
+    assert peaks['spill'] <= peaks['stream'] + budget < peaks['bulk']
+
+
+def test_SpillJoin_ConstrainedBudget(monkeypatch):
+    """
+    Test out-of-core join of paged tables within small memory budget : runs are spilled and merged in several
+    passes, buffered records and run file buffers never exceed budget, debts are in API order and payment plan info is identical to bulk
+    calculation, errors included; run files are removed when access is closed
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    monkeypatch.setattr(SpillJoin, 'MaxFanIn', 4)
+    tables = PortfolioGenerator(dict(config, Synthetic={"CorruptionRate": 0.1}), 300).tables()
+    bulk = APIBulkAccess(dict(config, Vectorized={"Enabled": False}), *tables)
+    budget = 30000
+
+    def planInfo(api, dbt):
+        try:
+            return addPaymentPlanExtraInfo(api, dict(dbt))
+        except Exception as err:
+            return str(err)
+
+    with MockServer(tables) as server:
+        paged = {table: dict(config['Tables'].get(table, {}), PageSize=50)
+                 for table in ['Debts', 'PaymentPlans', 'Payments']}
+        spill = APISpillAccess.Load(APIAccess(dict(server.config(config), Tables=paged,
+                                                   Spill={"MemoryBudget": budget})))
+        assert server.stats()['requests'] > 3
+        requests = server.stats()['requests']
+        debts, infos = zip(*[(dbt, planInfo(spill, dbt)) for dbt in spill.iterDebts()])
+        assert server.stats()['requests'] == requests
+
+    assert list(debts) == tables[0]
+    assert list(infos) == [planInfo(bulk, dbt) for dbt in tables[0]]
+    stats = spill.spillStats()
+    assert stats['records'] > len(tables[2]) and stats['runs'] > 4 * SpillJoin.MaxFanIn
+    assert 0 < stats['peak_buffered_bytes'] <= budget // APISpillAccess.Sorts
+    spill.close()
+    assert not os.path.exists(spill.directory)
+
+
+@pytest.mark.parametrize("today", [datetime.datetime(2021, 1, 28), datetime.datetime(2021, 1, 28, 13, 45)])
+def test_VectorizedPayments_SameAsPerDebt(today):
+    """
+    Test remaining amounts and next payment due dates computed by vectorized engine are exactly equal to
+    per-debt calculation : payments subtracted one by one, schedule from start date and frequency
+    """
+    APIAccess.Today = today
+    rnd = random.Random(7)
+    debts = [{"amount": round(rnd.uniform(1, 10000), 2), "id": i} for i in range(200)]
+    plans = [{"debt_id": i, "id": 1000 + i, "installment_frequency": rnd.choice(["WEEKLY", "BI_WEEKLY"]),
+              "start_date": rnd.choice(["2020-01-01", "2020-12-31T10:00:00Z", "2021-01-28", "2021-02-10"])}
+             for i in range(0, 200, 3)]
+    payments = [{"amount": round(rnd.uniform(0.01, 500), rnd.choice([0, 2, 3])),
+                 "date": f"2021-{rnd.randint(1, 2):02}-{rnd.randint(1, 28):02}",
+                 "payment_plan_id": rnd.choice(plans[1:])['id']} for _ in range(3000)]
+    # paid off debt
+    payments += [{"amount": debts[0]['amount'] / 2, "date": "2021-01-01", "payment_plan_id": 1000}] * 2
+
+    bulk = APIBulkAccess(config, debts, plans, payments)
+    per_debt = APIBulkAccess(dict(config, Vectorized={"Enabled": False}), debts, plans, payments)
+    assert per_debt.paymentPlanInfo(plans[0], 0) is None
+
+    for dbt in debts:
+        assert addPaymentPlanExtraInfo(bulk, dict(dbt)) == addPaymentPlanExtraInfo(per_debt, dict(dbt))
+        assert DebtRecordExtra(bulk, dbt['id']).asDict() == DebtRecordExtra(per_debt, dbt['id']).asDict()
+    assert all(bulk.paymentPlanInfo(pp, 0) is not None for pp in plans)
+    assert bulk.paymentPlanInfo(plans[0], 0) == {'remaining_amount': 0, 'next_payment_due_date': None}
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_InvalidPaymentAmount_BulkFetch(capfd, impl):
+    """ Test payment plan with invalid payment is left to per-debt calculation, reporting the same error """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    # === Mock Responses
+    payments = [dict(pmt, amount=None) if pmt is Payments[0] else pmt for pmt in Payments]
+    mockTables(Debts[0:1], PaymentPlans[0:1], payments)
+
+    # === Assertions
+    output = "[{'amount': 123.46, 'id': 0, 'in_payment_plan': True}]\n" \
+             "***ERROR*** Invalid payment amount : amount=None, payment_plan_id=0,  date=2020-09-29\n"
+
+    runImplementation(impl, "bulk")
+    out, err = capfd.readouterr()
     assert out == output
 
 
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_Regression_AsyncFetch(capfd, impl):
+    """
+    Test Functional and OOP implementation in async fetch mode with full dataset as presented in assessment
+    Output must be in debt id order, identical to per-debt fetch mode
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    # === Mock Responses
+    mockQueries(Debts, PaymentPlans, Payments)
+
+    # === Assertions
+    runImplementation(impl, "async")
+    out, err = capfd.readouterr()
+    assert out == BaseCaseOutput
+    assert len(responses.calls) == 1 + len(Debts) + len(PaymentPlans)
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_AsyncFetch_DuplicateDebtIds(capfd, impl):
+    """ Test debt id repeated in Debts table is fetched once, output is the same as in single fetch mode """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    mockFilteredTables(Debts + [{"amount": 100, "id": 1}], PaymentPlans, Payments)
+
+    # === Assertions
+    runImplementation(impl, "single")
+    expected, _ = capfd.readouterr()
+    responses.calls.reset()
+    runImplementation(impl, "async")
+    out, _ = capfd.readouterr()
+    assert out == expected and "ERROR" not in out
+    assert len([call for call in responses.calls if "debt_id=1" in call.request.url]) == 1
+
+
+@responses.activate
+def test_AsyncFetch_HTTPResponseError(capfd):
+    """ Test HTTP error response in async fetch mode is reported as in sequential mode """
+    # === Mock Responses
+    mockQueries(Debts, PaymentPlans, Payments)
+    responses.replace(responses.GET,
+                      config['URL']['PaymentPlans'] + "?debt_id=2",
+                      json={'error': 'Not Found'},
+                      status=404)
+
+    # === Assertions
+    output = f"***ERROR*** Error fetching data from PaymentPlans for   debt_id=2: 404 Client Error: " \
+             f"Not Found for url: {config['URL']['PaymentPlans']}?debt_id=2\n"
+
+    runDebtFunctional(config, basic1extra2both3=3, test_run=True, fetch_mode="async")
+    out, err = capfd.readouterr()
+    assert out == output
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_Regression_ThreadsFetch(capfd, impl):
+    """
+    Test Functional and OOP implementation enriching debts in thread pool with full dataset as presented in assessment
+    Output must be in debt id order, identical to sequential run
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    # === Mock Responses
+    mockQueries(Debts, PaymentPlans, Payments)
+
+    # === Assertions
+    runImplementation(impl, "threads")
+    out, err = capfd.readouterr()
+    assert out == BaseCaseOutput
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_ThreadsFetch_FirstErrorInDebtOrder(capfd, impl):
+    """
+    Test Functional and OOP implementation enriching debts in thread pool, when several debts have invalid data
+    Error reported must be the one for lowest debt id, as in sequential run
+    """
+    # === Mock Responses
+    debts = [dict(dbt, amount="N/A") if dbt['id'] in (2, 4) else dbt for dbt in Debts]
+    mockQueries(debts, PaymentPlans, Payments)
+
+    # === Assertions
+    output = "***ERROR*** Invalid debt amount : id=2 amount=N/A\n"
+
+    runImplementation(impl, "threads")
+    out, err = capfd.readouterr()
+    assert out == output
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_Regression_BatchedFetch(capfd, impl):
+    """
+    Test Functional and OOP implementation in batched fetch mode with full dataset as presented in assessment
+    Debts are enriched in chunks of 2 : 2 multi-id requests per chunk, output identical to per-debt fetch mode
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    # === Mock Responses
+    mockFilteredTables(Debts, PaymentPlans, Payments)
+
+    # === Assertions
+    runImplementation(impl, "batched")
+    out, err = capfd.readouterr()
+    assert out == BaseCaseOutput
+    # Debts + 3 chunks of PaymentPlans + 2 chunks of Payments (debt 4 has no plan)
+    assert len(responses.calls) == 6
+    assert urlsplit(responses.calls[1].request.url).query == "debt_id=0&debt_id=1"
+
+
+@responses.activate
+def test_Batch_ChunksByURLLength():
+    """ Test multi-id requests are split in chunks so that URL does not exceed configured length """
+    # === Mock Responses
+    mockFilteredTables(Debts, PaymentPlans, Payments)
+
+    # === Assertions
+    url_length = len(config['URL']['PaymentPlans']) + 1 + len("debt_id=0&") * 3
+    api = APIAccess(dict(config, Batch={"Size": 100, "MaxURLLength": url_length}))
+    plans = api.fetchPaymentPlansBatch([dbt['id'] for dbt in Debts])
+
+    assert plans == {dbt['id']: [pp for pp in PaymentPlans if pp['debt_id'] == dbt['id']] for dbt in Debts}
+    assert [len(parse_qs(urlsplit(call.request.url).query)['debt_id']) for call in responses.calls] == [3, 2]
+    assert all(len(call.request.url) <= url_length for call in responses.calls)
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_MultiplePaymentPlans_BulkFetch(capfd, impl):
+    """
+    Test Functional and OOP implementation in bulk fetch mode for debt having multiple payment plans
+    """
+    # === Mock Responses
+    mockTables([Debts[0]], [PaymentPlans[0], dict(PaymentPlans[1], debt_id=0)], Payments)
+
+    # === Assertions
+    output = "***ERROR*** Corrupt payment plan data for debt_id '0' : multiple records\n"
+
+    runImplementation(impl, "bulk")
+    out, err = capfd.readouterr()
+    assert out == output
+
+
+@pytest.mark.parametrize("run", [runDebtFunctional, runDebtObjectOriented_LoadIds])
+@responses.activate
+def test_BothInfo_SinglePass(capfd, run):
+    """
+    Test Functional and OOP implementation output both lists in single pass over debts :
+    API requests made for both lists are the same as for extended info list alone
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    # === Mock Responses
+    mockQueries(Debts, PaymentPlans, Payments)
+
+    requests_made = {}
+    for basic1extra2both3 in [2, 3]:
+        responses.calls.reset()
+        run(config, basic1extra2both3=basic1extra2both3, test_run=True)
+        requests_made[basic1extra2both3] = sorted(call.request.url for call in responses.calls)
+
+    # === Assertions
+    out, err = capfd.readouterr()
+    assert out.endswith(BaseCaseOutput)
+    assert requests_made[3] == requests_made[2]
+
+
+@pytest.mark.parametrize("run", [runDebtFunctional, runDebtObjectOriented_LoadIds, runDebtObjectOriented_GenerateIds])
+@responses.activate
+def test_Regression_JsonLines(capfd, run):
+    """
+    Test Functional and OOP implementation JSON lines output with full dataset as presented in assessment
+    Each debt is output once with extended info, dates in ISO 8601 UTC format
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    # === Mock Responses
+    # Debts parametrized query, used by generated debt ids, precedes no param query
+    for dbt in Debts:
+        responses.add(responses.GET, config['URL']['Debts'] + f"?id={dbt['id']}", json=[dbt])
+    responses.add(responses.GET, config['URL']['Debts'] + f"?id={len(Debts)}", json=[])
+    mockQueries(Debts, PaymentPlans, Payments)
+
+    # === Assertions
+    output = \
+        '{"amount": 123.46, "id": 0, "in_payment_plan": true, "remaining_amount": 20.959999999999994, ' \
+        '"next_payment_due_date": "2021-02-01T00:00:00Z"}\n' \
+        '{"amount": 100.0, "id": 1, "in_payment_plan": true, "remaining_amount": 50.0, ' \
+        '"next_payment_due_date": "2021-01-30T00:00:00Z"}\n' \
+        '{"amount": 4920.34, "id": 2, "in_payment_plan": true, "remaining_amount": 607.6700000000001, ' \
+        '"next_payment_due_date": "2021-02-10T00:00:00Z"}\n' \
+        '{"amount": 12938.0, "id": 3, "in_payment_plan": true, "remaining_amount": 9247.745000000003, ' \
+        '"next_payment_due_date": "2021-01-30T00:00:00Z"}\n' \
+        '{"amount": 9238.02, "id": 4, "in_payment_plan": false, "remaining_amount": 9238.02, ' \
+        '"next_payment_due_date": null}\n'
+
+    run(config, basic1extra2both3=3, output_format="jsonl")
+    out, err = capfd.readouterr()
+    assert out == output
+
+
+def test_JsonLines_Streaming():
+    """ Test JSON lines writer outputs first record before next record is produced """
+    written = []
+
+    class Output:
+        def __init__(self):
+            self.buffer = ""
+
+        def write(self, text):
+            self.buffer += text
+
+        def flush(self):
+            written.append(self.buffer)
+
+    def records():
+        yield {'id': 0}
+        # first record is flushed before second is requested
+        assert written == ['{"id": 0}\n']
+        yield {'id': 1}
+
+    assert writeJsonLines(records(), Output()) == 2
+    assert written[-1] == '{"id": 0}\n{"id": 1}\n'
+
+
+@pytest.mark.parametrize("run", [runDebtFunctional, runDebtObjectOriented_LoadIds])
+@responses.activate
+def test_IncrementalFetch_NewPayments(capfd, monkeypatch, tmp_path, run):
+    """
+    Test incremental fetch mode : second run fetches payment plans and only payments made since first run, in single
+    query each, and recomputes changed payment plan from all its payments. Output is the same as in single fetch mode
+    """
+    monkeypatch.chdir(tmp_path)
+    plans = [dict(pp) for pp in PaymentPlans]
+    payments = list(Payments)
+    # mocks serve current content of plans and payments
+    mockFilteredTables(Debts, plans, payments)
+
+    # === first run : no state, all payment plans are recomputed
+    APIAccess.Today = datetime.datetime(2020, 9, 1, 12, 0)
+    run(config, 3, True, "incremental")
+    capfd.readouterr()
+
+    # === second run : new payments, changed start date of payment plan 2
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    payments += [{"amount": 10, "date": "2021-01-02", "payment_plan_id": 1},
+                 {"amount": 20.5, "date": "2020-12-01", "payment_plan_id": 3}]
+    plans[2]['start_date'] = "2020-01-02"
+
+    run(config, 3, True, "single")
+    expected, _ = capfd.readouterr()
+
+    responses.calls.reset()
+    run(config, 3, True, "incremental")
+    out, _ = capfd.readouterr()
+
+    # === Assertions
+    assert out == expected
+    assert [call.request.url for call in responses.calls if call.request.url.startswith(config['URL']['Payments'])] \
+           == [config['URL']['Payments'] + "?date_gte=2020-09-01", config['URL']['Payments'] + "?payment_plan_id=2"]
+    assert [call.request.url for call in responses.calls
+            if call.request.url.startswith(config['URL']['PaymentPlans'])] == [config['URL']['PaymentPlans']]
+
+
+@pytest.mark.parametrize("impl", ["Functional", "OOP"])
+@responses.activate
+def test_IncrementalFetch_CountersAndPrunedState(monkeypatch, tmp_path, impl):
+    """
+    Test incremental fetch mode processes each payment plan once per run in both implementations, drops state of
+    payment plans no longer seen, so that watermark moves on, and keeps state of each shard in separate file
+    """
+    monkeypatch.chdir(tmp_path)
+    plans = [dict(pp) for pp in PaymentPlans]
+    mockFilteredTables(Debts, plans, Payments)
+
+    def runCounters():
+        api = APIIncrementalAccess(APIAccess(config))
+        if impl == "Functional":
+            enrichDebts(api, addPaymentPlanExtraInfo, api.iterDebts())
+        else:
+            loadDebtRecords(api, DebtRecordExtra, api.iterDebts())
+        return api.incrementalStats()
+
+    # === Assertions
+    APIAccess.Today = datetime.datetime(2020, 9, 1, 12, 0)
+    assert runCounters() == {'recomputed': 4, 'incremental': 0, 'delta_payments': 0}
+
+    # payment plan 3 is removed : its state no longer holds back watermark
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    del plans[3]
+    assert runCounters() == {'recomputed': 0, 'incremental': 3, 'delta_payments': 2}
+    state = IncrementalState(config)
+    assert sorted(state.plans) == ["0", "1", "2"]
+    assert state.watermark() == APIAccess.Today.isoformat()
+
+    # no changes : one query per table
+    APIAccess.Today = datetime.datetime(2021, 2, 1)
+    responses.calls.reset()
+    assert runCounters() == {'recomputed': 0, 'incremental': 3, 'delta_payments': 0}
+    assert len(responses.calls) == 3
+
+    assert IncrementalState(config, ShardSpec(1, 2)).path == ".debt_state.1_of_2.json"
+
+
+def test_IncrementalFetch_PaymentsFetchedWithoutLock(monkeypatch, tmp_path):
+    """ Test incremental fetch mode fetches payments of payment plans without holding state lock """
+    monkeypatch.chdir(tmp_path)
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    api = APIIncrementalAccess(APIAccess(config))
+    fetched = []
+
+    def fetchPayments(payment_plan_id=None):
+        fetched.append(api.lock.locked())
+        return [pmt for pmt in Payments if pmt['payment_plan_id'] == payment_plan_id]
+
+    monkeypatch.setattr(api.api, 'fetchPayments', fetchPayments)
+    for pp in PaymentPlans:
+        assert api.paymentPlanInfo(pp, 100.0) is not None
+    assert fetched == [False] * len(PaymentPlans)
+
+
+def test_DebtTable_SameAsRecords():
+    """ Test debt records stored in DebtTable columns are returned with the same values and display """
+    records = [DebtRecordExtra.FromValues(0, 123.46, True, 20.96, datetime.datetime(2021, 2, 1)),
+               DebtRecordExtra.FromValues(1, 100.0, True, 0.0, None),
+               DebtRecordExtra.FromValues(2, 4920.34, False, None, None),
+               DebtRecordExtra.FromValues(3, 12938.0, True, 9247.745, datetime.datetime(2021, 1, 30, 10, 15, 1, 5))]
+    table = DebtTable(DebtRecordExtra).extend(records)
+
+    assert len(table) == 4
+    assert repr(table) == repr(records)
+    assert [rec.display(False) for rec in table] == [rec.display(False) for rec in records]
+    assert [rec.asDict() for rec in table] == [rec.asDict() for rec in records]
+
+    basic = DebtTable(DebtRecord).extend([DebtRecord.FromValues("A-1", 1.5, False), Exception("first"),
+                                          DebtRecord.FromValues(2 ** 70, 2.5, True), Exception("second")])
+    assert repr(basic) == "[{'amount': 1.5, 'id': A-1, 'in_payment_plan': False}, " \
+                          f"{{'amount': 2.5, 'id': {2 ** 70}, 'in_payment_plan': True}}]"
+    assert str(basic.error) == "first"
+    assert not hasattr(basic[0], '__dict__')
+
+
 @pytest.mark.parametrize("impl", ["Functional", "OOP"])
 @responses.activate
 def test_DebtIsPaidOff(capfd, impl):
@@ -379,6 +1779,73 @@ def test_MultipleDebtIds_OOP(capfd):
     out, err = capfd.readouterr()
     assert out == output
 
+@pytest.mark.parametrize("max_debt_id", [0, 4, 37, 1000])
+@responses.activate
+def test_DebtIdScanner_SparseIds(max_debt_id):
+    """
+    Test debt id discovery on sparse id space : gaps shorter than IdScan.MaxGap do not stop the scan,
+    number of probes grows logarithmically with highest debt id
+    """
+    # === Mock Responses
+    # gaps of 2 missing ids every 5 ids
+    debt_ids = [debt_id for debt_id in range(max_debt_id + 1) if debt_id % 5 not in (2, 3)] + [max_debt_id]
+    debts = [{"amount": 100, "id": debt_id} for debt_id in sorted(set(debt_ids))]
+    mockFilteredTables(debts, [], [])
+
+    # === Assertions
+    scanner = DebtIdScanner(APIAccess(config))
+    assert scanner.upperBound() == max_debt_id + 1
+    probes = len(responses.calls)
+    assert probes <= 2 * (4 * max(1, max_debt_id).bit_length() + 1)
+
+    assert list(scanner.iterDebts()) == debts
+    assert len(responses.calls) - probes == (max_debt_id + 2) // 2
+
+
+@responses.activate
+def test_GenerateIds_SparseIds(capfd):
+    """ Test OOP implementation with generated debt ids, when some debt ids are missing """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    # === Mock Responses
+    debts = [dict(dbt, id=dbt['id'] * 2) for dbt in Debts]
+    plans = [dict(pp, debt_id=pp['debt_id'] * 2) for pp in PaymentPlans]
+    mockFilteredTables(debts, plans, Payments)
+
+    # === Assertions
+    output = \
+        "{'amount': 123.46, 'id': 0, 'in_payment_plan': True}\n" \
+        "{'amount': 100.0, 'id': 2, 'in_payment_plan': True}\n" \
+        "{'amount': 4920.34, 'id': 4, 'in_payment_plan': True}\n" \
+        "{'amount': 12938.0, 'id': 6, 'in_payment_plan': True}\n" \
+        "{'amount': 9238.02, 'id': 8, 'in_payment_plan': False}\n"
+
+    runDebtObjectOriented_GenerateIds(config, basic1extra2both3=1, test_run=True)
+    out, err = capfd.readouterr()
+    assert out == output
+
+
+@pytest.mark.parametrize("test_run", [True, False])
+def test_GenerateIds_BothSinglePass(capfd, monkeypatch, mockServer, test_run):
+    """
+    Test OOP implementation with generated debt ids outputs both lists with as many requests as extended list alone,
+    and the same output as basic and extended lists output one after the other
+    """
+    APIAccess.Today = datetime.datetime(2021, 1, 28)
+    monkeypatch.setattr(APIAccess, '_instance', None)
+    cfg = mockServer.config(config)
+    outputs, requests = {}, {}
+    for basic1extra2both3 in [1, 2, 3]:
+        mockServer.resetStats()
+        APIAccess._instance = None
+        assert runDebtObjectOriented_GenerateIds(cfg, basic1extra2both3, test_run)
+        outputs[basic1extra2both3], err = capfd.readouterr()
+        requests[basic1extra2both3] = mockServer.stats()['requests']
+
+    assert requests[3] == requests[2]
+    separator = "" if test_run else "-" * 80 + "\n"
+    assert outputs[3] == outputs[1] + separator + outputs[2]
+
+
 @pytest.mark.parametrize("impl", ["Functional", "OOP"])
 @responses.activate
 def test_MultiplePaymentPlans(capfd, impl):